@@ -13,9 +13,19 @@
 #  DB 0x0a   ; a hex byte
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
-
+#
+#  BANK 3   ; what follows goes into bank 3 of the bank store
+#  Table:
+#  DB 42
+#  BANK     ; back to the program
+
+import hashlib
+import json
+import os
 import sys
 import re
+import struct
+import zlib
 
 # Opcodes
 OPCODES = {
@@ -55,6 +65,19 @@ OPCODES = {
     "XOR":  {"type": 2, "code": "10101011"},
 }
 
+# Binary image (.ls8b) layout; must match the loader in ls8/cpu.py
+IMAGE_MAGIC = b"LS8B"
+IMAGE_HEADER = struct.Struct("<4sBBBBHHI")
+IMAGE_HAS_SYMBOLS = 0b01
+IMAGE_HAS_CHECKSUM = 0b10
+
+# Bank-switched memory; must match the bank window in ls8/cpu.py. Labels
+# in a BANK section get addresses in the window, where the bank shows up
+# once it's selected
+BANK_WINDOW = 0x80
+BANK_SIZE = 0x40
+BANK_COUNT = 0x400
+
 # Regex for matching lines
 # Capturing groups: label, opcode, operandA, operandB
 REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
@@ -63,10 +86,37 @@ REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
 REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
 REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
 
+# The same, compiled once rather than looked up on every line
+LINE = re.compile(REGEX)
+LINE_DS = re.compile(REGEX_DS, re.IGNORECASE)
+LINE_DB = re.compile(REGEX_DB, re.IGNORECASE)
+REGISTER = re.compile(r"R([0-7])")
+
+# Build cache written to the output directory by build()
+CACHE_FILE = ".asm-cache.json"
+
+
+class AssemblerError(ValueError):
+    """
+    An error in the source being assembled. `line` is the 1-based source
+    line (None if unknown) and `status` the exit status main() uses.
+    """
+
+    def __init__(self, message, line=None, status=1):
+        if line is not None:
+            message = f"line {line}: {message}"
+        super().__init__(message)
+        self.line = line
+        self.status = status
+
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-O] [inputfile] [outputfile]
+           asm.py [-O] --build [sourcedir] [outputdir] [.ls8 | .ls8b]
+
+    An output file ending in .ls8b gets a binary image instead of text.
+    -O runs the peephole optimizer and reports what it saved.
     """
 
     if len(argv) == 1:
@@ -101,6 +151,8 @@ def open_files(inputfile, outputfile):
 
     if outputfile == "-":
         outputfile = sys.stdout
+    elif outputfile.endswith(".ls8b"):
+        outputfile = open(outputfile, "wb")
     else:
         outputfile = open(outputfile, "w")
 
@@ -127,7 +179,7 @@ def p8(v):
     return "{:08b}".format(v)
 
 
-def pass1(inputfile, sym, code):
+def pass1(inputfile, sym, code, line_map=None, banks=None):
     """
     Pass 1
 
@@ -135,6 +187,10 @@ def pass1(inputfile, sym, code):
     * Parse labels, opcodes, and operands
     * Record label offsets
     * Emit machine code
+    * Record the source line of every byte in line_map, if given
+    * Emit BANK sections into banks (bank number -> code list), if given
+
+    Raises AssemblerError on bad source.
     """
 
     # Source line number
@@ -143,18 +199,25 @@ def pass1(inputfile, sym, code):
     # Current code address (for labels)
     addr = 0
 
+    # Where code is being emitted: the program, or a BANK section
+    out = code
+    bank = None
+    if banks is None:
+        banks = {}
+
+    # Program address to carry on from after a BANK section
+    program_addr = 0
+
     def get_reg(op, fatal=True):
         """Get a register number from a string, e.g. "R2" -> 2"""
 
         nonlocal line_num
 
-        m = re.match(r"R([0-7])", op)
+        m = REGISTER.match(op)
 
         if m is None:
             if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise AssemblerError(f"unknown register {op}", line_num)
             else:
                 return None
 
@@ -165,7 +228,7 @@ def pass1(inputfile, sym, code):
 
         nonlocal addr
 
-        code.append(f"{machine_code} # {opcode}")
+        out.append(f"{machine_code} # {opcode}")
         addr += 1
 
     def out1(opcode, op_a, op_b, machine_code):
@@ -174,8 +237,8 @@ def pass1(inputfile, sym, code):
         nonlocal addr
 
         reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
+        out.append(f"{machine_code} # {opcode} {op_a}")
+        out.append(p8(reg_a))
         addr += 2
 
     def out2(opcode, op_a, op_b, machine_code):
@@ -186,9 +249,9 @@ def pass1(inputfile, sym, code):
         reg_a = get_reg(op_a)
         reg_b = get_reg(op_b)
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
+        out.append(f"{machine_code} # {opcode} {op_a},{op_b}")
+        out.append(p8(reg_a))
+        out.append(p8(reg_b))
 
         addr += 3
 
@@ -207,9 +270,9 @@ def pass1(inputfile, sym, code):
             # If it's not a value, it might be a symbol
             out_b = f"sym:{op_b}"
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
+        out.append(f"{machine_code} # {opcode} {op_a},{op_b}")
+        out.append(p8(reg_a))
+        out.append(out_b)
 
         addr += 3
 
@@ -220,11 +283,10 @@ def pass1(inputfile, sym, code):
 
         nonlocal addr
 
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+        m = LINE_DS.match(line)
 
         if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
+            raise AssemblerError("missing argument to DS", line_num, 2)
 
         data = m.group(2)
 
@@ -234,7 +296,7 @@ def pass1(inputfile, sym, code):
             if print_char == ' ':
                 print_char = '[space]'
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
+            out.append(f"{p8(ord(data[i]))} # {print_char}")
 
         addr += len(data)
 
@@ -245,11 +307,10 @@ def pass1(inputfile, sym, code):
 
         nonlocal addr
 
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+        m = LINE_DB.match(line)
 
         if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
+            raise AssemblerError("missing argument to DB", line_num, 2)
 
         data = m.group(2)
 
@@ -257,35 +318,60 @@ def pass1(inputfile, sym, code):
             val = int(data, 0)
 
         except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+            raise AssemblerError("invalid integer argument to DB",
+                                 line_num, 2)
 
         # Force to byte size
         val &= 0xff
 
-        code.append(f"{p8(val)} # {data}")
+        out.append(f"{p8(val)} # {data}")
 
         addr += 1
 
+    def handle_bank(op_a):
+        """
+        Handle the BANK pseudo-opcode
+        """
+
+        nonlocal addr, out, bank, program_addr
+
+        if bank is None:
+            program_addr = addr
+
+        if op_a is None:
+            # Back to the program
+            out = code
+            bank = None
+            addr = program_addr
+            return
+
+        try:
+            bank = int(op_a, 0)
+        except ValueError:
+            raise AssemblerError("invalid bank number", line_num, 2)
+
+        if not 0 <= bank < BANK_COUNT:
+            raise AssemblerError(f"bank {bank} out of range", line_num, 2)
+
+        # A bank can be reopened; carry on after what it holds already
+        out = banks.setdefault(bank, [])
+        addr = BANK_WINDOW + sum(1 for c in out if c[:1] != '#')
+
     def check_ops(opcode, op_a, op_b):
         """Check operands for sanity with a particular opcode"""
 
         def check_ops_count(desired, found):
             # Makes sure we have right operand count
             if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise AssemblerError(f"missing operand to {opcode}",
+                                     line_num)
             elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise AssemblerError(f"unexpected operand to {opcode}",
+                                     line_num)
 
         # Make sure we know this opcode at all
         if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
+            raise AssemblerError(f"unknown opcode {opcode}", line_num, 2)
 
         op_type = OPCODES[opcode]["type"]
 
@@ -330,7 +416,8 @@ def pass1(inputfile, sym, code):
 
         # print(line)  # debug
 
-        m = re.match(REGEX, line)
+        m = LINE.match(line)
+        start = addr
 
         if m is not None:
             label, opcode, op_a, op_b = normalize_line(m.groups())
@@ -341,13 +428,15 @@ def pass1(inputfile, sym, code):
             if label is not None:
                 sym[label] = addr
                 # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
+                out.append(f'# {label} (address {addr}):')
 
             if opcode is not None:
                 if opcode == 'DS':
                     handle_ds(line)
                 elif opcode == 'DB':
                     handle_db(line)
+                elif opcode == 'BANK':
+                    handle_bank(op_a)
                 else:
                     # Check operand count
                     check_ops(opcode, op_a, op_b)
@@ -357,16 +446,303 @@ def pass1(inputfile, sym, code):
                     handler = type_f[op_info["type"]]
                     handler(opcode, op_a, op_b, op_info["code"])
         else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+            raise AssemblerError(f"no match: {line}", line_num, 3)
 
+        if bank is not None:
+            # Bank addresses aren't program addresses, so they stay out
+            # of line_map
+            if addr > BANK_WINDOW + BANK_SIZE:
+                raise AssemblerError(f"bank {bank} holds more than "
+                                     f"{BANK_SIZE} bytes", line_num, 2)
 
-def pass2(outputfile, sym, code):
+        elif line_map is not None:
+            for a in range(start, addr):
+                line_map[a] = line_num
+
+
+# Optimizer: register operand A is written by these (POP also moves SP)
+WRITES_A = {
+    "ADD", "AND", "DEC", "DIV", "INC", "LD", "LDI", "MOD", "MUL", "NOT",
+    "OR", "POP", "SHL", "SHR", "SUB", "XOR",
+}
+
+# Optimizer: nothing after these runs unless it's jumped to
+UNCONDITIONAL = {"HLT", "IRET", "JMP", "RET"}
+
+# Optimizer: jumps that may or may not be taken
+CONDITIONAL = {"JEQ", "JGE", "JGT", "JLE", "JLT", "JNE"}
+
+# Optimizer: registers never treated as constants. The CPU sets IS (R6)
+# bits from other threads and moves SP (R7) itself, and IM (R5) decides
+# when handlers run
+VOLATILE = {5, 6, 7}
+
+# Label comment lines written by pass 1
+LABEL_LINE = re.compile(r"# (\w+) \(address (\d+)\):")
+
+# Bank section header in .ls8 text output
+BANK_LINE = "# BANK {}:"
+
+# Bytes per instruction by operand type
+TYPE_SIZE = {0: 1, 1: 2, 2: 3, 8: 3}
+
+
+def decode_items(code, line_map=None):
     """
-    Output the code, substituting in any symbols.
+    Split pass 1 output into items for the optimizer:
+
+    * ["label", name]
+    * ["op", opcode, entries, line]
+    * ["data", entries, line]
+
+    `entries` are the pass 1 code strings the item covers and `line` the
+    source line of its first byte (None without a line_map).
     """
 
-    for c in code:
+    items = []
+    addr = 0
+    i = 0
+
+    while i < len(code):
+        c = code[i]
+        line = line_map.get(addr) if line_map else None
+
+        if c[:1] == '#':
+            items.append(["label", LABEL_LINE.match(c).group(1)])
+            i += 1
+            continue
+
+        bits, _, comment = c.partition('#')
+        words = comment.split()
+        info = OPCODES.get(words[0]) if words else None
+
+        # DS/DB bytes have a character or number as their comment, so
+        # only instructions match an opcode name and its bits
+        if info is not None and info["code"] == bits.strip():
+            size = TYPE_SIZE[info["type"]]
+            items.append(["op", words[0], code[i:i + size], line])
+        else:
+            size = 1
+            items.append(["data", [c], line])
+
+        i += size
+        addr += size
+
+    return items
+
+
+def encode_items(items, sym, code, line_map=None):
+    """
+    Lay the items out again, refilling code and sym with the new label
+    addresses (and line_map, if given).
+    """
+
+    code.clear()
+    sym.clear()
+    if line_map is not None:
+        line_map.clear()
+
+    addr = 0
+
+    for item in items:
+        if item[0] == "label":
+            sym[item[1]] = addr
+            code.append(f'# {item[1]} (address {addr}):')
+            continue
+
+        entries, line = item[-2], item[-1]
+        code.extend(entries)
+
+        if line_map is not None and line is not None:
+            for a in range(addr, addr + len(entries)):
+                line_map[a] = line
+
+        addr += len(entries)
+
+
+def reg_of(entry):
+    """Register number of a pass 1 register operand entry"""
+
+    return int(entry, 2)
+
+
+def global_constants(items):
+    """
+    Return {register: (index, value entry)} for registers that are only
+    ever written by one LDI, items[index], in the straight-line code the
+    program starts with. The entry code ends at the first label (a jump
+    target), data byte or jump of any kind, so every item after the LDI
+    runs after it and sees the constant; the items before it don't.
+    """
+
+    writes = {}
+    for item in items:
+        if item[0] == "op" and item[1] in WRITES_A:
+            r = reg_of(item[2][1])
+            writes[r] = writes.get(r, 0) + 1
+
+    constants = {}
+
+    for index, item in enumerate(items):
+        # The entry code ends at the first label or data byte
+        if item[0] != "op":
+            break
+
+        opcode, entries = item[1], item[2]
+
+        if opcode == "LDI":
+            r = reg_of(entries[1])
+            if r == 5:
+                # Interrupts may be enabled from here on, and a handler
+                # could run before a later constant is loaded
+                break
+            if writes[r] == 1 and r not in VOLATILE:
+                constants[r] = (index, entries[2])
+
+        if (opcode in UNCONDITIONAL or opcode in CONDITIONAL
+                or opcode in ("CALL", "INT", "ST")):
+            break
+
+    return constants
+
+
+def optimize(sym, code, line_map=None):
+    """
+    Optional peephole pass between pass 1 and pass 2:
+
+    * drop an LDI of the constant a register is already known to hold
+    * drop a PUSH Rx that is immediately followed by POP Rx
+    * turn ADD/SUB Rx,Ry with Ry known to be 1 into INC/DEC Rx
+    * drop instructions after an unconditional JMP/HLT/RET/IRET, up to
+      the next label
+
+    Registers are only tracked within a basic block (labels are assumed
+    to be jump targets), except for constants loaded once at the start
+    of the program, which hold from their LDI on. Label addresses are fixed up afterwards; addresses
+    written as numbers in the source are not.
+
+    Rewrites code, sym and line_map in place and returns a report dict.
+    """
+
+    items = decode_items(code, line_map)
+
+    size_before = sum(len(item[-2]) for item in items if item[0] != "label")
+    ops_before = sum(1 for item in items if item[0] == "op")
+    counts = {"ldi": 0, "push_pop": 0, "inc_dec": 0, "dead": 0}
+
+    constants = global_constants(items)
+
+    out = []
+    known = {}
+    dead = False
+    i = 0
+
+    while i < len(items):
+        item = items[i]
+        i += 1
+
+        if item[0] == "label":
+            known = {}
+            dead = False
+            out.append(item)
+            continue
+
+        if item[0] == "data":
+            known = {}
+            dead = False
+            out.append(item)
+            continue
+
+        opcode, entries = item[1], item[2]
+
+        if dead:
+            counts["dead"] += 1
+            continue
+
+        if opcode == "LDI":
+            r = reg_of(entries[1])
+            if known.get(r) == entries[2]:
+                counts["ldi"] += 1
+                continue
+            if r not in VOLATILE:
+                known[r] = entries[2]
+            out.append(item)
+            continue
+
+        if (opcode == "PUSH" and i < len(items) and items[i][0] == "op"
+                and items[i][1] == "POP" and items[i][2][1] == entries[1]):
+            counts["push_pop"] += 1
+            i += 1
+            continue
+
+        if opcode in ("ADD", "SUB"):
+            b = reg_of(entries[2])
+            value = known.get(b)
+            if value is None and b in constants and constants[b][0] < i - 1:
+                # The program's LDI of the constant has already run
+                value = constants[b][1]
+            if value == p8(1):
+                a = reg_of(entries[1])
+                new = "INC" if opcode == "ADD" else "DEC"
+                item = ["op", new,
+                        [f"{OPCODES[new]['code']} # {new} R{a}", entries[1]],
+                        item[3]]
+                counts["inc_dec"] += 1
+
+        out.append(item)
+
+        if opcode in ("CALL", "INT"):
+            # The subroutine or handler may change anything
+            known = {}
+        elif opcode in WRITES_A:
+            known.pop(reg_of(entries[1]), None)
+
+        if opcode in ("PUSH", "POP", "CALL", "RET"):
+            known.pop(7, None)
+
+        if opcode in UNCONDITIONAL:
+            dead = True
+
+    encode_items(out, sym, code, line_map)
+
+    size_after = sum(len(item[-2]) for item in out if item[0] != "label")
+    ops_after = sum(1 for item in out if item[0] == "op")
+
+    return {
+        "bytes_before": size_before,
+        "bytes_after": size_after,
+        # Every instruction removed is one cycle less each time its code
+        # runs; a static count, so once per pass through the code
+        "instructions_removed": ops_before - ops_after,
+        "rewrites": counts,
+    }
+
+
+def format_report(name, report):
+    """
+    One-line summary of an optimize() report.
+    """
+
+    saved = report["bytes_before"] - report["bytes_after"]
+    details = ", ".join(f"{k} {v}" for k, v in report["rewrites"].items() if v)
+
+    return (f"{name}: {report['bytes_before']} -> {report['bytes_after']} "
+            f"bytes ({saved} saved), {report['instructions_removed']} "
+            f"instructions removed (cycles saved per pass)"
+            + (f" [{details}]" if details else ""))
+
+
+def pass2(outputfile, sym, code, banks=None):
+    """
+    Output the code, substituting in any symbols, followed by each BANK
+    section under a "# BANK n:" line.
+    """
+
+    sections = [code]
+    for bank, entries in sorted((banks or {}).items()):
+        sections.append([BANK_LINE.format(bank)] + entries)
+
+    for c in (c for section in sections for c in section):
         # Replace symbols
         if c[:4] == 'sym:':
             s = c[4:].strip()
@@ -375,13 +751,257 @@ def pass2(outputfile, sym, code):
                 c = p8(sym[s])
 
             else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
+                raise AssemblerError(f"unknown symbol: {s}", status=2)
 
         outputfile.write(f"{c}\n")
 
 
+def resolve(sym, code, line_map=None):
+    """
+    Return the machine code as bytes, substituting in any symbols.
+    """
+
+    result = bytearray()
+
+    for c in code:
+        # Skip label comment lines
+        if c[:1] == '#':
+            continue
+
+        if c[:4] == 'sym:':
+            s = c[4:].strip()
+
+            if s not in sym:
+                line = line_map.get(len(result)) if line_map else None
+                raise AssemblerError(f"unknown symbol: {s}", line, 2)
+
+            result.append(sym[s])
+
+        else:
+            result.append(int(c.split('#')[0], 2))
+
+    return bytes(result)
+
+
+def pass2_binary(outputfile, sym, code, load_address=0, banks=None):
+    """
+    Output the code as a binary image with a symbol table and checksum.
+    Images have no room for BANK sections.
+    """
+
+    if banks:
+        raise AssemblerError("BANK sections need .ls8 text output", status=2)
+
+    data = resolve(sym, code)
+
+    table = bytearray()
+    for name, address in sym.items():
+        encoded = name.encode("ascii")
+        table += bytes((address, len(encoded))) + encoded
+
+    header = IMAGE_HEADER.pack(IMAGE_MAGIC, 1, load_address,
+                               IMAGE_HAS_SYMBOLS | IMAGE_HAS_CHECKSUM, 0,
+                               len(data), len(sym), zlib.crc32(data))
+
+    outputfile.write(header + data + table)
+
+
+def bank_labels(banks):
+    """
+    Return {label: address} for the labels in pass 1 BANK sections.
+    """
+
+    labels = {}
+
+    for entries in banks.values():
+        for c in entries:
+            m = LABEL_LINE.match(c)
+            if m is not None:
+                labels[m.group(1)] = int(m.group(2))
+
+    return labels
+
+
+def assemble(source, optimize_code=False, report=None, banks=None):
+    """
+    Assemble source text (a string or an iterable of lines) and return
+    (code, symbols, line_map): the machine code as bytes, the label
+    addresses, and a dict mapping each code address to its 1-based
+    source line. Raises AssemblerError on bad source.
+
+    With optimize_code the peephole pass runs, and its report is copied
+    into the `report` dict if one is given. BANK sections are resolved
+    into the `banks` dict (bank number -> bytes) if one is given.
+    """
+
+    if isinstance(source, str):
+        source = source.splitlines()
+
+    sym = {}
+    code = []
+    line_map = {}
+    bank_code = {}
+
+    pass1(source, sym, code, line_map, bank_code)
+
+    if optimize_code:
+        result = optimize(sym, code, line_map)
+        # The optimizer only lays out the program's own labels again
+        sym.update(bank_labels(bank_code))
+        if report is not None:
+            report.update(result)
+
+    data = resolve(sym, code, line_map)
+    if len(data) > 256:
+        raise AssemblerError(f"program is {len(data)} bytes, more than "
+                             f"fits in RAM")
+
+    if banks is not None:
+        for bank, entries in bank_code.items():
+            banks[bank] = resolve(sym, entries)
+
+    return data, sym, line_map
+
+
+def source_hash(source, optimize_code=False):
+    """
+    Return the cache key for a source file's text. The assembler's own
+    source and the optimizer setting are hashed in too, so changing
+    either invalidates the cache.
+    """
+
+    digest = hashlib.sha256(ASSEMBLER_HASH)
+    digest.update(b"O" if optimize_code else b"-")
+    digest.update(source)
+
+    return digest.hexdigest()
+
+
+def build(source_dir=".", output_dir=".", extension=".ls8",
+          optimize_code=False):
+    """
+    Assemble every .asm file in source_dir into output_dir, in this
+    process, skipping files whose source hasn't changed since the last
+    build and whose output is still in place. output_dir is created if
+    it doesn't exist.
+
+    Pass 1 results (symbols and code) are cached by content hash in
+    output_dir/CACHE_FILE, so a missing or stale output file is rewritten
+    without re-parsing. With optimize_code the peephole pass runs on
+    every file assembled and its report is printed to stderr. Returns
+    (assembled, rewritten, skipped) counts.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+    cache_path = os.path.join(output_dir, CACHE_FILE)
+
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    assembled = rewritten = skipped = 0
+    changed = False
+
+    for name in sorted(os.listdir(source_dir)):
+        if not name.endswith(".asm"):
+            continue
+
+        with open(os.path.join(source_dir, name), "rb") as f:
+            source = f.read()
+
+        key = source_hash(source, optimize_code)
+        outname = os.path.join(output_dir, name[:-4] + extension)
+
+        entry = cache.get(name)
+
+        try:
+            if entry is None or entry["hash"] != key:
+                sym = {}
+                code = []
+                banks = {}
+                pass1(source.decode().splitlines(), sym, code, banks=banks)
+
+                if optimize_code:
+                    print(format_report(name, optimize(sym, code)),
+                          file=sys.stderr)
+                    sym.update(bank_labels(banks))
+
+                # JSON keys are strings; bank numbers are turned back
+                # into ints when the output is written
+                entry = cache[name] = {"hash": key, "sym": sym, "code": code,
+                                       "banks": banks}
+                assembled += 1
+
+            elif entry.get("output") == output_stamp(outname):
+                skipped += 1
+                continue
+
+            else:
+                rewritten += 1
+
+            banks = {int(bank): entries
+                     for bank, entries in entry.get("banks", {}).items()}
+
+            if extension == ".ls8b":
+                with open(outname, "wb") as f:
+                    pass2_binary(f, entry["sym"], entry["code"], banks=banks)
+            else:
+                with open(outname, "w") as f:
+                    pass2(f, entry["sym"], entry["code"], banks)
+
+        except AssemblerError as e:
+            # Say which file it was in
+            e.args = (f"{name}: {e}",)
+            raise
+
+        entry["output"] = output_stamp(outname)
+        changed = True
+
+    if changed:
+        with open(cache_path, "w") as f:
+            json.dump(cache, f)
+
+    return assembled, rewritten, skipped
+
+
+def output_stamp(path):
+    """
+    Return [size, mtime] of an output file, or None if it's missing, to
+    notice outputs that were deleted or edited since they were built.
+    """
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return [st.st_size, st.st_mtime_ns]
+
+
 def main(argv):
+    optimize_code = "-O" in argv
+    if optimize_code:
+        argv = [a for a in argv if a != "-O"]
+
+    if len(argv) > 1 and argv[1] == "--build":
+        args = argv[2:] + [".", ".", ".ls8"][len(argv) - 2:]
+        try:
+            assembled, rewritten, skipped = build(*args[:3],
+                                                  optimize_code=optimize_code)
+        except AssemblerError as e:
+            print(e, file=sys.stderr)
+            return e.status
+        except OSError as e:
+            # A missing source directory, unwritable output, ...
+            print(e, file=sys.stderr)
+            return 1
+
+        print(f"{assembled} assembled, {rewritten} rewritten from cache, "
+              f"{skipped} up to date", file=sys.stderr)
+        return 0
+
     # Parse command line
     inputfile, outputfile = parse_commandline(argv)
 
@@ -394,12 +1014,34 @@ def main(argv):
     # Set up the machine code output
     code = []
 
+    # BANK sections: bank number -> machine code
+    banks = {}
+
     # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    try:
+        pass1(inputfile, sym, code, banks=banks)
+
+        if optimize_code:
+            name = getattr(inputfile, "name", "-")
+            print(format_report(name, optimize(sym, code)), file=sys.stderr)
+            sym.update(bank_labels(banks))
+
+        if "b" in getattr(outputfile, "mode", ""):
+            pass2_binary(outputfile, sym, code, banks=banks)
+        else:
+            pass2(outputfile, sym, code, banks)
+
+    except AssemblerError as e:
+        print(e, file=sys.stderr)
+        return e.status
 
     return 0
 
 
+# Hash of this file, part of every cache key (see source_hash())
+with open(__file__, "rb") as f:
+    ASSEMBLER_HASH = hashlib.sha256(f.read()).digest()
+
+
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
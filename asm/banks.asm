@@ -0,0 +1,79 @@
+; Prints strings kept in memory banks
+;
+; The strings live in BANK sections, outside the program's 256 bytes.
+; Storing a bank number at 0xF5 swaps that bank into the window at 0x80,
+; where labels in BANK sections point. The window is written back to
+; the bank store on every switch, so changes to a bank stick.
+;
+; Expected output:
+; Hello from bank 1
+; Hello from bank 2
+; Jello from bank 1
+
+	LDI R4,0xF5          ; bank register
+	LDI R2,PrintStr      ; address of PrintStr
+
+	LDI R3,1
+	ST R4,R3             ; select bank 1
+	LDI R0,Bank1Text
+	LDI R1,18
+	CALL R2
+
+	LDI R3,2
+	ST R4,R3             ; select bank 2
+	LDI R0,Bank2Text
+	LDI R1,18
+	CALL R2
+
+	LDI R3,1
+	ST R4,R3             ; back to bank 1
+	LDI R0,Bank1Text
+	LDI R3,74            ; 'J'
+	ST R0,R3             ; change the first letter
+
+	LDI R3,2
+	ST R4,R3             ; switch away...
+	LDI R3,1
+	ST R4,R3             ; ...and back: the change was kept
+	LDI R0,Bank1Text
+	LDI R1,18
+	CALL R2
+	HLT
+
+; Subroutine: PrintStr
+; R0 the address of the string
+; R1 the number of bytes to print
+
+PrintStr:
+
+	LDI R3,0
+	CMP R1,R3            ; Done when R1 == 0
+	LDI R3,PrintStrEnd
+	JEQ R3
+
+	LD R3,R0             ; Load R3 from address in R0
+	PRA R3               ; Print character
+
+	INC R0
+	DEC R1
+
+	LDI R3,PrintStr      ; Keep processing
+	JMP R3
+
+PrintStrEnd:
+
+	RET
+
+BANK 1
+
+Bank1Text:
+
+	ds Hello from bank 1
+	db 0x0a
+
+BANK 2
+
+Bank2Text:
+
+	ds Hello from bank 2
+	db 0x0a
@@ -0,0 +1,26 @@
+; arith.asm
+;
+; Benchmark: tight arithmetic loop, 250 x 250 trips through
+; INC/ADD/XOR/MUL plus the loop compare.
+;
+; Expected output: 30
+
+	LDI R0,0             ; accumulator
+	LDI R1,0             ; outer counter
+	LDI R2,250           ; loop limit
+Outer:
+	LDI R3,0             ; inner counter
+	LDI R4,Inner
+Inner:
+	INC R3
+	ADD R0,R3
+	XOR R0,R1
+	MUL R0,R3
+	CMP R3,R2
+	JNE R4               ; Loops while R3 != 250
+	INC R1
+	CMP R1,R2
+	LDI R4,Outer
+	JNE R4               ; Loops while R1 != 250
+	PRN R0
+	HLT
@@ -0,0 +1,32 @@
+; branchy.asm
+;
+; Benchmark: branch-heavy CMP/JEQ/JNE loop. Takes a different
+; path for odd and even counter values, 256 x 200 trips.
+;
+; Expected output: 203
+
+	LDI R1,0             ; zero, for comparisons
+	LDI R3,200           ; outer counter, counting down
+Outer:
+Inner:
+	LDI R0,1
+	AND R0,R2            ; parity of the inner counter
+	CMP R0,R1
+	LDI R4,Even
+	JEQ R4               ; Skip the odd path when even
+	INC R0
+	INC R0
+Even:
+	INC R2
+	CMP R2,R1
+	LDI R4,Inner
+	JNE R4               ; Loops until R2 wraps to 0
+	DEC R3
+	CMP R3,R1
+	LDI R4,Outer
+	JNE R4               ; Loops while R3 != 0
+	ADD R2,R0
+	LDI R0,200
+	ADD R2,R0
+	PRN R2
+	HLT
@@ -0,0 +1,34 @@
+; recurse.asm
+;
+; Benchmark: deep CALL/RET recursion. Sums 60 + 59 + ... + 1
+; recursively, 250 times over.
+;
+; Expected output: 38
+
+	LDI R2,Sum           ; address of Sum
+	LDI R3,250           ; repetitions
+Again:
+	LDI R0,60            ; n
+	LDI R1,0             ; result
+	CALL R2
+	DEC R3
+	LDI R4,0
+	CMP R3,R4
+	LDI R4,Again
+	JNE R4               ; Repeat while R3 != 0
+	PRN R1
+	HLT
+
+; Adds R0 + (R0 - 1) + ... + 1 to R1, one call per term
+Sum:
+	LDI R4,0
+	CMP R0,R4
+	LDI R4,SumDone
+	JEQ R4               ; Done when R0 == 0
+	ADD R1,R0
+	PUSH R0
+	DEC R0
+	CALL R2
+	POP R0
+SumDone:
+	RET
@@ -0,0 +1,31 @@
+; stackheavy.asm
+;
+; Benchmark: stack-heavy code, four PUSHes and four POPs per
+; trip, 250 x 250 trips.
+;
+; Expected output: 7
+
+	LDI R0,7             ; value shuffled through the stack
+	LDI R1,0             ; outer counter
+	LDI R3,250           ; loop limit
+Outer:
+	LDI R2,0             ; inner counter
+	LDI R4,Inner
+Inner:
+	PUSH R0
+	PUSH R0
+	PUSH R0
+	PUSH R0
+	POP R0
+	POP R0
+	POP R0
+	POP R0
+	INC R2
+	CMP R2,R3
+	JNE R4               ; Loops while R2 != 250
+	INC R1
+	CMP R1,R3
+	LDI R4,Outer
+	JNE R4               ; Loops while R1 != 250
+	PRN R0
+	HLT
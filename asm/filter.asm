@@ -0,0 +1,46 @@
+; Upper-cases its input
+;
+; Reads bytes from an input port until the input ends and prints them
+; with a-z turned into A-Z, as a filter. Run it with the port at 0xF0
+; (its status byte is at 0xF1):
+;
+;   python ls8.py ../asm/filter.asm --input-port 0xF0 < file
+;
+; Without the port, the status byte reads as 0 and it stops at once.
+;
+; Expected output: the input, upper-cased
+
+	LDI R0,0xF0          ; data port
+
+Loop:
+
+	LDI R1,0xF1          ; status port
+	LD R1,R1
+	LDI R2,1             ; bit 0: a byte is ready
+	AND R1,R2
+	CMP R1,R2
+	LDI R3,Done
+	JNE R3               ; Stop at the end of the input
+
+	LD R1,R0             ; Read the byte
+
+	LDI R2,97            ; 'a'
+	CMP R1,R2
+	LDI R3,Print
+	JLT R3
+	LDI R2,123           ; 'z' + 1
+	CMP R1,R2
+	JGE R3
+
+	LDI R2,32            ; 'a' - 'A'
+	SUB R1,R2
+
+Print:
+
+	PRA R1
+	LDI R3,Loop
+	JMP R3
+
+Done:
+
+	HLT
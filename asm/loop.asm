@@ -0,0 +1,27 @@
+; loop.asm
+;
+; Tight nested counting loop, handy for timing the emulator.
+; Counts R0 up to 200, 200 times over.
+;
+; Expected output: 200
+
+	LDI R1,1             ; increment
+	LDI R2,200           ; loop limit
+	LDI R3,0             ; outer counter
+
+Outer:
+	LDI R0,0             ; inner counter
+	LDI R4,Inner
+
+Inner:
+	ADD R0,R1
+	CMP R0,R2
+	JNE R4               ; Loops while R0 != 200
+
+	ADD R3,R1
+	CMP R3,R2
+	LDI R4,Outer
+	JNE R4               ; Loops while R3 != 200
+
+	PRN R0
+	HLT
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+Run many LS-8 programs in parallel on a process pool.
+
+Usage: batch.py [-j JOBS] [--max-cycles N] [--timeout SECONDS]
+                <directory | manifest>
+
+A directory runs every .ls8, .ls8b or .asm file in it. A manifest has one job
+per line, either a bare program path or a JSON object:
+
+    {"program": "examples/mult.ls8", "registers": [3, 4], "max_cycles": 500,
+     "timeout": 0.5}
+
+`registers` optionally sets the initial values of R0 upwards. Relative
+program paths in a manifest are resolved against the manifest's
+directory.
+
+Results are streamed to stdout as JSON lines in completion order:
+
+    {"program": ..., "status": "halted", "cycles": 5, "pc": 12,
+     "fl": 0, "registers": [...], "stdout": "72\n"}
+
+`status` is "halted", "cycle_limit" (the job ran out of cycles),
+"timeout" (it ran out of wall-clock time), "fault" or "stack_overflow"
+(with the reason in "error"), or "error" if the job couldn't be run.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cpu import CPU, RUN_BUDGET, RUN_HALTED
+from devices import CaptureOutput
+
+# Default per-job instruction budget
+MAX_CYCLES = 1000000
+
+# The warmed-up CPU owned by each worker process
+worker_cpu = None
+
+
+def init_worker():
+    """
+    Process pool initializer: build the worker's CPU once.
+    """
+    global worker_cpu
+    worker_cpu = CPU()
+    worker_cpu.output = CaptureOutput()
+
+
+def run_job(job):
+    """
+    Run one job on the worker's CPU and return its result dict.
+    """
+    cpu = worker_cpu
+    cpu.reset(clear_ram=True)
+    cpu.output.clear()
+
+    result = {"program": job["program"]}
+    # Program output is captured by the CPU's output device; this only
+    # catches the trace printed on a fault
+    out = io.StringIO()
+
+    try:
+        cpu.load(job["program"])
+
+        for r, value in enumerate(job.get("registers", [])):
+            cpu.reg[r] = value
+
+        timeout = job.get("timeout")
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with contextlib.redirect_stdout(out):
+            outcome = cpu.run(max_cycles=job.get("max_cycles", MAX_CYCLES),
+                              deadline=deadline)
+
+        if outcome.status == RUN_BUDGET:
+            result["status"] = ("cycle_limit" if outcome.reason == "cycles"
+                                else "timeout")
+        else:
+            result["status"] = outcome.status
+            if outcome.status != RUN_HALTED:
+                result["error"] = outcome.reason
+
+    except (Exception, SystemExit) as e:
+        result["status"] = "error"
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result["cycles"] = cpu.cycles
+    result["pc"] = cpu.pc
+    result["fl"] = cpu.fl
+    result["registers"] = list(cpu.reg)
+    result["stdout"] = cpu.output.getvalue() + out.getvalue()
+
+    return result
+
+
+def read_jobs(source, max_cycles, timeout=None):
+    """
+    Return the list of jobs described by a directory or manifest file.
+    """
+    if os.path.isdir(source):
+        return [
+            {"program": os.path.join(source, name), "max_cycles": max_cycles,
+             "timeout": timeout}
+            for name in sorted(os.listdir(source))
+            if name.endswith((".ls8", ".ls8b", ".asm"))
+        ]
+
+    base = os.path.dirname(source)
+    jobs = []
+
+    with open(source) as file:
+        for line in file:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+
+            if line.startswith("{"):
+                job = json.loads(line)
+            else:
+                job = {"program": line}
+
+            job["program"] = os.path.join(base, job["program"])
+            job.setdefault("max_cycles", max_cycles)
+            job.setdefault("timeout", timeout)
+            jobs.append(job)
+
+    return jobs
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run many LS-8 programs on a process pool.")
+    parser.add_argument("source", help="directory of .ls8 files or manifest")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: CPU count)")
+    parser.add_argument("--max-cycles", type=int, default=MAX_CYCLES,
+                        help=f"per-job instruction budget "
+                             f"(default: {MAX_CYCLES})")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="per-job wall-clock limit in seconds")
+    args = parser.parse_args(argv[1:])
+
+    jobs = read_jobs(args.source, args.max_cycles, args.timeout)
+    failures = 0
+
+    with ProcessPoolExecutor(max_workers=args.jobs,
+                             initializer=init_worker) as pool:
+        futures = [pool.submit(run_job, job) for job in jobs]
+
+        for future in as_completed(futures):
+            result = future.result()
+            if result["status"] in ("error", "fault", "stack_overflow"):
+                failures += 1
+            print(json.dumps(result), flush=True)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite for the LS-8 emulator.
+
+Usage: benchmark.py [program ...] [-e ENGINE] [--min-time SECONDS]
+                    [--json FILE] [--baseline FILE] [--threshold PERCENT]
+
+By default it runs every halting program in ../asm plus the synthetic
+workloads in ../asm/bench (tight arithmetic loops, deep recursion,
+stack-heavy and branch-heavy code) on every engine (see ENGINES in
+jit.py). .asm sources are assembled in-process.
+
+For each program and engine it reports:
+
+    instructions    executed by one run
+    ips             instructions per second, over repeated runs lasting
+                    at least --min-time
+    load_ms         time to load (and for .asm, assemble) the program
+    memory_bytes    Python heap held by one machine after a run,
+                    including its translation cache or compiled code
+
+--json writes the results as JSON ("-" for stdout). --baseline compares
+against a JSON file from an earlier --json run and exits with status 1
+if any program/engine pair got more than --threshold percent slower.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from cpu import CPU, RUN_BUDGET
+from devices import CaptureOutput
+from jit import ENGINES
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ASM_DIR = os.path.join(HERE, os.pardir, "asm")
+
+DEFAULT_PROGRAMS = (
+    sorted(glob.glob(os.path.join(ASM_DIR, "*.asm")))
+    + sorted(glob.glob(os.path.join(ASM_DIR, "bench", "*.asm")))
+)
+
+# Programs still running after this many instructions are skipped
+PROBE_CYCLES = 5000000
+
+# Default minimum measuring time per program and engine, in seconds
+MIN_TIME = 0.5
+
+# Default slowdown, in percent, reported as a regression
+THRESHOLD = 10.0
+
+# Loads timed for load_ms
+LOADS = 20
+
+
+def load_machine(file_name):
+    """
+    Return a CPU with `file_name` loaded and output captured.
+    """
+    cpu = CPU()
+    cpu.output = CaptureOutput()
+    cpu.load(file_name)
+    return cpu
+
+
+def probe(file_name):
+    """
+    Run a program once on the interpreter with a budget and return its
+    RunResult, so programs that never halt can be left out.
+    """
+    cpu = load_machine(file_name)
+    return cpu.run(max_cycles=PROBE_CYCLES)
+
+
+def load_time(file_name):
+    """
+    Return the mean time to load `file_name`, in milliseconds.
+    """
+    cpu = load_machine(file_name)
+
+    start = time.perf_counter()
+    for _ in range(LOADS):
+        cpu.load(file_name)
+    return (time.perf_counter() - start) * 1000 / LOADS
+
+
+def machine_memory(file_name, engine):
+    """
+    Return the bytes of Python heap one machine holds after loading and
+    running `file_name` on `engine`.
+    """
+    tracemalloc.start()
+    try:
+        cpu = load_machine(file_name)
+        ENGINES[engine](cpu)()
+        cpu.output.clear()
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def bench(file_name, engine, min_time=MIN_TIME):
+    """
+    Run one program on one engine repeatedly for at least `min_time`
+    seconds and return (runs, seconds).
+    """
+    cpu = load_machine(file_name)
+
+    # Every run restarts from the loaded state; restore() keeps the
+    # translation cache, so the block engines are measured warm
+    image = cpu.snapshot()
+    output = cpu.output
+    run = ENGINES[engine](cpu)
+
+    runs = 0
+    elapsed = 0.0
+
+    while elapsed < min_time:
+        cpu.restore(image)
+        output.clear()
+
+        start = time.perf_counter()
+        run()
+        elapsed += time.perf_counter() - start
+        runs += 1
+
+    return runs, elapsed
+
+
+def run_suite(programs, engines, min_time=MIN_TIME, log=sys.stdout):
+    """
+    Benchmark every program on every engine and return the results as a
+    list of dicts. Progress is written to `log` as it goes.
+    """
+    results = []
+
+    for file_name in programs:
+        # Relative to this directory, so baselines match from any cwd
+        name = os.path.relpath(file_name, HERE)
+        outcome = probe(file_name)
+
+        if outcome.status == RUN_BUDGET:
+            print(f"{name}: skipped, still running after {PROBE_CYCLES} "
+                  f"instructions", file=log)
+            continue
+
+        load_ms = load_time(file_name)
+
+        for engine in engines:
+            runs, seconds = bench(file_name, engine, min_time)
+            result = {
+                "program": name,
+                "engine": engine,
+                "status": outcome.status,
+                "instructions": outcome.cycles,
+                "runs": runs,
+                "seconds": seconds,
+                "ips": outcome.cycles * runs / seconds,
+                "load_ms": load_ms,
+                "memory_bytes": machine_memory(file_name, engine),
+            }
+            results.append(result)
+
+            print(f"{name} [{engine}]: {runs} runs of {outcome.cycles} "
+                  f"instructions in {seconds:.3f}s ({result['ips']:,.0f} "
+                  f"inst/s), load {load_ms:.3f}ms, "
+                  f"{result['memory_bytes']:,} bytes", file=log)
+
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD, log=sys.stdout):
+    """
+    Compare results with a baseline's and return the number of
+    regressions: program/engine pairs more than `threshold` percent
+    slower.
+    """
+    before = {(r["program"], r["engine"]): r for r in baseline["results"]}
+    regressions = 0
+
+    for result in results:
+        old = before.get((result["program"], result["engine"]))
+        if old is None:
+            continue
+
+        change = 100 * (result["ips"] / old["ips"] - 1)
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+
+        print(f"{result['program']} [{result['engine']}]: "
+              f"{old['ips']:,.0f} -> {result['ips']:,.0f} inst/s "
+              f"({change:+.1f}%){flag}", file=log)
+
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the LS-8 emulator.")
+    parser.add_argument("programs", nargs="*", default=DEFAULT_PROGRAMS,
+                        help="programs to run (default: ../asm and "
+                             "../asm/bench)")
+    parser.add_argument("-e", "--engine", action="append", choices=ENGINES,
+                        help="engine to measure; repeatable (default: all)")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME,
+                        help=f"seconds to spend per program and engine "
+                             f"(default: {MIN_TIME})")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results as JSON to FILE "
+                             "(- for stdout)")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare against results saved with --json")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help=f"slowdown in percent that counts as a "
+                             f"regression (default: {THRESHOLD})")
+    args = parser.parse_args(argv[1:])
+
+    # Keep stdout clean for JSON
+    log = sys.stderr if args.json == "-" else sys.stdout
+
+    results = run_suite(args.programs, args.engine or list(ENGINES),
+                        args.min_time, log)
+
+    if args.json:
+        report = {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=1)
+            print()
+        else:
+            with open(args.json, "w") as file:
+                json.dump(report, file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        print(file=log)
+        if compare(results, baseline, args.threshold, log):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
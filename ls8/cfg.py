@@ -0,0 +1,756 @@
+#!/usr/bin/env python3
+
+"""
+Static control-flow analysis for LS-8 programs.
+
+Analysis decodes a program from address 0, and from every interrupt
+handler it installs, without running it. LDI constants are propagated
+through the registers, so `LDI Rx,Label` followed by `CALL Rx` or
+`JMP Rx` resolves to a real edge. Calls are analysed as subroutines:
+each one's stack use and the registers it writes are summarised once
+and applied at every call site. The result is a graph of basic blocks
+and a report of:
+
+    the worst-case stack depth below the 0xF4 stack top, counting
+    nested calls and one interrupt frame, and whether it can reach
+    the program
+    loops (back edges) and recursive subroutines
+    unreachable code
+    DS/DB data bytes that can be executed as code
+    paths that run off the end of the program
+    jumps and calls whose target couldn't be worked out
+
+Stores through a register whose value isn't known are assumed not to
+land in the program; ones that provably do are reported.
+
+Programs assembled from source (analyze_assembly(), or an .asm file)
+carry the assembler's record of which bytes are data; for loaded RAM
+images (analyze_cpu()) anything not reached is reported as unreachable.
+
+block_starts() lists the addresses a block run can start a block at;
+CPU.prebuild() decodes them into the translation cache ahead of time.
+
+Usage: cfg.py <program> [--blocks]
+
+Prints the report (and with --blocks the basic blocks) and exits with
+status 1 if it found a problem.
+"""
+
+import argparse
+import sys
+
+from cpu import (
+    ALU, ASM_DIR, CALL, CPU, HLT, INT, IRET, JMP, JNE, JUMP_IF, LD, LDI,
+    OPCODE_NAMES, POP, PUSH, RET, ST, Fault,
+)
+
+SP = 7
+
+# Where the stack pointer starts
+STACK_TOP = 0xF4
+
+# Bytes interrupt entry pushes: the PC, FL and R0-R6
+INTERRUPT_FRAME = 9
+
+# First interrupt vector; I0-I7 are at 0xF8-0xFF
+VECTORS = 0xF8
+
+# Times a merge point may see the stack grow before the stack is
+# assumed to grow without bound (a push in a loop)
+DEPTH_RAISES = 8
+
+# Most passes over the program before giving up on the summaries
+# settling
+PASSES = 8
+
+# Register state with nothing known
+UNKNOWN = (None,) * 8
+
+# Every register, for calls that may write anything
+ALL_REGISTERS = frozenset(range(8))
+
+# Opcodes the CPU executes
+VALID = frozenset(OPCODE_NAMES)
+
+
+class Function:
+    """
+    A subroutine, interrupt handler or the main program, as found by
+    the analysis.
+    """
+    def __init__(self, entry, kind):
+        self.entry = entry
+        # "main", "subroutine" or "handler"
+        self.kind = kind
+        # Addresses of the instructions it runs itself
+        self.instructions = set()
+        # Most bytes it has on the stack at once, including the return
+        # address and frames of anything it calls (but not its own
+        # return address, which its caller counts)
+        self.depth = 0
+        # Registers it (or anything it calls) may write
+        self.writes = set()
+        # Entry addresses of subroutines it calls
+        self.calls = set()
+        # Set if its stack use has no bound (recursion or a push in a
+        # loop)
+        self.unbounded = False
+        self.recursive = False
+        # Register values known on entry, over every call seen so far
+        self.entry_regs = None
+        # Set while its body is being analysed
+        self.active = False
+        # Set once it has been analysed in the current pass
+        self.visited = False
+
+    def summary(self):
+        """
+        Return what callers and the report use, to tell when another
+        pass has stopped changing anything.
+        """
+        return (self.entry_regs, self.depth, frozenset(self.writes),
+                frozenset(self.calls), self.unbounded, self.recursive)
+
+
+class Block:
+    """
+    A basic block of the control-flow graph.
+    """
+    def __init__(self, start):
+        self.start = start
+        # (pc, opcode, oper1, oper2) for every instruction
+        self.instructions = []
+        # Start addresses of the blocks control can pass to next; for a
+        # CALL, the return address
+        self.successors = []
+        # Subroutine entries called from the block
+        self.calls = []
+
+
+class Analysis:
+    """
+    Control-flow graph and static checks for one program.
+    """
+    def __init__(self, ram, length, data=(), symbols=None, code=None):
+        """
+        Analyse the program in `ram` (up to 256 bytes), which ends at
+        address `length`. `data` holds the addresses of DS/DB bytes and
+        `code` the start addresses of the instructions the assembler
+        emitted, where known.
+        """
+        self.ram = bytes(ram).ljust(256, b"\0")
+        self.length = length
+        self.data = frozenset(data)
+        self.code = frozenset(code) if code is not None else None
+        self.symbols = symbols or {}
+
+        # entry -> Function; the summaries carry over between passes
+        self.functions = {}
+
+        # A call site's view of a subroutine depends on what the
+        # subroutine was last known to do, so repeat the whole analysis
+        # until no summary changes
+        for _ in range(PASSES):
+            before = {entry: func.summary()
+                      for entry, func in self.functions.items()}
+            self.analyze()
+            if before == {entry: func.summary()
+                          for entry, func in self.functions.items()}:
+                break
+
+        self.blocks = self.build_blocks()
+        self.loops = self.find_loops()
+
+    def analyze(self):
+        """
+        One pass over the program from address 0 and every interrupt
+        handler found.
+        """
+        # pc -> (opcode, oper1, oper2) of every reachable instruction
+        self.instructions = {}
+        # pc -> addresses control can pass to next, within a function
+        self.edges = {}
+        # pc of a resolved CALL -> subroutine entry
+        self.call_targets = {}
+        # Interrupt handler entries installed with ST
+        self.handlers = set()
+
+        for func in self.functions.values():
+            func.visited = False
+
+        # Findings, each a sorted list or dict by address in the end
+        self.unresolved = {}        # pc -> instruction text
+        self.invalid = set()        # pcs of opcodes the CPU lacks
+        self.off_end = set()        # pcs at or past the program's end
+        self.data_executed = set()  # data addresses run as code
+        self.code_stores = {}       # pc -> code address it stores to
+        self.bad_returns = {}       # pc -> bytes left on the stack
+        self.sp_writes = set()      # pcs writing SP directly
+        self.underflows = set()     # POPs below the function's entry SP
+        self.unbalanced = set()     # merge points reached at two depths
+
+        # Power-on registers are zero, apart from SP
+        self.main = self.function(0, "main", (0,) * 7 + (None,))
+
+        # Handlers may install further handlers
+        done = set()
+        while self.handlers - done:
+            entry = min(self.handlers - done)
+            done.add(entry)
+            self.function(entry, "handler")
+
+    def label(self, address):
+        """
+        Return `address` as "LABEL", "LABEL+offset" or a hex address.
+        """
+        best = None
+        for name, value in self.symbols.items():
+            if value <= address and (best is None or value > best[1]):
+                best = (name, value)
+
+        if best is None:
+            return f"{address:02X}"
+        if best[1] == address:
+            return best[0]
+        return f"{best[0]}+{address - best[1]}"
+
+    def text(self, pc):
+        """
+        Return the instruction at `pc` as assembler text.
+        """
+        ram = self.ram
+        execute_cmd = ram[pc]
+        name = OPCODE_NAMES.get(execute_cmd, f"{execute_cmd:08b}")
+        oper1 = ram[(pc + 1) & 0xFF]
+        oper2 = ram[(pc + 2) & 0xFF]
+
+        if execute_cmd == LDI:
+            return f"{name} R{oper1},{oper2}"
+        if execute_cmd >> 6 == 2:
+            return f"{name} R{oper1},R{oper2}"
+        if execute_cmd >> 6 == 1:
+            return f"{name} R{oper1}"
+        return name
+
+    def function(self, entry, kind, regs=UNKNOWN):
+        """
+        Analyse the function starting at `entry` (once) and return it.
+        `regs` are the register values known on entry.
+        """
+        func = self.functions.get(entry)
+        if func is None:
+            func = self.functions[entry] = Function(entry, kind)
+        if func.active:
+            return func
+
+        if func.entry_regs is not None:
+            regs = tuple(a if a == b else None
+                         for a, b in zip(func.entry_regs, regs))
+        if func.visited and regs == func.entry_regs:
+            return func
+
+        func.entry_regs = regs
+        func.visited = True
+        func.active = True
+
+        # pc -> (register values, stack depth) on arrival
+        states = {entry: (regs, 0)}
+        raises = {}
+        work = [entry]
+
+        while work:
+            pc = work.pop()
+            regs, depth = states[pc]
+
+            for next_pc, next_regs, next_depth in self.step(func, pc, regs,
+                                                            depth):
+                old = states.get(next_pc)
+                if old is None:
+                    states[next_pc] = (next_regs, next_depth)
+                    work.append(next_pc)
+                    continue
+
+                merged = tuple(a if a == b else None
+                               for a, b in zip(old[0], next_regs))
+                merged_depth = old[1]
+
+                if next_depth != old[1]:
+                    self.unbalanced.add(next_pc)
+                    if next_depth > old[1]:
+                        raises[next_pc] = raises.get(next_pc, 0) + 1
+                        if raises[next_pc] > DEPTH_RAISES:
+                            func.unbounded = True
+                        else:
+                            merged_depth = next_depth
+
+                if (merged, merged_depth) != old:
+                    states[next_pc] = (merged, merged_depth)
+                    work.append(next_pc)
+
+        func.active = False
+        return func
+
+    def step(self, func, pc, regs, depth):
+        """
+        Record the instruction at `pc` and return the (pc, registers,
+        depth) states it can pass control to.
+        """
+        ram = self.ram
+        execute_cmd = ram[pc]
+        size = (execute_cmd >> 6) + 1
+        next_pc = pc + size
+
+        func.instructions.add(pc)
+        func.depth = max(func.depth, depth)
+
+        if pc >= self.length:
+            self.off_end.add(pc)
+            return []
+        if next_pc > len(ram):
+            # The operands would be fetched past the end of RAM
+            self.off_end.add(pc)
+            return []
+
+        oper1 = ram[pc + 1] if size > 1 else 0
+        oper2 = ram[pc + 2] if size > 2 else 0
+        self.instructions[pc] = (execute_cmd, oper1, oper2)
+
+        self.data_executed.update(address for address in range(pc, next_pc)
+                                  if address in self.data)
+
+        # Unknown opcodes and register numbers past R7 fault
+        if (execute_cmd not in VALID or (size > 1 and oper1 > 7)
+                or (size > 2 and execute_cmd != LDI and oper2 > 7)):
+            self.invalid.add(pc)
+            return []
+
+        regs = list(regs)
+        successors = []
+        self.edges[pc] = successors
+
+        def go(target, new_depth=depth):
+            successors.append(target)
+            return (target, tuple(regs), new_depth)
+
+        def write(r, value):
+            regs[r] = value
+            func.writes.add(r)
+            if r == SP:
+                # Depths from here on are relative to the wrong top
+                self.sp_writes.add(pc)
+
+        if execute_cmd in ALU:
+            a = regs[oper1]
+            b = regs[oper2] if size == 3 else 0
+            value = None
+            if a is not None and b is not None:
+                try:
+                    value = ALU[execute_cmd](a, b)
+                except Fault:
+                    pass
+            write(oper1, value)
+
+        elif execute_cmd == LDI:
+            write(oper1, oper2)
+
+        elif execute_cmd == LD:
+            write(oper1, None)
+
+        elif execute_cmd == ST:
+            address = regs[oper1]
+            if address is not None:
+                if address >= VECTORS and regs[oper2] is not None:
+                    self.handlers.add(regs[oper2])
+                elif address < self.length and address not in self.data:
+                    self.code_stores[pc] = address
+
+        elif execute_cmd == PUSH:
+            return [go(next_pc, depth + 1)]
+
+        elif execute_cmd == POP:
+            write(oper1, None)
+            if depth == 0:
+                self.underflows.add(pc)
+            return [go(next_pc, depth - 1)]
+
+        elif execute_cmd == HLT:
+            return []
+
+        elif execute_cmd in (RET, IRET):
+            if execute_cmd == RET and (depth != 0 or func.kind != "subroutine"):
+                self.bad_returns[pc] = depth
+            return []
+
+        elif execute_cmd == CALL:
+            target = regs[oper1]
+            if target is None:
+                self.unresolved[pc] = self.text(pc)
+                func.unbounded = True
+                writes = ALL_REGISTERS
+            else:
+                callee = self.function(target, "subroutine", tuple(regs))
+                func.calls.add(target)
+                self.call_targets[pc] = target
+                if callee.active:
+                    # Still being analysed further up: recursion. What
+                    # it writes so far is refined by later passes.
+                    callee.recursive = True
+                    func.unbounded = True
+                    writes = set(callee.writes)
+                else:
+                    func.depth = max(func.depth, depth + 1 + callee.depth)
+                    func.unbounded |= callee.unbounded
+                    writes = callee.writes
+            func.writes |= writes
+            for r in writes:
+                regs[r] = None
+            return [go(next_pc)]
+
+        elif execute_cmd == INT:
+            # The handler restores R0-R6 before IRET
+            self.unresolved[pc] = self.text(pc)
+
+        elif execute_cmd == JMP or execute_cmd in JUMP_IF or execute_cmd == JNE:
+            target = regs[oper1]
+            states = []
+            if target is None:
+                self.unresolved[pc] = self.text(pc)
+            else:
+                states.append(go(target))
+            if execute_cmd != JMP:
+                states.append(go(next_pc))
+            return states
+
+        return [go(next_pc)]
+
+    def build_blocks(self):
+        """
+        Split the reachable instructions into basic blocks and return
+        them as a dict keyed by start address.
+        """
+        predecessors = {}
+        for pc, successors in self.edges.items():
+            for target in successors:
+                predecessors.setdefault(target, []).append(pc)
+
+        def falls_through(pc):
+            # Control only ever passes straight on to the next
+            # instruction
+            execute_cmd = self.instructions[pc][0]
+            return (self.edges.get(pc) == [pc + (execute_cmd >> 6) + 1]
+                    and not execute_cmd & 0b00010000)
+
+        leaders = set(self.functions)
+        for pc in self.instructions:
+            preds = predecessors.get(pc, [])
+            if len(preds) != 1 or not falls_through(preds[0]):
+                leaders.add(pc)
+
+        blocks = {}
+        for start in sorted(leaders):
+            if start not in self.instructions:
+                continue
+            block = Block(start)
+            pc = start
+
+            while True:
+                execute_cmd, oper1, oper2 = self.instructions[pc]
+                block.instructions.append((pc, execute_cmd, oper1, oper2))
+                if pc in self.call_targets:
+                    block.calls.append(self.call_targets[pc])
+
+                successors = self.edges.get(pc, [])
+                next_pc = pc + (execute_cmd >> 6) + 1
+                if (not falls_through(pc) or next_pc in leaders
+                        or next_pc not in self.instructions):
+                    block.successors = [target for target in successors
+                                        if target in self.instructions]
+                    break
+                pc = next_pc
+
+            blocks[start] = block
+
+        return blocks
+
+    def find_loops(self):
+        """
+        Return (from, header) block start pairs for every back edge,
+        found by depth-first search from each function entry.
+        """
+        loops = set()
+        done = set()
+
+        for entry in sorted(self.functions):
+            if entry not in self.blocks or entry in done:
+                continue
+
+            # Blocks on the current path, and an iterator per block
+            on_path = {entry}
+            stack = [(entry, iter(self.blocks[entry].successors))]
+            done.add(entry)
+
+            while stack:
+                start, successors = stack[-1]
+                for target in successors:
+                    if target in on_path:
+                        loops.add((start, target))
+                    elif target not in done and target in self.blocks:
+                        done.add(target)
+                        on_path.add(target)
+                        stack.append((target,
+                                      iter(self.blocks[target].successors)))
+                        break
+                else:
+                    stack.pop()
+                    on_path.discard(start)
+
+        return sorted(loops)
+
+    def stack_depth(self):
+        """
+        Return the most bytes the stack can hold at once: the main
+        program's worst case plus, if it installs interrupt handlers,
+        one interrupt frame and the deepest handler. None if there is
+        no bound.
+        """
+        funcs = [self.main] + [self.functions[entry]
+                               for entry in self.handlers
+                               if entry in self.functions]
+        if any(func.unbounded for func in funcs):
+            return None
+
+        depth = self.main.depth
+        if len(funcs) > 1:
+            depth += INTERRUPT_FRAME + max(func.depth for func in funcs[1:])
+        return depth
+
+    def unreachable(self):
+        """
+        Return the addresses of the bytes of instructions (or, without
+        the assembler's record of them, of any bytes) before the end of
+        the program that are never reached.
+        """
+        def size(pc):
+            return (self.ram[pc] >> 6) + 1
+
+        if self.code is not None:
+            return sorted(address for pc in self.code - set(self.instructions)
+                          for address in range(pc, pc + size(pc)))
+
+        covered = set()
+        for pc in self.instructions:
+            covered.update(range(pc, pc + size(pc)))
+        return sorted(set(range(self.length)) - covered - self.data)
+
+    def block_starts(self):
+        """
+        Return the addresses a block run can start a block at: every
+        basic block, plus the instruction after each PUSH and ST, which
+        end the CPU's blocks (see CPU.block_end) without ending a basic
+        block.
+        """
+        starts = set(self.blocks)
+        for pc, (execute_cmd, _, _) in self.instructions.items():
+            next_pc = pc + (execute_cmd >> 6) + 1
+            if execute_cmd in (PUSH, ST) and next_pc in self.instructions:
+                starts.add(next_pc)
+        return sorted(starts)
+
+    def problems(self):
+        """
+        Return a list of text lines, one per problem found.
+        """
+        lines = []
+
+        def at(pc):
+            return f"{pc:02X} ({self.label(pc)})"
+
+        depth = self.stack_depth()
+        if depth is None:
+            lines.append("stack depth has no static bound")
+        elif STACK_TOP - depth < self.length:
+            lines.append(f"stack can grow to {STACK_TOP - depth:02X}, into "
+                         f"the program (which ends at {self.length:02X})")
+
+        for pc in sorted(self.data_executed):
+            lines.append(f"data byte at {at(pc)} can be executed")
+        for pc in sorted(self.off_end):
+            lines.append(f"execution can run off the end of the program "
+                         f"at {at(pc)}")
+        for pc in sorted(self.invalid):
+            lines.append(f"invalid instruction at {at(pc)}: {self.text(pc)}")
+        for pc, text in sorted(self.unresolved.items()):
+            lines.append(f"unresolved target at {at(pc)}: {text}")
+        for pc, depth in sorted(self.bad_returns.items()):
+            if depth > 0:
+                lines.append(f"RET at {at(pc)} leaves {depth} pushed "
+                             f"byte(s) on the stack")
+            elif depth < 0:
+                lines.append(f"RET at {at(pc)} after popping {-depth} "
+                             f"byte(s) past its return address")
+            else:
+                lines.append(f"RET at {at(pc)} outside a subroutine")
+        for pc in sorted(self.underflows):
+            lines.append(f"POP at {at(pc)} pops more than was pushed")
+        for pc, address in sorted(self.code_stores.items()):
+            lines.append(f"ST at {at(pc)} writes into the program at "
+                         f"{at(address)}")
+        for pc in sorted(self.sp_writes):
+            lines.append(f"SP written directly at {at(pc)}; stack depths "
+                         f"after it are unreliable")
+        for pc in sorted(self.unbalanced & set(self.blocks)):
+            lines.append(f"stack depth differs between paths into {at(pc)}")
+
+        return lines
+
+    def report(self, blocks=False):
+        """
+        Return the analysis as text; with `blocks`, list the basic
+        blocks too.
+        """
+        lines = [f"{len(self.instructions)} instructions reachable in "
+                 f"{len(self.blocks)} blocks, {self.length} bytes of program"]
+
+        depth = self.stack_depth()
+        if depth is None:
+            lines.append("Stack depth: unbounded")
+        else:
+            lines.append(f"Stack depth: {depth} bytes, down to "
+                         f"{STACK_TOP - depth:02X}")
+
+        lines.append("")
+        lines.append("Functions:")
+        for entry, func in sorted(self.functions.items()):
+            notes = [func.kind]
+            if func.recursive:
+                notes.append("recursive")
+            if func.unbounded:
+                notes.append("unbounded stack")
+            calls = ", ".join(self.label(target)
+                              for target in sorted(func.calls))
+            lines.append(f"  {entry:02X} {self.label(entry):<20} "
+                         f"depth {func.depth:>3}  ({', '.join(notes)})"
+                         + (f" calls {calls}" if calls else ""))
+
+        lines.append("")
+        lines.append("Loops:")
+        for start, header in self.loops:
+            lines.append(f"  {self.label(header)} (back edge from "
+                         f"{self.label(start)})")
+        if not self.loops:
+            lines.append("  none")
+
+        unreachable = self.unreachable()
+        lines.append("")
+        lines.append("Unreachable:")
+        for first, last in ranges(unreachable):
+            lines.append(f"  {first:02X}-{last:02X} ({self.label(first)})")
+        if not unreachable:
+            lines.append("  none")
+
+        problems = self.problems()
+        lines.append("")
+        lines.append("Problems:")
+        lines += [f"  {line}" for line in problems]
+        if not problems:
+            lines.append("  none")
+
+        if blocks:
+            lines.append("")
+            lines.append("Blocks:")
+            for start, block in sorted(self.blocks.items()):
+                successors = " ".join(f"{target:02X}"
+                                      for target in block.successors)
+                lines.append(f"  {self.label(start)}: -> "
+                             f"{successors or '(end)'}")
+                for pc, _, _, _ in block.instructions:
+                    lines.append(f"    {pc:02X}: {self.text(pc)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def ranges(addresses):
+    """
+    Group sorted addresses into (first, last) runs.
+    """
+    runs = []
+    for address in addresses:
+        if runs and runs[-1][1] == address - 1:
+            runs[-1][1] = address
+        else:
+            runs.append([address, address])
+    return [tuple(run) for run in runs]
+
+
+def analyze_assembly(code, sym):
+    """
+    Analyse a program from the assembler's pass 1 output: the `code`
+    list and `sym` table filled in by asm.pass1().
+    """
+    if ASM_DIR not in sys.path:
+        sys.path.append(ASM_DIR)
+    from asm import decode_items, resolve
+
+    data = set()
+    instructions = set()
+    address = 0
+    for item in decode_items(code):
+        if item[0] == "op":
+            instructions.add(address)
+        elif item[0] == "data":
+            data.add(address)
+        else:
+            continue
+        address += len(item[-2])
+
+    ram = resolve(sym, code)
+    return Analysis(ram, len(ram), data, sym, instructions)
+
+
+def analyze_cpu(cpu):
+    """
+    Analyse the program loaded in `cpu`.
+    """
+    return Analysis(cpu.ram, cpu.program_end, symbols=cpu.symbols)
+
+
+def analyze_file(file_name):
+    """
+    Analyse an .asm source or a program file the CPU can load.
+    """
+    if not file_name.endswith(".asm"):
+        cpu = CPU()
+        cpu.load(file_name)
+        return analyze_cpu(cpu)
+
+    if ASM_DIR not in sys.path:
+        sys.path.append(ASM_DIR)
+    from asm import pass1
+
+    sym = {}
+    code = []
+    with open(file_name) as file:
+        pass1(file, sym, code)
+    return analyze_assembly(code, sym)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Analyse an LS-8 program's control flow.")
+    parser.add_argument("program", help="program (.asm, .ls8 or .ls8b)")
+    parser.add_argument("--blocks", action="store_true",
+                        help="list the basic blocks too")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        analysis = analyze_file(args.program)
+    except (OSError, ValueError) as e:
+        print(f"{args.program}: {e}", file=sys.stderr)
+        return 1
+
+    sys.stdout.write(analysis.report(args.blocks))
+    return 1 if analysis.problems() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -2,22 +2,259 @@
 CPU functionality.
 """
 
+import collections
+import copy
+import mmap
+import os
+import re
+import struct
 import sys
+import threading
+import time
+import zlib
+from functools import partial
+
+from devices import ConsoleOutput
+
+# Layout of a machine state snapshot: RAM, registers (so IM and IS
+# too), PC, FL, the running and interrupts-enabled flags, the stack
+# limit and the end of the program, one byte each, then the cycle count
+# as a little-endian u64
+STATE_RAM = slice(0, 256)
+STATE_REG = slice(256, 264)
+STATE_PC = 264
+STATE_FL = 265
+STATE_RUNNING = 266
+STATE_IE = 267
+STATE_STACK_LIMIT = 268
+STATE_PROGRAM_END = 269
+STATE_CYCLES = slice(270, 278)
+STATE_SIZE = 278
+
+# File signature for snapshots saved with save_snapshot()
+SNAPSHOT_MAGIC = b"LS8S"
+
+# Binary program image (.ls8b), as written by asm.py:
+#
+#   magic "LS8B", version, load address, flags, reserved,
+#   code length (u16), symbol count (u16), CRC-32 of the code (u32),
+#   all little-endian; then the code bytes, then the symbol table as
+#   (address, name length, name) entries.
+IMAGE_MAGIC = b"LS8B"
+IMAGE_HEADER = struct.Struct("<4sBBBBHHI")
+IMAGE_HAS_SYMBOLS = 0b01
+IMAGE_HAS_CHECKSUM = 0b10
+
+# Outcome of a run: `status` is one of the RUN_* values, `cycles` the
+# instructions counted during the run and `reason` a description of a
+# fault or of which budget ran out
+RunResult = collections.namedtuple("RunResult", "status cycles reason")
+
+RUN_HALTED = "halted"
+RUN_BUDGET = "budget"
+RUN_FAULT = "fault"
+RUN_STACK_OVERFLOW = "stack_overflow"
+# Stopped from outside (running cleared) without halting
+RUN_STOPPED = "stopped"
+
+
+class Fault(Exception):
+    """
+    Raised when a program does something the machine can't execute.
+    """
+
+
+class StackOverflow(Fault):
+    """
+    Raised when a push would grow the stack into the loaded program.
+    """
+
+
+# Where asm.py lives, for loading .asm sources directly
+ASM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, "asm")
+
+# Label comments asm.py writes into .ls8 text, e.g. "# LOOP (address 9):"
+LABEL_COMMENT = re.compile(r"#\s*(\w+) \(address (\d+)\):")
+
+# Start of a BANK section in .ls8 text, e.g. "# BANK 3:"
+BANK_COMMENT = re.compile(r"#\s*BANK (\d+):")
+
+# Bank-switched memory (see map_banks()); the window must match asm.py.
+# The bank number is little-endian in RAM at the bank register and the
+# byte after it
+BANK_WINDOW = 0x80
+BANK_SIZE = 0x40
+BANK_REGISTER = 0xF5
+# Default bank store: 1024 banks of BANK_SIZE bytes, 64 KB
+BANK_STORE_SIZE = 0x10000
+
+# Opcodes
+# Loads registerA with the value at
+# the memory address stored in registerB.
+LD = 0b10000011        # LD RegA, regB
+# Set the value of a register to an integer.
+LDI = 0b10000010       # LDI regA, integer
+# Store value in registerB in the address
+# stored in registerA.
+ST = 0b10000100        # ST regA, regB
+PRN = 0b01000111       # PRN regA
+PRA = 0b01001000       # PRA regA
+# Halt the CPU (and exit the emulator).
+HLT = 0b00000001       # HLT
+# Add the value in two registers
+# and store the result in registerA
+ADD = 0b10100000       # ADD regA, regB
+MUL = 0b10100010       # MUL regA, regB
+SUB = 0b10100001       # SUB regA, regB
+# Decrement (subtract 1 from)
+# the value in the given register.
+DEC = 0b01100110       # DEC regA
+# Increment (add 1 to)
+# the value in the given register.
+INC = 0b01100101       # INC regA
+# divide the value in the first register
+# by the value in the second register,
+# storing the result in the first register
+DIV = 0b10100011       # DIV regA, regB
+PUSH = 0b01000101      # PUSH regA
+POP = 0b01000110       # POP regA
+SHL = 0b10101100       # SHL regA, regB
+# Calls a subroutine (function)
+# at the address stored in the register.
+CALL = 0b01010000      # CALL regA
+RET = 0b00010001       # RET
+# Compare the values in two registers.
+CMP = 0b10100111       # CMP regA, regB
+# Divide the value in the first register
+# by the value in the second, storing
+# the remainder of the result in registerA.
+MOD = 0b10100100       # MOD regA, regB
+#ADDI = 0b      # ADDI regA, regB
+# Bitwise-AND the values in registerA
+# and registerB, then store the result in registerA.
+AND = 0b10101000       # AND regA, regB
+NOT = 0b01101001       # NOT regA
+OR  = 0b10101010       # OR regA, regB
+XOR = 0b10101011       # XOR regA, regB
+SHR = 0b10101101       # SHR regA, regB
+# Jump to the address stored
+# in the given register.
+JMP = 0b01010100       # JMP regA
+# If equal flag is set (true),
+# jump to the address stored in the given register.
+JEQ = 0b01010101       # JEQ regA
+# If greater-than flag or equal flag
+# is set (true), jump to the address
+# stored in the given register.
+JGE = 0b01011010       # JGE regA
+# If greater-than flag is set (true),
+# jump to the address stored in the given
+# register.
+JGT = 0b01010111       # JGT regA
+# If less-than flag is set (true),
+# jump to the address stored in the given
+# register.
+JLT = 0b01011000       # JLT regA
+# If less-than flag or equal flag
+# is set (true), jump to the address
+# stored in the given register.
+JLE = 0b01011001       # JLE regA
+# If E flag is clear (false, 0),
+# jump to the address stored in the given
+# register.
+JNE = 0b01010110       # JNE regA
+# Issue the interrupt number stored
+# in the given register.
+INT = 0b01010010       # INT regA
+# Return from an interrupt handler.
+IRET = 0b00010011      # IRET
+# No operation.
+NOP = 0b00000000       # NOP
+
+# Opcode -> mnemonic
+OPCODE_NAMES = {globals()[name]: name for name in (
+    "LD", "LDI", "ST", "PRN", "PRA", "HLT", "ADD", "MUL", "SUB", "DEC",
+    "INC", "DIV", "PUSH", "POP", "SHL", "CALL", "RET", "CMP", "MOD", "AND",
+    "NOT", "OR", "XOR", "SHR", "JMP", "JEQ", "JGE", "JGT", "JLT", "JLE",
+    "JNE", "INT", "IRET", "NOP",
+)}
+
+# Flags, `00000LGE`
+FL_L = 0b100
+FL_G = 0b010
+FL_E = 0b001
+
+
+def divide(a, b):
+    if b == 0:
+        raise Fault("division by zero")
+    return a // b
+
+
+def modulo(a, b):
+    if b == 0:
+        raise Fault("division by zero")
+    return a % b
+
+
+# ALU operations: opcode -> function(a, b) of the operand registers'
+# values, returning the 8-bit result for register A. One-operand
+# instructions get b = 0. None of them touch FL; only CMP does.
+ALU = {
+    ADD: lambda a, b: (a + b) & 0xFF,
+    SUB: lambda a, b: (a - b) & 0xFF,
+    MUL: lambda a, b: (a * b) & 0xFF,
+    DIV: divide,
+    MOD: modulo,
+    AND: lambda a, b: a & b,
+    OR: lambda a, b: a | b,
+    XOR: lambda a, b: a ^ b,
+    SHL: lambda a, b: (a << b) & 0xFF,
+    SHR: lambda a, b: a >> b,
+    NOT: lambda a, b: ~a & 0xFF,
+    INC: lambda a, b: (a + 1) & 0xFF,
+    DEC: lambda a, b: (a - 1) & 0xFF,
+}
+
+
+def compare(a, b):
+    """
+    Return the FL value CMP sets for register values `a` and `b`.
+    """
+    return FL_L if a < b else FL_G if a > b else FL_E
+
+
+# Conditional jump -> FL bits that make it jump. JNE, which jumps when
+# E is clear, is handled on its own.
+JUMP_IF = {
+    JEQ: FL_E,
+    JGT: FL_G,
+    JLT: FL_L,
+    JLE: FL_L | FL_E,
+    JGE: FL_G | FL_E,
+}
 
 class CPU:
     """
     Main CPU class.
     """
+    # Maximum number of instructions decoded into one cached block
+    BLOCK_LIMIT = 64
+
+    # Instructions between deadline checks in budgeted runs
+    CHECK_INTERVAL = 4096
+
     def __init__(self):
         """
         Construct a new CPU.
         """
         # Opcodes
         self.op = 0
-        # RAM memory
-        self.ram = [0]*255
+        # RAM memory: the full 8-bit address space
+        self.ram = bytearray(256)
         # Registers
-        self.reg = [0]*8
+        self.reg = bytearray(8)
         self.reg[7] = 0xF4
         # Program Counter
         self.pc = 0
@@ -31,89 +268,228 @@ class CPU:
         self.fl = 0
         # Set Running Loop
         self.running = True
+        # Instructions executed by budgeted runs
+        self.cycles = 0
+        # Cleared while an interrupt handler runs
+        self.interrupts_enabled = True
+        # Set by raise_interrupt() until the run loop services it
+        self.interrupt_pending = False
+        # Held while IS and interrupt_pending change, which other
+        # threads do through raise_interrupt()
+        self.interrupt_lock = threading.Lock()
+        # Set by HLT; unlike `running`, never cleared by an interrupt
+        self.halted = False
+        # (cycle count, time.monotonic() value or None) that handlers
+        # running instructions themselves, like memo.Memoizer's, must
+        # stop at to keep a budgeted run within its budget; set by the
+        # budgeted run loops once per slice, None outside them
+        self.budget = None
         # Stack Pointer
         self.sp = 7
+        # End of the loaded program
+        self.program_end = 0
+        # Pushing below this is a stack overflow: the end of the program,
+        # or of the bank window while banks are mapped
+        self.stack_limit = 0
+        # Label -> address, from a binary image's symbol table
+        self.symbols = {}
+        # Address -> source line, for programs loaded from .asm
+        self.line_map = {}
+        # Translation cache: block start PC -> decoded basic block
+        self.blocks = {}
+        # Nonzero for every RAM address covered by a cached block
+        self.code_map = bytearray(256)
+        # Where PRN and PRA send their output
+        self.output = ConsoleOutput()
+        # Memory-mapped output ports: address -> device (None for
+        # self.output), see map_output()
+        self.ports = {}
+        # Memory-mapped input ports: address -> function returning the
+        # byte LD reads there, see map_input()
+        self.inputs = {}
+        # Bank store, window and register, and the bank in the window;
+        # see map_banks()
+        self.banks = None
+        self.bank_window = BANK_WINDOW
+        self.bank_register = BANK_REGISTER
+        self.bank = 0
+        # Bank number -> bytes, from the loaded program's BANK sections
+        self.bank_data = {}
+        # Opcode -> callable that replaces its handler in the dispatch
+        # table, kept across rebuilds (see memo.Memoizer.install())
+        self.overrides = {}
 
-        # in CPU opcodes
-        # Loads registerA with the value at 
-        # the memory address stored in registerB.
-        self.LD = 0b10000011        # LD RegA, regB
-        # Set the value of a register to an integer.
-        self.LDI = 0b10000010       # LDI regA, integer
-        self.PRN = 0b01000111       # PRN regA
-        self.PRA = 0b01001000       # PRA regA
-        # Halt the CPU (and exit the emulator).
-        self.HLT = 0b00000001       # HLT
-        # Add the value in two registers 
-        # and store the result in registerA
-        self.ADD = 0b10100000       # ADD regA, regB
-        self.MUL = 0b10100010       # MUL regA, regB
-        self.SUB = 0b10100001       # SUB regA, regB
-        # Decrement (subtract 1 from) 
-        # the value in the given register.
-        self.DEC = 0b01100110       # DEC regA
-        # ncrement (add 1 to) 
-        # the value in the given register.
-        self.INC = 0b01100101       # INC regA
-        # divide the value in the first register
-        # by the value in the second register,
-        # storing the result in the first register
-        self.DIV = 0b10100011       # DIV regA, regB     
-        self.PUSH = 0b01000101      # PUSH regA
-        self.POP = 0b01000110       # POP regA
-        self.SHL = 0b10101100       # SHL regA, regB
-        # Calls a subroutine (function) 
-        # at the address stored in the register.
-        self.CALL = 0b01010000      # CALL regA
-        self.RET = 0b00010001       # RET
-        # Compare the values in two registers.
-        self.CMP = 0b10100111       # CMP regA, regB
-        # Divide the value in the first register 
-        # by the value in the second, storing 
-        # the remainder of the result in registerA.
-        self.MOD = 0b10100100       # MOD regA, regB
-        #self.ADDI = 0b      # ADDI regA, regB
-        # Bitwise-AND the values in registerA 
-        # and registerB, then store the result in registerA.
-        self.AND = 0b10101000       # AND regA, regB
-        self.NOT = 0b01101001       # NOT regA
-        self.OR  = 0b10101010       # OR regA, regB
-        self.XOR = 0b10101011       # XOR regA, regB
-        self.SHR = 0b10101101       # SHR regA, regB
-        # Jump to the address stored 
-        # in the given register.
-        self.JPM = 0b01010100       # JMP regA
-        # If equal flag is set (true), 
-        # jump to the address stored in the given register.
-        self.JEQ = 0b01010101       # JEQ regA
-        # If greater-than flag or equal flag 
-        # is set (true), jump to the address 
-        # stored in the given register.
-        self.JGE = 0b01011010       # JGE regA
-        # If greater-than flag is set (true), 
-        # jump to the address stored in the given 
-        # register. 
-        self.JGT = 0b01010111       # JGT regA
-        # If less-than flag is set (true), 
-        # jump to the address stored in the given 
-        # register.
-        self.JLT = 0b01011000       # JLT regA
-        # If E flag is clear (false, 0), 
-        # jump to the address stored in the given 
-        # register.
-        self.JNE = 0b01010110       # JNE regA
-        # Issue the interrupt number stored 
-        # in the given register. 
-        self.INT = 0b01010010       # INT regA
-        # Return from an interrupt handler.
-        self.IRET = 0b00010011      # IRET 
+        # The opcodes as attributes too (self.LDI, cpu.CALL, ...)
+        for opcode, name in OPCODE_NAMES.items():
+            setattr(self, name, opcode)
 
+        # Opcode -> handler dispatch table
+        self.build_dispatch()
+
+
+    def reset(self, clear_ram=False):
+        """
+        Return the CPU to its power-on register state, keeping RAM
+        (and so any loaded program) intact unless `clear_ram` is set.
+        """
+        self.reg[:] = bytes(8)
+        self.reg[7] = 0xF4
+        self.pc = 0
+        self.fl = 0
+        self.running = True
+        self.cycles = 0
+        self.interrupts_enabled = True
+        self.interrupt_pending = False
+        self.halted = False
+
+        if clear_ram:
+            self.ram[:] = bytes(256)
+            self.program_end = 0
+            self.unmap()
+            self.flush_blocks()
+
+    def unmap(self):
+        """
+        Drop the banks and ports mapped with map_banks(), map_output()
+        and map_input(), so the next program starts on plain RAM.
+        """
+        self.banks = None
+        self.bank_window = BANK_WINDOW
+        self.bank_register = BANK_REGISTER
+        self.bank = 0
+        self.bank_data = {}
+        self.ports = {}
+        self.inputs = {}
+        self.stack_limit = self.program_end
+
+        # Back to the plain ST and LD handlers
+        self.build_dispatch()
+
+    def snapshot(self):
+        """
+        Return the whole machine state as one immutable bytes object
+        (see the STATE_* layout).
+        """
+        state = bytearray(STATE_SIZE)
+        state[STATE_RAM] = self.ram
+        state[STATE_REG] = self.reg
+        state[STATE_PC] = self.pc & 0xFF
+        state[STATE_FL] = self.fl
+        state[STATE_RUNNING] = self.running
+        state[STATE_IE] = self.interrupts_enabled
+        # A byte each: a full 256-byte program ends at 0x100, stored as
+        # 0xFF, below which every push overflows just the same
+        state[STATE_STACK_LIMIT] = min(self.stack_limit, 0xFF)
+        state[STATE_PROGRAM_END] = min(self.program_end, 0xFF)
+        state[STATE_CYCLES] = self.cycles.to_bytes(8, "little")
+
+        return bytes(state)
+
+    def restore(self, state):
+        """
+        Restore a state produced by snapshot(). RAM and registers are
+        copied in place straight from memoryview slices of `state`.
+        """
+        view = memoryview(state)
+        ram = view[STATE_RAM]
+
+        # Only throw away cached blocks if their code has changed
+        code_map = self.code_map
+        if self.blocks and any(code_map[address] and ram[address] != value
+                               for address, value in enumerate(self.ram)):
+            self.flush_blocks()
+
+        self.ram[:] = ram
+        self.reg[:] = view[STATE_REG]
+        self.pc = view[STATE_PC]
+        self.fl = view[STATE_FL]
+        self.running = bool(view[STATE_RUNNING])
+        self.halted = not self.running
+        self.interrupts_enabled = bool(view[STATE_IE])
+        self.stack_limit = view[STATE_STACK_LIMIT]
+        self.program_end = view[STATE_PROGRAM_END]
+        self.cycles = int.from_bytes(view[STATE_CYCLES], "little")
+
+        if self.banks is not None:
+            # The window holds whichever bank the registers name; the
+            # store itself isn't part of a snapshot
+            register = self.bank_register
+            self.bank = self.ram[register] | self.ram[register + 1] << 8
+
+    def fork(self):
+        """
+        Return a new CPU continuing from this one's current state.
+
+        The child shares everything that is read-only once built (the
+        PC step and block boundary tables, handler names, symbols) with
+        its parent instead of rebuilding it; only the 264 bytes of RAM
+        and registers are copied, which costs less than tracking writes
+        to share them. Handlers are rebound to the child, and its
+        translation cache starts empty.
+
+        The child writes to the same output device, and the same mapped
+        port devices, as its parent, so their output interleaves; give
+        it its own (child.output = CaptureOutput(), ...) to keep them
+        apart, as difftest does.
+        """
+        child = copy.copy(self)
+        child.ram = bytearray(self.ram)
+        child.reg = bytearray(self.reg)
+        child.blocks = {}
+        child.code_map = bytearray(256)
+        child.interrupt_lock = threading.Lock()
+        if self.banks is not None:
+            # switch_bank() writes the window back into the store
+            child.banks = bytearray(self.banks)
+        # A run() installed on the instance (see hooks.Hooks.install())
+        # is bound to this CPU, not the child
+        child.__dict__.pop("run", None)
+        # Likewise overriding handlers
+        child.overrides = {}
+
+        child.bind_dispatch()
+
+        return child
+
+    def save_snapshot(self, file_name):
+        """
+        Write snapshot() to `file_name`.
+        """
+        with open(file_name, "wb") as file:
+            file.write(SNAPSHOT_MAGIC + self.snapshot())
+
+    def load_snapshot(self, file_name):
+        """
+        Restore a snapshot written by save_snapshot().
+        """
+        with open(file_name, "rb") as file:
+            data = file.read()
+
+        if (data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC
+                or len(data) != len(SNAPSHOT_MAGIC) + STATE_SIZE):
+            raise ValueError("not an LS-8 snapshot")
+
+        self.restore(memoryview(data)[len(SNAPSHOT_MAGIC):])
 
     def load(self, file_name):
         """
-        Load a program into memory.
+        Load a program into memory. Binary images are recognised by
+        their magic number and .asm sources by their extension; anything
+        else is read as .ls8 text.
         """
+        if file_name.endswith(".asm"):
+            return self.load_source(file_name)
+
+        with open(file_name, "rb") as file:
+            if file.read(len(IMAGE_MAGIC)) == IMAGE_MAGIC:
+                return self.load_image(file)
+
         address = 0
+        self.symbols = {}
+        self.line_map = {}
+        self.bank_data = {}
+        # The BANK section being read, if any
+        bank = None
                 
         # with open(file_name[1]) as file:
         with open(file_name) as file:
@@ -122,57 +498,114 @@ class CPU:
                 #str = line.strip().partition("#")[0]
                 str = line.split("#")[0].strip()
                 if len(str) == 0:
+                    # Keep the assembler's label comments as symbols
+                    label = LABEL_COMMENT.match(line.strip())
+                    if label is not None:
+                        self.symbols[label.group(1)] = int(label.group(2))
+                    section = BANK_COMMENT.match(line.strip())
+                    if section is not None:
+                        bank = self.bank_data.setdefault(
+                            int(section.group(1)), bytearray())
+                    continue
+
+                if bank is not None:
+                    bank.append(int(str, 2))
                     continue
                 
                 self.ram_write(address, int(str, 2))
                 
                 address +=1
 
+        self.program_end = self.stack_limit = address
+        self.load_banks()
+
+    def load_source(self, file_name):
+        """
+        Assemble an .asm file in-process and load the code straight into
+        RAM. Raises asm.AssemblerError on bad source.
+        """
+        if ASM_DIR not in sys.path:
+            sys.path.append(ASM_DIR)
+        from asm import assemble
+
+        banks = {}
+        with open(file_name) as file:
+            code, symbols, line_map = assemble(file, banks=banks)
+
+        self.ram[:len(code)] = code
+        self.symbols = symbols
+        self.line_map = line_map
+        self.bank_data = banks
+
+        # Code may have been loaded under cached blocks
+        if self.blocks:
+            self.flush_blocks()
+
+        self.pc = 0
+        self.program_end = self.stack_limit = len(code)
+        self.load_banks()
+
+    def load_image(self, file):
+        """
+        Load a binary program image from an open file, copying the code
+        from a memory map straight into RAM.
+        """
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as image:
+            (magic, version, load_address, flags, _, length, symbol_count,
+             checksum) = IMAGE_HEADER.unpack_from(image)
+
+            if version != 1:
+                raise ValueError(f"unsupported image version {version}")
+
+            start = IMAGE_HEADER.size
+            end = start + length
+            if load_address + length > len(self.ram) or end > len(image):
+                raise ValueError("image does not fit in RAM")
+
+            code = memoryview(image)[start:end]
+            try:
+                if (flags & IMAGE_HAS_CHECKSUM
+                        and zlib.crc32(code) != checksum):
+                    raise ValueError("image checksum mismatch")
+
+                self.ram[load_address:load_address + length] = code
+            finally:
+                code.release()
+
+            self.symbols = {}
+            self.line_map = {}
+            self.bank_data = {}
+            if flags & IMAGE_HAS_SYMBOLS:
+                offset = end
+                for _ in range(symbol_count):
+                    address, size = image[offset], image[offset + 1]
+                    name = image[offset + 2:offset + 2 + size].decode("ascii")
+                    self.symbols[name] = address
+                    offset += 2 + size
+
+        # Code may have been loaded under cached blocks
+        if self.blocks:
+            self.flush_blocks()
+
+        self.pc = load_address
+        self.program_end = self.stack_limit = load_address + length
+        self.load_banks()
 
     def alu(self, op, oper1, oper2):
         """
-        ALU operations.
-        """
-        if op == "ADD":
-            self.reg[oper1] += self.reg[oper2]
-
-        # elif op == "ADDI":
-        #      self.reg[oper1] += self.reg[oper2]
-
-        elif op == "MUL":
-            self.reg[oper1] *= self.reg[oper2]
-
-        elif op == "SUB": 
-            self.reg[oper1] -= self.reg[oper2]
-
-        elif op == "DEC": 
-            self.reg[oper1] -= self.reg[oper2]
-
-        elif op == "DIV":
-            if oper2 == 0:
-                print('Error: Empty address, unable to complete computation')
-                self.HLT()
-            else:
-                self.reg[oper1] //= self.reg[oper2]
-             
-        elif op == "MOD":
-            if oper2 == 0:
-                print('Error: Empty address, unable to complete computation')
-                self.HLT()
-            else:
-                self.reg[oper1] %= self.reg[oper2]
-
-        elif op == "CMP":
-            # `FL` bits: `00000LGE`
-            if self.reg[oper1] < self.reg[oper2]:
-                self.fl = 0b00000100
-            elif self.reg[oper1] > self.reg[oper2]:
-                self.fl = 0b00000010
-            else:
-                self.fl = 0b00000001
+        ALU operations. `op` is the instruction's opcode; the result
+        is looked up in the ALU table (CMP sets FL instead).
+        """
+        reg = self.reg
 
+        if op == self.CMP:
+            self.fl = compare(reg[oper1], reg[oper2])
+        elif op in ALU:
+            # One-operand instructions' second byte isn't a register
+            b = reg[oper2] if op >> 6 == 2 else 0
+            reg[oper1] = ALU[op](reg[oper1], b)
         else:
-            raise Exception("Unsupported ALU Operation")
+            raise Fault(f"{op:08b} is not an ALU operation")
 
     def trace(self):
         """
@@ -181,7 +614,7 @@ class CPU:
         if you need help debugging.
         """
 
-        print(f"TRACE: %02X | %02X %02X %02X |" % (
+        print(f"TRACE: %02X | %02X | %02X %02X %02X |" % (
             self.pc,
             self.fl,
             #self.ie,
@@ -195,128 +628,964 @@ class CPU:
 
         print()
 
-    def run(self):
+    def build_dispatch(self):
         """
-        Run the CPU. ()
+        Build the 256-entry dispatch table, indexed directly by opcode,
+        and the matching table of PC increments.
         """
-        while self.running:
-            execute_cmd = self.ram_read(self.pc)
-            
-            instruction = execute_cmd & 0b00111111  # select opcode and mask
-            operand_count = execute_cmd >> 6 
-            opcode_size = (operand_count) +1        # shift to right 
-            op_position = self.pc
-            # operands = (self.ram_read(op_position + i) for i in range(operand_count))
-                        
-            oper1 = self.ram_read(self.pc+1) #next(operands) 
-            oper2 = self.ram_read(self.pc+2) #next(oper1) 
-
-            if execute_cmd == self.LDI: # 0b10000010            
-                self.reg[oper1] = oper2
-
-            elif execute_cmd == self.PRN: #0b01000111
-                print(self.reg[oper1])
-
-            elif execute_cmd == self.HLT: #0b00000001
+        # Opcode -> name of its handler method
+        self.handlers = {
+            self.LDI: "handle_ldi",
+            self.PRN: "handle_prn",
+            self.HLT: "handle_hlt",
+            self.ADD: "handle_add",
+            self.MUL: "handle_mul",
+            self.SUB: "handle_sub",
+            self.DIV: "handle_div",
+            self.CMP: "handle_cmp",
+            self.MOD: "handle_mod",
+            self.PUSH: "handle_push",
+            self.POP: "handle_pop",
+            self.CALL: "handle_call",
+            self.RET: "handle_ret",
+            self.JMP: "handle_jmp",
+            self.JEQ: "handle_jeq",
+            self.JNE: "handle_jne",
+            self.JGT: "handle_jgt",
+            self.JLT: "handle_jlt",
+            self.JLE: "handle_jle",
+            self.JGE: "handle_jge",
+            self.NOP: "handle_nop",
+            self.AND: "handle_and",
+            self.OR: "handle_or",
+            self.XOR: "handle_xor",
+            self.NOT: "handle_not",
+            self.SHL: "handle_shl",
+            self.SHR: "handle_shr",
+            self.INC: "handle_inc",
+            self.DEC: "handle_dec",
+            self.ST: "handle_st",
+            self.LD: "handle_ld",
+            self.PRA: "handle_pra",
+            self.INT: "handle_int",
+            self.IRET: "handle_iret",
+        }
+        self.bind_dispatch()
+
+        # PC advance, decoded once from the opcode bits `AABCDDDD`:
+        # instructions that set the PC (C bit) advance by 0, the rest
+        # by the operand count (AA) plus one for the opcode itself
+        self.pc_step = [
+            0 if opcode & 0b00010000 else (opcode >> 6) + 1
+            for opcode in range(256)
+        ]
+
+        # Opcodes that end a basic block: everything that sets the PC,
+        # HLT, and the RAM writers (so a block never runs on past a
+        # store into its own code)
+        self.block_end = [
+            bool(opcode & 0b00010000) or opcode not in self.handlers
+            for opcode in range(256)
+        ]
+        for opcode in (self.HLT, self.PUSH, self.ST):
+            self.block_end[opcode] = True
+
+    def bind_dispatch(self):
+        """
+        Fill the dispatch table with this CPU's bound handlers.
+        """
+        # Every unassigned opcode traps into handle_unknown
+        self.dispatch = [self.handle_unknown] * 256
+
+        for opcode, name in self.handlers.items():
+            self.dispatch[opcode] = getattr(self, name)
+        for opcode, handler in self.overrides.items():
+            self.dispatch[opcode] = handler
+
+    def map_output(self, address, device=None):
+        """
+        Map an output port at `address`: bytes stored there with ST go
+        to `device` (default: self.output) instead of RAM.
+
+        ST only switches to the port-checking handler once a port is
+        mapped, so programs without ports pay nothing for them.
+        """
+        # Copied, not updated in place: a fork() shares these with its
+        # parent
+        self.ports = dict(self.ports)
+        self.ports[address & 0xFF] = device
+        self.handlers = dict(self.handlers)
+        if self.banks is None:
+            self.handlers[self.ST] = "handle_st_port"
+        self.bind_dispatch()
+
+        # Cached blocks hold the old ST handler
+        self.flush_blocks()
+
+    def map_input(self, address, device, status=None):
+        """
+        Map an input port at `address`: LD from it returns device.read()
+        and LD from `status` (default: the next address) returns
+        device.status(), e.g. for a devices.StreamInput. Neither is
+        stored in RAM.
+
+        LD only switches to the port-checking handler once a port is
+        mapped, so programs without ports pay nothing for them.
+        """
+        if status is None:
+            status = address + 1
+
+        # Copied, not updated in place: a fork() shares these with its
+        # parent
+        self.inputs = dict(self.inputs)
+        self.inputs[address & 0xFF] = device.read
+        self.inputs[status & 0xFF] = device.status
+        self.handlers = dict(self.handlers)
+        self.handlers[self.LD] = "handle_ld_port"
+        self.bind_dispatch()
+
+        # Cached blocks hold the old LD handler
+        self.flush_blocks()
+
+    def map_banks(self, store=None, window=BANK_WINDOW,
+                  register=BANK_REGISTER):
+        """
+        Turn on bank switching: the BANK_SIZE bytes of RAM at `window`
+        show one bank of `store` (a bytearray or writable mmap, 64 KB of
+        zeros by default), and storing a bank number at `register` (low
+        byte) or the byte after it (high byte) swaps the window's
+        contents back into the store and the new bank in. The loaded
+        program's BANK sections are copied into the store, and bank 0
+        is selected.
+
+        Everything but ST reads and writes the window as plain RAM, and
+        ST only switches to the bank-checking handler once banks are
+        mapped, so programs without banks pay nothing for them. A memory
+        map brings pages of a large store in as banks touch them rather
+        than reading it all up front. A fork() gets its own copy of the
+        store, so its bank switches don't reach its parent. The stack
+        limit moves up to the end of the window, so a stack that grows
+        down into it overflows instead of overwriting the bank.
+        """
+        if not 0 <= window <= 0x100 - BANK_SIZE:
+            raise ValueError(f"bank window {window:#x} doesn't fit in RAM")
+        if not 0 <= register < 0xFF:
+            raise ValueError(f"bank register {register:#x} doesn't fit in "
+                             f"RAM")
+        if len(store if store is not None else b"") % BANK_SIZE:
+            raise ValueError(f"bank store isn't a multiple of {BANK_SIZE} "
+                             f"bytes")
+
+        self.banks = (store if store is not None
+                      else bytearray(BANK_STORE_SIZE))
+        self.bank_window = window
+        self.bank_register = register
+        self.handlers = dict(self.handlers)
+        self.handlers[self.ST] = "handle_st_bank"
+        self.bind_dispatch()
+
+        # Cached blocks hold the old ST handler
+        self.flush_blocks()
+        self.load_banks()
+
+    def load_banks(self):
+        """
+        Copy the loaded program's BANK sections into the bank store and
+        show bank 0 in the window. Programs with BANK sections turn bank
+        switching on with the default store if it's off.
+        """
+        if self.banks is None:
+            if self.bank_data:
+                self.map_banks()
+            return
+
+        window = self.bank_window
+        if self.program_end > window:
+            raise ValueError(f"program runs into the bank window at "
+                             f"{window:#x}")
+        # The stack mustn't grow down into the window either
+        self.stack_limit = max(self.program_end, window + BANK_SIZE)
+
+        banks = self.banks
+        for number, data in self.bank_data.items():
+            offset = number * BANK_SIZE
+            if offset + len(data) > len(banks):
+                raise ValueError(f"bank {number} is past the end of the "
+                                 f"bank store")
+            banks[offset:offset + len(data)] = data
+
+        register = self.bank_register
+        self.ram[register] = self.ram[register + 1] = 0
+        self.ram[window:window + BANK_SIZE] = banks[:BANK_SIZE]
+        self.bank = 0
+        if any(self.code_map[window:window + BANK_SIZE]):
+            self.flush_blocks()
+
+    def switch_bank(self, number):
+        """
+        Swap the window's contents back into the bank store and show
+        bank `number` in their place.
+        """
+        banks = self.banks
+        offset = number * BANK_SIZE
+        if offset >= len(banks):
+            raise Fault(f"bank {number} is past the end of the bank store")
+
+        ram = self.ram
+        window = self.bank_window
+        end = window + BANK_SIZE
+        old = self.bank * BANK_SIZE
+
+        banks[old:old + BANK_SIZE] = ram[window:end]
+        ram[window:end] = banks[offset:offset + BANK_SIZE]
+        self.bank = number
+
+        # Code may be running from a bank
+        if any(self.code_map[window:end]):
+            self.flush_blocks()
+
+    def run(self, max_cycles=None, deadline=None):
+        """
+        Run the CPU until it halts, faults or uses up its budget, and
+        return a RunResult.
+
+        `max_cycles` limits the instructions executed by this call and
+        `deadline` is a time.monotonic() value to stop at; the deadline
+        is checked every CHECK_INTERVAL instructions. A run stopped by
+        either reports RUN_BUDGET and carries on where it left off when
+        run() is called again. Only budgeted runs count cycles.
+        """
+        return self.run_engine(self.step, max_cycles, deadline,
+                               free=self.run_free)
+
+    def run_engine(self, step, max_cycles=None, deadline=None, free=None,
+                   poll=None):
+        """
+        Run the CPU with an engine's or instrument's inner loop and
+        return a RunResult. Budgets, interrupts and faults are handled
+        here, once, for every run loop.
+
+        `step(count)` runs instructions while self.running, at most
+        `count` of them (a block engine may finish the block it is in),
+        adds them to self.cycles even if one faults, and returns how
+        many it ran. An unbudgeted run calls `free()` instead if given,
+        a loop that runs until the CPU stops without counting. `poll`
+        replaces self.poll_interrupts between steps.
+        """
+        start = self.cycles
+        try:
+            if max_cycles is None and deadline is None and free is not None:
+                free()
+                return self.result(start)
+
+            return self.result(start, self.run_slices(
+                step, max_cycles, deadline, poll or self.poll_interrupts))
+        except (Fault, IndexError) as e:
+            return self.fault(start, e)
+        finally:
+            self.budget = None
+
+    def run_slices(self, step, max_cycles, deadline, poll):
+        """
+        Call `step` a slice of up to CHECK_INTERVAL instructions at a
+        time until the CPU stops or a budget runs out, delivering
+        interrupts in between. Returns the budget that ran out ("cycles"
+        or "deadline"), or None.
+        """
+        limit = max_cycles if max_cycles is not None else sys.maxsize
+        # Instructions run inside handlers (see self.budget) go straight
+        # into self.cycles, and count against the budget too
+        base = self.cycles
+
+        while True:
+            count = min(limit - (self.cycles - base), self.CHECK_INTERVAL)
+
+            # The clock is only read between slices
+            while True:
+                # The step may still run `count` instructions; handlers
+                # get the rest
+                self.budget = (base + limit - count, deadline)
+                count -= step(count)
+                if count <= 0 or not poll():
+                    break
+
+            if not self.resumable():
+                return None
+            if self.cycles - base >= limit:
+                return "cycles"
+            if deadline is not None and time.monotonic() >= deadline:
+                return "deadline"
+
+    def run_free(self):
+        """
+        The unbudgeted interpreter loop.
+        """
+        # Local aliases keep attribute lookups out of the hot loop
+        ram = self.ram
+        dispatch = self.dispatch
+        pc_step = self.pc_step
+
+        while True:
+            while self.running:
+                pc = self.pc
+                execute_cmd = ram[pc]
+
+                # operands are passed unconditionally; handlers ignore
+                # the ones they don't use
+                dispatch[execute_cmd](ram[pc + 1], ram[pc + 2])
+
+                # increment program counter as determined by opcode size
+                self.pc += pc_step[execute_cmd]
+
+            # The loop also stops when an interrupt is raised
+            if not self.poll_interrupts():
+                break
+
+    def step(self, count):
+        """
+        The budgeted interpreter loop: run up to `count` instructions
+        and return how many ran (see run_engine()).
+        """
+        ram = self.ram
+        dispatch = self.dispatch
+        pc_step = self.pc_step
+
+        cycles = 0
+        try:
+            while self.running and cycles < count:
+                # counted up front so a faulting instruction still
+                # counts as executed
+                cycles += 1
+                pc = self.pc
+                execute_cmd = ram[pc]
+                dispatch[execute_cmd](ram[pc + 1], ram[pc + 2])
+                self.pc += pc_step[execute_cmd]
+        finally:
+            self.cycles += cycles
+
+        return cycles
+
+    def resumable(self):
+        """
+        Return True if a stopped run loop can carry on with this CPU.
+        """
+        return not self.halted and (self.running or self.interrupt_pending)
+
+    def result(self, start, budget=None):
+        """
+        Return the RunResult for a run loop that stopped without a
+        fault; `start` is self.cycles when the run began.
+        """
+        cycles = self.cycles - start
+
+        if self.halted:
+            return RunResult(RUN_HALTED, cycles, None)
+        if budget is not None and self.resumable():
+            return RunResult(RUN_BUDGET, cycles, budget)
+        return RunResult(RUN_STOPPED, cycles, None)
+
+    def fault(self, start, error):
+        """
+        Stop the CPU after `error` escaped a run loop and return its
+        RunResult. The PC is left at the faulting instruction.
+        """
+        self.running = False
+        self.interrupt_pending = False
+
+        if isinstance(error, StackOverflow):
+            status = RUN_STACK_OVERFLOW
+        else:
+            status = RUN_FAULT
+
+        if isinstance(error, IndexError):
+            # An operand fetch or register index past the end
+            reason = f"address out of range at {self.pc:02X}"
+        else:
+            reason = str(error)
+
+        return RunResult(status, self.cycles - start, reason)
+
+    def bind_op(self, execute_cmd, oper1, oper2):
+        """
+        Return a zero-argument callable performing one straight-line
+        instruction with its operands already decoded.
+        """
+        reg = self.reg
+
+        if execute_cmd == self.LDI:
+            return partial(reg.__setitem__, oper1, oper2)
+
+        if execute_cmd == self.ADD:
+            return lambda: reg.__setitem__(
+                oper1, (reg[oper1] + reg[oper2]) & 0xFF)
+
+        if execute_cmd == self.SUB:
+            return lambda: reg.__setitem__(
+                oper1, (reg[oper1] - reg[oper2]) & 0xFF)
+
+        if execute_cmd == self.MUL:
+            return lambda: reg.__setitem__(
+                oper1, (reg[oper1] * reg[oper2]) & 0xFF)
+
+        if execute_cmd == self.CMP:
+            def cmp():
+                a = reg[oper1]
+                b = reg[oper2]
+                # `FL` bits: `00000LGE`
+                self.fl = 0b100 if a < b else 0b010 if a > b else 0b001
+            return cmp
+
+        return partial(self.dispatch[execute_cmd], oper1, oper2)
+
+    def bind_tail(self, execute_cmd, pc, oper1, oper2):
+        """
+        Return a zero-argument callable for the instruction ending a
+        block. It runs the instruction at `pc` and returns the next PC.
+        """
+        reg = self.reg
+        next_pc = pc + (execute_cmd >> 6) + 1
+
+        if execute_cmd == self.JMP:
+            return lambda: reg[oper1]
+
+        if execute_cmd in JUMP_IF:
+            mask = JUMP_IF[execute_cmd]
+            return lambda: reg[oper1] if self.fl & mask else next_pc
+
+        if execute_cmd == self.JNE:
+            return lambda: next_pc if self.fl & 0b001 else reg[oper1]
+
+        handler = self.dispatch[execute_cmd]
+        step = self.pc_step[execute_cmd]
+
+        def tail():
+            # Anything else runs through its handler, which may read or
+            # set the real PC
+            self.pc = pc
+            handler(oper1, oper2)
+            return self.pc + step
+
+        return tail
+
+    def translate(self, start):
+        """
+        Decode the straight-line run of instructions at `start` into a
+        basic block and add it to the translation cache.
+
+        A block is (body, tail): `body` is a tuple of zero-argument
+        callables for every instruction but the last, and `tail` runs
+        the last one (usually a jump, CALL, RET or HLT) and returns the
+        next PC.
+        """
+        ram = self.ram
+        block_end = self.block_end
+
+        body = []
+        pc = start
+
+        while True:
+            execute_cmd = ram[pc]
+            size = (execute_cmd >> 6) + 1
+
+            # Stop at a block terminator, at the size limit, or when the
+            # next instruction would run off the end of RAM
+            if (block_end[execute_cmd] or len(body) == self.BLOCK_LIMIT
+                    or pc + size + 2 >= len(ram)):
+                break
+
+            body.append(self.bind_op(execute_cmd, ram[pc + 1], ram[pc + 2]))
+            pc += size
+
+        block = (tuple(body),
+                 self.bind_tail(execute_cmd, pc, ram[pc + 1], ram[pc + 2]))
+
+        for address in range(start, pc + size):
+            self.code_map[address] = 1
+        self.blocks[start] = block
+
+        return block
+
+    def flush_blocks(self):
+        """
+        Drop every cached block. Called when RAM under a cached block
+        is written.
+        """
+        self.blocks.clear()
+        self.code_map[:] = bytes(256)
+
+    def prebuild(self, starts):
+        """
+        Decode the block at every address in `starts` into the
+        translation cache ahead of time, e.g. the block starts found by
+        cfg.Analysis, so running the program never stops to translate.
+        """
+        for start in starts:
+            if start not in self.blocks:
+                self.translate(start)
+
+    def run_blocks(self, max_cycles=None, deadline=None):
+        """
+        Run the CPU from the translation cache, decoding each basic
+        block once and replaying it on later visits. Budgets work as
+        in run(), but are checked once per block, so a run may go up
+        to a block's length past `max_cycles`.
+        """
+        return self.run_engine(self.step_blocks, max_cycles, deadline,
+                               free=self.run_blocks_free)
+
+    def run_blocks_free(self):
+        """
+        The unbudgeted block loop.
+        """
+        blocks = self.blocks
+        translate = self.translate
+
+        while True:
+            while self.running:
+                try:
+                    body, tail = blocks[self.pc]
+                except KeyError:
+                    body, tail = translate(self.pc)
+
+                for op in body:
+                    op()
+                self.pc = tail()
+
+            # Interrupts are taken between blocks
+            if not self.poll_interrupts():
+                break
+
+    def step_blocks(self, count):
+        """
+        The budgeted block loop, counting cycles a block at a time: run
+        blocks until at least `count` instructions have, and return how
+        many did (see run_engine()).
+        """
+        blocks = self.blocks
+        translate = self.translate
+
+        cycles = 0
+        try:
+            while self.running and cycles < count:
+                try:
+                    body, tail = blocks[self.pc]
+                except KeyError:
+                    body, tail = translate(self.pc)
+
+                cycles += len(body) + 1
+                for op in body:
+                    op()
+                self.pc = tail()
+        finally:
+            self.cycles += cycles
+
+        return cycles
+
+    def handle_ldi(self, oper1, oper2):
+        """
+        LDI regA, integer
+        """
+        self.reg[oper1] = oper2
+
+    def handle_prn(self, oper1, oper2):
+        """
+        PRN regA
+        """
+        self.output.write(b"%d\n" % self.reg[oper1])
+
+    def handle_hlt(self, oper1, oper2):
+        """
+        HLT
+        """
+        self.running = False
+        self.halted = True
+        self.output.flush()
+
+    def handle_add(self, oper1, oper2):
+        """
+        ADD regA, regB
+        """
+        self.reg[oper1] = (self.reg[oper1] + self.reg[oper2]) & 0xFF
+
+    def handle_mul(self, oper1, oper2):
+        """
+        MUL regA, regB
+        """
+        self.reg[oper1] = (self.reg[oper1] * self.reg[oper2]) & 0xFF
+
+    def handle_sub(self, oper1, oper2):
+        """
+        SUB regA, regB
+        """
+        self.reg[oper1] = (self.reg[oper1] - self.reg[oper2]) & 0xFF
+
+    def handle_div(self, oper1, oper2):
+        """
+        DIV regA, regB
+        """
+        self.alu(self.DIV, oper1, oper2)
+
+    def handle_mod(self, oper1, oper2):
+        """
+        MOD regA, regB
+        """
+        self.alu(self.MOD, oper1, oper2)
+
+    def handle_cmp(self, oper1, oper2):
+        """
+        CMP regA, regB
+        """
+        # `FL` bits: `00000LGE`
+        a = self.reg[oper1]
+        b = self.reg[oper2]
+        if a < b:
+            self.fl = 0b00000100
+        elif a > b:
+            self.fl = 0b00000010
+        else:
+            self.fl = 0b00000001
+
+    def handle_push(self, oper1, oper2):
+        """
+        PUSH regA
+        """
+        # decrement
+        address = (self.reg[self.sp] - 1) & 0xFF
+        if address < self.stack_limit or address == 0xFF:
+            self.stack_overflow(address)
+        self.reg[self.sp] = address
+        # add to stack at memory address assigned by
+        # decremented stack pointer
+        self.ram[address] = self.reg[oper1]
+        if self.code_map[address]:
+            self.flush_blocks()
+
+    def handle_pop(self, oper1, oper2):
+        """
+        POP regA
+        """
+        # copy value at memory address assigned by
+        # stack pointer
+        self.reg[oper1] = self.ram[self.reg[self.sp]]
+        # increment
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
+
+    def handle_call(self, oper1, oper2):
+        """
+        CALL regA
+        """
+        # get the address of the next instruction by adding 2 to
+        # the current instruction
+        addr_next_inst = (self.pc + 2) & 0xFF
+        # decrement
+        address = (self.reg[self.sp] - 1) & 0xFF
+        if address < self.stack_limit or address == 0xFF:
+            self.stack_overflow(address)
+        self.reg[self.sp] = address
+        # push the address of next instruction onto stack
+        # for use in the Return instruction
+        self.ram[address] = addr_next_inst
+        if self.code_map[address]:
+            self.flush_blocks()
+        self.pc = self.reg[oper1]
+
+    def handle_ret(self, oper1, oper2):
+        """
+        RET
+        """
+        # copy value at memory address assigned by
+        # stack pointer into the pc
+        self.pc = self.ram[self.reg[self.sp]]
+        # increment
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
+
+    def handle_jmp(self, oper1, oper2):
+        """
+        JMP regA
+        """
+        self.pc = self.reg[oper1]
+
+    def handle_jeq(self, oper1, oper2):
+        """
+        JEQ regA
+        """
+        if self.fl & 0b00000001:
+            self.pc = self.reg[oper1]
+        else:
+            self.pc += 2
+
+    def handle_jne(self, oper1, oper2):
+        """
+        JNE regA
+        """
+        if not self.fl & 0b00000001:
+            self.pc = self.reg[oper1]
+        else:
+            self.pc += 2
+
+    def handle_jgt(self, oper1, oper2):
+        """
+        JGT regA
+        """
+        if self.fl & FL_G:
+            self.pc = self.reg[oper1]
+        else:
+            self.pc += 2
+
+    def handle_jlt(self, oper1, oper2):
+        """
+        JLT regA
+        """
+        if self.fl & FL_L:
+            self.pc = self.reg[oper1]
+        else:
+            self.pc += 2
+
+    def handle_jle(self, oper1, oper2):
+        """
+        JLE regA
+        """
+        if self.fl & (FL_L | FL_E):
+            self.pc = self.reg[oper1]
+        else:
+            self.pc += 2
+
+    def handle_jge(self, oper1, oper2):
+        """
+        JGE regA
+        """
+        if self.fl & (FL_G | FL_E):
+            self.pc = self.reg[oper1]
+        else:
+            self.pc += 2
+
+    def handle_nop(self, oper1, oper2):
+        """
+        NOP
+        """
+
+    def handle_st(self, oper1, oper2):
+        """
+        ST regA, regB
+        """
+        self.ram_write(self.reg[oper1], self.reg[oper2])
+
+    def handle_st_port(self, oper1, oper2):
+        """
+        ST regA, regB, with output ports mapped
+        """
+        address = self.reg[oper1]
+        if address in self.ports:
+            device = self.ports[address] or self.output
+            device.write(b"%c" % self.reg[oper2])
+        else:
+            self.ram_write(address, self.reg[oper2])
+
+    def handle_st_bank(self, oper1, oper2):
+        """
+        ST regA, regB, with banks mapped
+        """
+        address = self.reg[oper1]
+        register = self.bank_register
+        if address == register or address == register + 1:
+            self.ram_write(address, self.reg[oper2])
+            self.switch_bank(self.ram[register]
+                             | self.ram[register + 1] << 8)
+        else:
+            self.handle_st_port(oper1, oper2)
+
+    def handle_and(self, oper1, oper2):
+        """
+        AND regA, regB
+        """
+        self.reg[oper1] &= self.reg[oper2]
+
+    def handle_or(self, oper1, oper2):
+        """
+        OR regA, regB
+        """
+        self.reg[oper1] |= self.reg[oper2]
+
+    def handle_xor(self, oper1, oper2):
+        """
+        XOR regA, regB
+        """
+        self.reg[oper1] ^= self.reg[oper2]
+
+    def handle_not(self, oper1, oper2):
+        """
+        NOT regA
+        """
+        self.reg[oper1] = ~self.reg[oper1] & 0xFF
+
+    def handle_inc(self, oper1, oper2):
+        """
+        INC regA
+        """
+        self.reg[oper1] = (self.reg[oper1] + 1) & 0xFF
+
+    def handle_dec(self, oper1, oper2):
+        """
+        DEC regA
+        """
+        self.reg[oper1] = (self.reg[oper1] - 1) & 0xFF
+
+    def handle_shl(self, oper1, oper2):
+        """
+        SHL regA, regB
+        """
+        self.reg[oper1] = (self.reg[oper1] << self.reg[oper2]) & 0xFF
+
+    def handle_shr(self, oper1, oper2):
+        """
+        SHR regA, regB
+        """
+        self.reg[oper1] >>= self.reg[oper2]
+
+    def handle_ld(self, oper1, oper2):
+        """
+        LD regA, regB
+        """
+        self.reg[oper1] = self.ram[self.reg[oper2]]
+
+    def handle_ld_port(self, oper1, oper2):
+        """
+        LD regA, regB, with input ports mapped
+        """
+        address = self.reg[oper2]
+        if address in self.inputs:
+            self.reg[oper1] = self.inputs[address]()
+        else:
+            self.reg[oper1] = self.ram[address]
+
+    def handle_pra(self, oper1, oper2):
+        """
+        PRA regA
+        """
+        self.output.write(b"%c" % self.reg[oper1])
+
+    def handle_int(self, oper1, oper2):
+        """
+        INT regA
+        """
+        self.pc += 2
+        self.raise_interrupt(self.reg[oper1] & 7)
+
+    def handle_iret(self, oper1, oper2):
+        """
+        IRET
+        """
+        # Interrupts raised while the handler ran
+        raised = self.reg[6]
+
+        # Pop R6-R0, then FL, then the PC, in reverse order of
+        # interrupt entry
+        for r in range(6, -1, -1):
+            self.reg[r] = self.pop_value()
+        self.fl = self.pop_value()
+        self.pc = self.pop_value()
+
+        with self.interrupt_lock:
+            self.reg[6] |= raised
+            self.interrupts_enabled = True
+
+            # Service anything that arrived meanwhile before the next
+            # fetch
+            if self.reg[5] & self.reg[6]:
+                self.interrupt_pending = True
                 self.running = False
 
-            elif execute_cmd == self.ADD:            
-                self.alu("ADD", oper1, oper2)
-
-            # elif execute_cmd == self.ADDI:            
-            #     self.alu("ADDI", oper1, oper2)
-
-            elif execute_cmd == self.MUL:
-                self.alu("MUL", oper1, oper2)
-
-            elif execute_cmd == self.SUB:
-                self.alu("SUB", oper1, oper2)
-
-            elif execute_cmd == self.DIV:
-                self.alu("DIV", oper1, oper2)
-
-            elif execute_cmd == self.CMP:
-                self.alu("CMP", oper1, oper2)
-
-            elif execute_cmd == self.MOD:            
-                self.alu("MOD", oper1, oper2)
-
-            elif execute_cmd == self.PUSH:
-                # decrement
-                self.reg[self.sp] -=1
-                # add to stack at memory address assigned by 
-                # decremented stack pointer
-                self.ram[self.reg[self.sp]] = self.reg[oper1]
-
-            elif execute_cmd == self.POP:
-                # copy value at memory address assigned by 
-                # stack pointer 
-                self.reg[oper1] = self.ram[self.reg[self.sp]]
-                # increment
-                self.reg[self.sp] +=1
-
-            elif execute_cmd == self.CALL:
-                # get the address of the next instruction by adding 2 to 
-                # the current instruction
-                addr_next_inst = self.pc +2
-                # decrement
-                self.reg[self.sp] -=1
-                # push the address of next instruction onto stack
-                # for use in the Return instruction
-                self.ram[self.reg[self.sp]] = addr_next_inst
-
-                reg_index = oper1
-                addr = self.reg[reg_index]
-                self.pc = addr
-
-            elif execute_cmd == self.RET:
-                # copy value at memory address assigned by 
-                # stack pointer into the pc 
-                self.pc = self.ram[self.reg[self.sp]]
-                # increment
-                self.reg[self.sp] +=1
-
-            elif execute_cmd == self.JPM:
-                self.pc = self.reg[oper1]
-                
-            elif execute_cmd == self.JEQ:
-                if self.fl == 0b00000001:
-                    self.JMP()
-                else:
-                    self.pc += self.opcode_size
+    def handle_unknown(self, oper1, oper2):
+        """
+        Trap for opcodes with no handler.
+        """
+        # Keep buffered program output ahead of the trace
+        self.output.flush()
+        self.trace()
+        raise Fault(f"unrecognized instruction {self.ram[self.pc]:08b} "
+                    f"at {self.pc:02X}")
 
-            elif execute_cmd == self.JNE:
-                if self.fl != 0b00000001:
-                    self.JMP()
-                else:
-                    self.pc += self.opcode_size
+    def raise_interrupt(self, number, key=None):
+        """
+        Raise interrupt `number`, optionally recording a key press at
+        0xF4 first. Safe to call from another thread: it only sets the
+        IS bit and asks the run loop to stop, which then services the
+        interrupt before the next fetch. Nothing polls per instruction.
+        """
+        with self.interrupt_lock:
+            if key is not None:
+                self.ram[0xF4] = key & 0xFF
+            self.reg[6] |= 1 << number
+            self.interrupt_pending = True
+            self.running = False
 
-            elif execute_cmd == self.AND:
-                self.reg[oper1] &= self.reg[oper2]
+    def poll_interrupts(self):
+        """
+        Called when a run loop stops. Deliver a pending interrupt and
+        return True if the CPU should keep running.
+        """
+        # raise_interrupt() can't run between clearing the pending flag
+        # and setting `running`, which would lose its stop, or in the
+        # middle of clearing an IS bit
+        with self.interrupt_lock:
+            if not self.interrupt_pending or self.halted:
+                return False
 
-            elif execute_cmd == self.OR:
-                self.reg[oper1] |= self.reg[oper2]
+            self.interrupt_pending = False
+            self.running = True
 
-            elif execute_cmd == self.XOR:
-                self.reg[oper1] ^= self.reg[oper2]
+            if not self.interrupts_enabled:
+                # Picked up again by IRET
+                return True
 
-            elif execute_cmd == self.NOT:
-                self.reg[oper1] != self.reg[oper2]
+            masked = self.reg[5] & self.reg[6]
+            if masked == 0:
+                return True
 
-            elif execute_cmd == self.SHL:
-                self.reg[oper1] <<= self.reg[oper2]
+            # Lowest numbered interrupt wins
+            number = (masked & -masked).bit_length() - 1
 
-            elif execute_cmd == self.SHR:
-                self.reg[oper1] >>= self.reg[oper2]
+            self.interrupts_enabled = False
+            self.reg[6] &= ~(1 << number) & 0xFF
 
-            else:
-                self.trace()
-                raise Exception(f'Unrecognized Instruction')
+            # Push PC, FL, then R0-R6
+            self.push_value(self.pc)
+            self.push_value(self.fl)
+            for r in range(7):
+                self.push_value(self.reg[r])
 
-            # increment program counter as determined by opcode size
-            if execute_cmd & 0b00010000 == 0:
-                self.pc += opcode_size
-                
+            self.pc = self.ram[0xF8 + number]
+            return True
+
+    def push_value(self, value):
+        """
+        Push a byte onto the stack.
+        """
+        address = (self.reg[self.sp] - 1) & 0xFF
+        if address < self.stack_limit or address == 0xFF:
+            self.stack_overflow(address)
+        self.reg[self.sp] = address
+        self.ram_write(address, value)
+
+    def stack_overflow(self, address):
+        """
+        Raise StackOverflow for a push to `address`.
+        """
+        if address == 0xFF:
+            raise StackOverflow("stack wrapped around below address 00")
+        if self.banks is not None and address >= self.program_end:
+            raise StackOverflow(f"push to {address:02X} would overwrite the "
+                                f"bank window at {self.bank_window:02X}")
+        raise StackOverflow(f"push to {address:02X} would overwrite the "
+                            f"program (which ends at {self.program_end:02X})")
+
+    def pop_value(self):
+        """
+        Pop a byte off the stack.
+        """
+        value = self.ram[self.reg[self.sp]]
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
+        return value
 
     def ram_read(self, address):
         """
@@ -330,7 +1599,9 @@ class CPU:
         """
         Set the value of a register to an integer.
         """
-        self.ram[address] = data
+        self.ram[address] = data & 0xFF
+        if self.code_map[address]:
+            self.flush_blocks()
 
 
     def halt(self):
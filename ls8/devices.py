@@ -0,0 +1,213 @@
+"""
+Input and output devices for the LS-8 emulator.
+
+PRN and PRA don't print directly; they hand bytes to the CPU's `output`
+device, anything with write(data) and flush(). HLT flushes it. The
+default writes to the console, and a host can give every machine a
+device of its own:
+
+    ConsoleOutput   unbuffered, to the current sys.stdout
+    BufferedOutput  batches writes to a binary stream, flushing when the
+                    buffer fills, on HLT, or every `interval` seconds
+    CaptureOutput   collects everything in a bytearray
+
+A device can also be mapped onto a RAM address with CPU.map_output(),
+so that ST to that address writes the stored byte to the device.
+
+Input comes in through ports mapped with CPU.map_input():
+
+    StreamInput     reads a file, stdin or an iterator in large chunks;
+                    LD from its data port takes the next byte and LD
+                    from its status port says whether one is left
+"""
+
+import itertools
+import sys
+import threading
+
+# Default BufferedOutput buffer size, in bytes
+BUFFER_SIZE = 8192
+
+# Default BufferedOutput timed flush interval, in seconds
+FLUSH_INTERVAL = 0.05
+
+# Default StreamInput read size, in bytes
+CHUNK_SIZE = 65536
+
+# StreamInput status byte: a byte is waiting, or the stream has ended
+INPUT_READY = 0b01
+INPUT_EOF = 0b10
+
+
+class ConsoleOutput:
+    """
+    Writes the raw bytes straight to whatever sys.stdout is at the time,
+    like BufferedOutput, flushing after every write so interactive
+    programs echo immediately.
+    """
+    def write(self, data):
+        stdout = sys.stdout
+        # Text already printed (a trace) goes first
+        stdout.flush()
+        buffer = getattr(stdout, "buffer", None)
+        if buffer is None:
+            # A text-only stand-in, e.g. from contextlib.redirect_stdout
+            stdout.write(data.decode("latin-1"))
+            return
+        buffer.write(data)
+        buffer.flush()
+
+    def flush(self):
+        sys.stdout.flush()
+
+
+class BufferedOutput:
+    """
+    Collects writes in a buffer and passes them to a binary stream in
+    large chunks.
+    """
+    def __init__(self, stream=None, size=BUFFER_SIZE,
+                 interval=FLUSH_INTERVAL):
+        """
+        Buffer up to `size` bytes for `stream` (default: the binary
+        stdout). With an `interval`, a daemon thread also flushes that
+        often, so an interactive program's output still shows up while
+        it waits for input; start() launches it.
+        """
+        self.stream = stream if stream is not None else sys.stdout.buffer
+        self.size = size
+        self.interval = interval
+        self.buffer = bytearray()
+        # Held while the buffer is handed to the stream, so the flush
+        # thread and the CPU never interleave
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.interval is not None and self.thread is None:
+            self.thread = threading.Thread(target=self.tick, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+    def tick(self):
+        while not self.stopped.wait(self.interval):
+            if self.buffer:
+                self.flush()
+
+    def write(self, data):
+        with self.lock:
+            self.buffer += data
+            if len(self.buffer) < self.size:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.buffer:
+                self.stream.write(self.buffer)
+                self.buffer.clear()
+            self.stream.flush()
+
+
+class CaptureOutput:
+    """
+    Collects all output in a bytearray, for tests and batch runs.
+    """
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    def flush(self):
+        pass
+
+    def clear(self):
+        self.data.clear()
+
+    def getvalue(self):
+        """
+        Return the captured output decoded as text.
+        """
+        return self.data.decode("latin-1")
+
+
+class StreamInput:
+    """
+    Input device reading a byte stream a chunk at a time, so a program
+    filtering a large stream costs one Python call per byte, not one
+    read.
+    """
+    def __init__(self, source=None, size=CHUNK_SIZE):
+        """
+        Read from `source`: a binary file (default: the binary stdin),
+        or an iterable of bytes-like chunks or of single byte values.
+        Files are read up to `size` bytes at a time, taking whatever a
+        pipe or terminal has ready rather than waiting to fill a chunk.
+        """
+        if source is None:
+            source = sys.stdin.buffer
+        if hasattr(source, "read"):
+            self.read_chunk = getattr(source, "read1", source.read)
+            self.chunks = None
+        else:
+            self.read_chunk = None
+            self.chunks = iter(source)
+        self.size = size
+        self.buffer = b""
+        self.position = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Refill the buffer from the source. Returns False once the stream
+        has ended.
+        """
+        while not self.eof:
+            if self.read_chunk is not None:
+                chunk = self.read_chunk(self.size)
+                if not chunk:
+                    self.eof = True
+                    break
+            else:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    self.eof = True
+                    break
+                if isinstance(chunk, int):
+                    # A stream of single bytes: take them a chunk at a
+                    # time too
+                    chunk = bytes(itertools.chain(
+                        (chunk,), itertools.islice(self.chunks,
+                                                   self.size - 1)))
+
+            if chunk:
+                self.buffer = chunk
+                self.position = 0
+                return True
+
+        return False
+
+    def read(self):
+        """
+        Return the next byte, or 0 once the stream has ended.
+        """
+        if self.position == len(self.buffer) and not self.fill():
+            return 0
+        byte = self.buffer[self.position]
+        self.position += 1
+        return byte
+
+    def status(self):
+        """
+        Return INPUT_READY if a byte is waiting, otherwise INPUT_EOF.
+        Waits for the source if the buffer is empty.
+        """
+        if self.position < len(self.buffer) or self.fill():
+            return INPUT_READY
+        return INPUT_EOF
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+"""
+Lockstep differential testing for the LS-8 emulator's engines.
+
+run_lockstep() runs one program on two engines side by side. The engine
+under test takes one step (a single instruction for the interpreter, a
+whole block for the block and JIT engines), then the reference engine
+runs the same number of instructions, and PC, FL, the registers, RAM,
+the run status and the output so far are compared. The first mismatch
+stops the run and is reported with the instructions the reference
+executed in that step and a diff of the two machine states.
+
+The fuzzer builds random programs from the OPCODES table in
+../asm/asm.py, assembles them in-process and runs each in lockstep under
+a cycle budget.
+
+Usage: difftest.py [program ...] [-a ENGINE] [-b ENGINE]
+                   [--fuzz N] [--seed SEED] [--length N] [--cycles N]
+                   [--optimizer]
+
+With programs, each is run in lockstep until it halts or uses up
+--cycles. With --fuzz, N random programs are. Exits with status 1 if
+any run diverged.
+
+--optimizer checks the assembler's -O pass instead: each .asm program
+given, and every program in OPTIMIZER_REGRESSIONS, is assembled with
+and without it and run on the interpreter, and the two runs must end
+the same way with the same output. Programs that print something that
+depends on their own size, like stackoverflow.asm's recursion depth,
+differ as they should.
+"""
+
+import argparse
+import contextlib
+import io
+import random
+import sys
+
+from cpu import ASM_DIR, CPU, STATE_PC
+from devices import CaptureOutput
+from jit import ENGINES as RUN_ENGINES, JIT, LOOP_LIMIT
+
+# Default instruction budget per program
+CYCLES = 10000
+
+# Default random program length, in instructions
+LENGTH = 24
+
+# Executions before the JIT compiles a block. Low so that short fuzz
+# programs run both interpreted and compiled blocks.
+JIT_THRESHOLD = 2
+
+# Most instructions the reference is allowed to run to catch up with an
+# engine that faulted partway through a step (a compiled self-loop)
+CATCH_UP = LOOP_LIMIT * (CPU.BLOCK_LIMIT + 1)
+
+# Instructions listed in a divergence report, counting back from the
+# end of the step
+LISTING = 16
+
+# Programs the -O pass once changed the output of; --optimizer always
+# runs them
+OPTIMIZER_REGRESSIONS = [
+    # R1 is only loaded on the path the JEQ skips
+    "LDI R2,Skip\nCMP R0,R0\nJEQ R2\nLDI R1,1\n"
+    "Skip:\nLDI R0,5\nADD R0,R1\nPRN R0\nHLT\n",
+    # R1 is added before it is loaded
+    "LDI R0,5\nADD R0,R1\nPRN R0\nLDI R1,1\nHLT\n",
+]
+
+# jit.ENGINES, with the JIT compiling blocks sooner. Run with
+# max_cycles=1, each stops after the smallest unit it can: one
+# instruction, one block, or one compiled self-loop.
+ENGINES = dict(RUN_ENGINES,
+               jit=lambda cpu: JIT(cpu, threshold=JIT_THRESHOLD).run)
+
+
+class Divergence:
+    """
+    The first point where two engines disagreed.
+    """
+    def __init__(self, step, before, listing, differences):
+        # Steps completed before the diverging one
+        self.step = step
+        # Machine state before the step, as snapshot() bytes
+        self.before = before
+        # Disassembled instructions the reference ran in the step
+        self.listing = listing
+        # Text lines describing each difference
+        self.differences = differences
+
+    def report(self):
+        """
+        Return the divergence as text.
+        """
+        lines = [f"Diverged in step {self.step} "
+                 f"(PC {self.before[STATE_PC]:02X} before it)"]
+        lines.append("Reference executed:")
+        lines += [f"  {line}" for line in self.listing]
+        lines.append("Differences:")
+        lines += [f"  {line}" for line in self.differences]
+        return "\n".join(lines)
+
+
+def opcode_table():
+    """
+    Return the assembler's OPCODES table, keyed by mnemonic.
+    """
+    if ASM_DIR not in sys.path:
+        sys.path.append(ASM_DIR)
+    from asm import OPCODES
+
+    return OPCODES
+
+
+def disassemble(ram, pc, names):
+    """
+    Return the instruction at `pc` as assembler text.
+    """
+    execute_cmd = ram[pc]
+    name, kind = names.get(execute_cmd, (f"DB 0b{execute_cmd:08b}", 0))
+    oper1 = ram[(pc + 1) & 0xFF]
+    oper2 = ram[(pc + 2) & 0xFF]
+
+    if kind == 1:
+        text = f"{name} R{oper1 & 7}"
+    elif kind == 2:
+        text = f"{name} R{oper1 & 7},R{oper2 & 7}"
+    elif kind == 8:
+        text = f"{name} R{oper1 & 7},0x{oper2:02X}"
+    else:
+        text = name
+
+    return f"{pc:02X}: {text}"
+
+
+def compare(reference, result_a, other, result_b):
+    """
+    Return a list of differences between two machines and their step
+    results; empty if they agree.
+    """
+    # The common case, checked without building anything
+    if (result_a.status == result_b.status and reference.pc == other.pc
+            and reference.fl == other.fl and reference.reg == other.reg
+            and reference.ram == other.ram
+            and reference.running == other.running
+            and reference.halted == other.halted
+            and reference.output.data == other.output.data):
+        return []
+
+    differences = []
+
+    if result_a.status != result_b.status:
+        differences.append(f"status: {result_a.status} ({result_a.reason}) "
+                           f"!= {result_b.status} ({result_b.reason})")
+
+    # On a fault the block engines leave the PC at the start of the
+    # faulting block, so only the rest of the state has to match
+    faulted = result_a.status not in ("halted", "budget", "stopped")
+
+    if not faulted and reference.pc != other.pc:
+        differences.append(f"PC: {reference.pc:02X} != {other.pc:02X}")
+    if reference.fl != other.fl:
+        differences.append(f"FL: {reference.fl:08b} != {other.fl:08b}")
+    for r in range(8):
+        if reference.reg[r] != other.reg[r]:
+            differences.append(f"R{r}: {reference.reg[r]:02X} != "
+                               f"{other.reg[r]:02X}")
+    for address in range(256):
+        if reference.ram[address] != other.ram[address]:
+            differences.append(f"[{address:02X}]: "
+                               f"{reference.ram[address]:02X} != "
+                               f"{other.ram[address]:02X}")
+    if reference.running != other.running:
+        differences.append(f"running: {reference.running} != "
+                           f"{other.running}")
+    if reference.halted != other.halted:
+        differences.append(f"halted: {reference.halted} != {other.halted}")
+
+    output_a = bytes(reference.output.data)
+    output_b = bytes(other.output.data)
+    if output_a != output_b:
+        differences.append(f"output: {output_a[-32:]!r} != "
+                           f"{output_b[-32:]!r}")
+
+    return differences
+
+
+def replay(reference, before, count, names):
+    """
+    Re-run `count` instructions of the reference from the state
+    `before` one at a time, and return the last LISTING of them
+    disassembled.
+    """
+    cpu = reference.fork()
+    cpu.output = CaptureOutput()
+    cpu.restore(before)
+
+    listing = []
+    for _ in range(count):
+        if not cpu.resumable():
+            break
+        listing.append(disassemble(cpu.ram, cpu.pc, names))
+        if cpu.run(max_cycles=1).status != "budget":
+            break
+
+    if len(listing) > LISTING:
+        listing = ["..."] + listing[-LISTING:]
+    return listing
+
+
+def run_lockstep(cpu, engine_a="interp", engine_b="blocks",
+                 max_cycles=CYCLES):
+    """
+    Run the program loaded in `cpu` on `engine_a` (the reference) and
+    `engine_b` in lockstep, and return the first Divergence, or None if
+    they agreed until the program stopped or `max_cycles` ran out.
+    `cpu` itself is left untouched.
+
+    The reference has to stop after exactly the instructions it is
+    given, which only the interpreter guarantees.
+    """
+    names = {int(op["code"], 2): (name, op["type"])
+             for name, op in opcode_table().items()}
+
+    reference = cpu.fork()
+    other = cpu.fork()
+    reference.output = CaptureOutput()
+    other.output = CaptureOutput()
+
+    run_a = ENGINES[engine_a](reference)
+    run_b = ENGINES[engine_b](other)
+
+    cycles = 0
+    step = 0
+
+    while cycles < max_cycles:
+        before = reference.snapshot()
+        result_b = run_b(max_cycles=1)
+
+        if result_b.status in ("halted", "budget", "stopped"):
+            count = max(result_b.cycles, 1)
+        else:
+            # Runs that fault don't count the block they faulted in;
+            # let the reference run until it stops too
+            count = result_b.cycles + CATCH_UP
+        result_a = run_a(max_cycles=count)
+
+        differences = compare(reference, result_a, other, result_b)
+        if differences:
+            return Divergence(step, before,
+                              replay(reference, before, count, names),
+                              differences)
+
+        if result_b.status != "budget":
+            return None
+
+        cycles += count
+        step += 1
+
+    return None
+
+
+def random_program(rng, length=LENGTH, implemented=None):
+    """
+    Return the assembler source of a random program of `length`
+    instructions, drawn from the assembler's OPCODES table.
+
+    R0-R3 hold data. Jumps and calls load a label into R4 first, so
+    they land on instructions; RET, POP and ST can still send the PC or
+    a store anywhere. DIV and MOD usually get a nonzero divisor loaded
+    first. Only opcodes in `implemented` (default: every
+    opcode the CPU has a handler for) are used, and INT and IRET are
+    left out, as nothing raises or services interrupts here.
+    """
+    opcodes = opcode_table()
+    if implemented is None:
+        implemented = set(CPU().handlers)
+
+    choices = [
+        name for name, op in sorted(opcodes.items())
+        if int(op["code"], 2) in implemented and name not in ("INT", "IRET")
+    ]
+    # Jumps and calls need a label to load
+    jumps = {name for name in choices
+             if opcodes[name]["type"] == 1
+             and int(opcodes[name]["code"], 2) & 0b00010000}
+
+    labels = [f"L{index}" for index in range(max(1, length // 6))]
+    # Which instruction each label is placed before; the first starts
+    # the program
+    placed = {0: labels[0]}
+    for label in labels[1:]:
+        placed[rng.randrange(length)] = label
+
+    lines = []
+    for index in range(length):
+        if index in placed:
+            lines.append(f"{placed[index]}:")
+
+        name = rng.choice(choices)
+        kind = opcodes[name]["type"]
+        a = f"R{rng.randrange(4)}"
+        b = f"R{rng.randrange(4)}"
+
+        if name in ("DIV", "MOD") and rng.random() < 0.75:
+            # Mostly a nonzero divisor, so fewer runs end right there
+            lines.append(f"LDI {b},{rng.randrange(1, 256)}")
+            lines.append(f"{name} {a},{b}")
+        elif name in jumps:
+            lines.append(f"LDI R4,{rng.choice(labels)}")
+            lines.append(f"{name} R4")
+        elif kind == 8:
+            lines.append(f"{name} {a},{rng.randrange(256)}")
+        elif kind == 2:
+            lines.append(f"{name} {a},{b}")
+        elif kind == 1:
+            lines.append(f"{name} {a}")
+        else:
+            lines.append(name)
+
+    # Labels placed on the same index collapse into one; define any left
+    # over at the end, next to the closing HLT
+    for label in labels:
+        if label not in placed.values():
+            lines.append(f"{label}:")
+    lines.append("HLT")
+
+    return "\n".join(lines) + "\n"
+
+
+def fuzz(count, engine_a="interp", engine_b="blocks", seed=None,
+         length=LENGTH, max_cycles=CYCLES, log=sys.stdout):
+    """
+    Run `count` random programs in lockstep and return the number that
+    diverged. Each divergence is written to `log` with the program's
+    source.
+    """
+    if ASM_DIR not in sys.path:
+        sys.path.append(ASM_DIR)
+    from asm import assemble
+
+    rng = random.Random(seed)
+    failures = 0
+
+    for index in range(count):
+        source = random_program(rng, length)
+        code, symbols, line_map = assemble(source)
+
+        cpu = CPU()
+        cpu.ram[:len(code)] = code
+        cpu.symbols = symbols
+        cpu.line_map = line_map
+        cpu.program_end = cpu.stack_limit = len(code)
+
+        # Unknown opcodes print a trace on the way to a fault
+        with contextlib.redirect_stdout(io.StringIO()):
+            divergence = run_lockstep(cpu, engine_a, engine_b, max_cycles)
+
+        if divergence is not None:
+            failures += 1
+            print(f"Program {index}:", file=log)
+            print(source, file=log)
+            print(divergence.report(), file=log)
+            print(file=log)
+
+    return failures
+
+
+def check_optimizer(source, max_cycles=CYCLES):
+    """
+    Assemble `source` with and without the -O pass, run both to the end
+    on the interpreter, and return a list of differences in how they
+    stopped and what they printed; empty if they agree. Fault reasons
+    aren't compared, as they name addresses the optimizer moves.
+    """
+    if ASM_DIR not in sys.path:
+        sys.path.append(ASM_DIR)
+    from asm import assemble
+
+    results = []
+    for optimize_code in (False, True):
+        code, symbols, line_map = assemble(source, optimize_code)
+
+        cpu = CPU()
+        cpu.ram[:len(code)] = code
+        cpu.symbols = symbols
+        cpu.line_map = line_map
+        cpu.program_end = cpu.stack_limit = len(code)
+        cpu.output = CaptureOutput()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = cpu.run(max_cycles=max_cycles)
+        results.append((result.status, bytes(cpu.output.data)))
+
+    (status_a, output_a), (status_b, output_b) = results
+
+    differences = []
+    if status_a != status_b:
+        differences.append(f"status: {status_a} != {status_b} with -O")
+    if output_a != output_b:
+        differences.append(f"output: {output_a[-32:]!r} != "
+                           f"{output_b[-32:]!r} with -O")
+    return differences
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run LS-8 engines in lockstep and compare them.")
+    parser.add_argument("programs", nargs="*",
+                        help="programs to run (.ls8, .ls8b or .asm)")
+    parser.add_argument("-a", "--reference", choices=ENGINES,
+                        default="interp",
+                        help="reference engine, which must stop on any "
+                             "instruction (default: interp)")
+    parser.add_argument("-b", "--engine", choices=ENGINES, default="blocks",
+                        help="engine under test (default: blocks)")
+    parser.add_argument("--fuzz", type=int, metavar="N", default=0,
+                        help="also run N random programs")
+    parser.add_argument("--seed", type=int,
+                        help="random seed for --fuzz")
+    parser.add_argument("--length", type=int, default=LENGTH,
+                        help=f"instructions per random program "
+                             f"(default: {LENGTH})")
+    parser.add_argument("--cycles", type=int, default=CYCLES,
+                        help=f"instructions to run each program for "
+                             f"(default: {CYCLES})")
+    parser.add_argument("--optimizer", action="store_true",
+                        help="compare .asm programs and the built-in "
+                             "regressions with and without -O instead")
+    args = parser.parse_args(argv[1:])
+
+    if args.optimizer:
+        sources = [(f"regression {index}", source) for index, source
+                   in enumerate(OPTIMIZER_REGRESSIONS)]
+        for file_name in args.programs:
+            if not file_name.endswith(".asm"):
+                parser.error(f"--optimizer needs .asm sources: {file_name}")
+            try:
+                with open(file_name) as f:
+                    sources.append((file_name, f.read()))
+            except OSError as e:
+                print(f"{file_name}: {e}", file=sys.stderr)
+                return 1
+
+        failures = 0
+        for name, source in sources:
+            differences = check_optimizer(source, args.cycles)
+            if differences:
+                failures += 1
+                print(f"{name}:")
+                print("\n".join(f"  {line}" for line in differences))
+            else:
+                print(f"{name}: ok")
+
+        return 1 if failures else 0
+
+    if not args.programs and not args.fuzz:
+        parser.error("give programs to run, --fuzz, or both")
+
+    failures = 0
+
+    for file_name in args.programs:
+        cpu = CPU()
+        try:
+            cpu.load(file_name)
+        except (OSError, ValueError) as e:
+            print(f"{file_name}: {e}", file=sys.stderr)
+            return 1
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            divergence = run_lockstep(cpu, args.reference, args.engine,
+                                      args.cycles)
+
+        if divergence is None:
+            print(f"{file_name}: ok")
+        else:
+            failures += 1
+            print(f"{file_name}:")
+            print(divergence.report())
+
+    if args.fuzz:
+        diverged = fuzz(args.fuzz, args.reference, args.engine, args.seed,
+                        args.length, args.cycles)
+        print(f"{args.fuzz} random programs, {diverged} diverged")
+        failures += diverged
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
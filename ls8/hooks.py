@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+
+"""
+Instrumentation hooks for the LS-8 emulator.
+
+Callbacks are registered on a Hooks object for these events:
+
+    execute     (pc, opcode, oper1, oper2), before every instruction
+    read        (address, value), for every data byte LD, POP, RET and
+                IRET read (instruction fetches aren't reported)
+    write       (address, value), for every byte ST, PUSH, CALL and
+                interrupt entry store
+    call        (pc, target), after a CALL
+    ret         (pc, return address), after a RET
+    interrupt   (number, pc), on entry to a handler, with the PC it
+                interrupted
+    halt        (pc), once the CPU halts
+
+CPU.run() never looks for hooks. Instead, install() shadows it with
+Hooks.run(), which runs an interpreter step that calls them through
+CPU.run_engine(), and uninstall() puts the plain loop back. The step
+uses per-opcode tables of the callbacks each instruction needs, built
+once when the run starts, so an instruction nothing watches only costs
+two empty loops.
+
+Built-in consumers, each attached with attach(hooks):
+
+    OpcodeHistogram     executions per opcode
+    MemoryHeatmap       reads and writes per RAM address, drawn as a
+                        16x16 grid
+    MetricsExporter     counters written to a file in the Prometheus
+                        text format every few seconds and at exit, e.g.
+                        for node_exporter's textfile collector
+
+Usage: hooks.py <program> [--metrics FILE]
+
+Runs the program with the histogram and heatmap attached and prints
+both.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+from cpu import CALL, CPU, IRET, LD, OPCODE_NAMES, POP, PUSH, RET, ST
+
+# Bytes pushed on interrupt entry (PC, FL, R0-R6) and popped by IRET
+INTERRUPT_FRAME = 9
+
+# Events a callback can be registered for
+EVENTS = ("execute", "read", "write", "call", "ret", "interrupt", "halt")
+
+# Default MetricsExporter write interval, in seconds
+METRICS_INTERVAL = 5.0
+
+# Heatmap shades, from untouched to the busiest address
+SHADES = " .:-=+*#%@"
+
+
+class Hooks:
+    """
+    Instrumentation callbacks for one CPU, and the loop that runs them.
+    """
+    def __init__(self, cpu):
+        """
+        Create an empty set of hooks for `cpu`.
+        """
+        self.cpu = cpu
+        # Event -> callbacks, in registration order
+        self.callbacks = {event: [] for event in EVENTS}
+        # Instructions run by the instrumented loop; updated once per
+        # CHECK_INTERVAL slice, so a metrics thread can read it mid-run
+        self.steps = 0
+        # Per-opcode hooks, from tables() when a run starts
+        self.before = self.after = None
+
+    def add(self, event, callback):
+        """
+        Register `callback` for `event` (see EVENTS).
+        """
+        if event not in self.callbacks:
+            raise ValueError(f"unknown event {event!r}")
+        self.callbacks[event].append(callback)
+
+    def remove(self, event, callback):
+        """
+        Unregister a callback added with add().
+        """
+        self.callbacks[event].remove(callback)
+
+    def install(self):
+        """
+        Make the CPU's run() the instrumented loop. A fork() of the CPU
+        gets the plain run() back.
+        """
+        self.cpu.run = self.run
+        return self
+
+    def uninstall(self):
+        """
+        Give the CPU back its plain run().
+        """
+        self.cpu.__dict__.pop("run", None)
+
+    def tables(self):
+        """
+        Return (before, after): for every opcode, a tuple of functions
+        called with (pc, opcode, oper1, oper2) before and after the
+        instruction runs, built from the registered callbacks.
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+        reg = cpu.reg
+        callbacks = self.callbacks
+        before = [list(callbacks["execute"]) for _ in range(256)]
+        after = [[] for _ in range(256)]
+
+        reads = callbacks["read"]
+        writes = callbacks["write"]
+
+        if reads:
+            # LD's address register may be the one it loads
+            address = [0]
+
+            def ld_address(pc, opcode, oper1, oper2):
+                address[0] = reg[oper2]
+
+            def ld(pc, opcode, oper1, oper2):
+                for callback in reads:
+                    callback(address[0], reg[oper1])
+
+            def pop(pc, opcode, oper1, oper2):
+                # The byte just above SP, which POP and RET have moved
+                top = (reg[7] - 1) & 0xFF
+                for callback in reads:
+                    callback(top, ram[top])
+
+            def iret(pc, opcode, oper1, oper2):
+                for offset in range(INTERRUPT_FRAME, 0, -1):
+                    address = (reg[7] - offset) & 0xFF
+                    for callback in reads:
+                        callback(address, ram[address])
+
+            before[LD].append(ld_address)
+            after[LD].append(ld)
+            after[POP].append(pop)
+            after[RET].append(pop)
+            after[IRET].append(iret)
+
+        if writes:
+            def st(pc, opcode, oper1, oper2):
+                for callback in writes:
+                    callback(reg[oper1], reg[oper2])
+
+            def push(pc, opcode, oper1, oper2):
+                top = reg[7]
+                for callback in writes:
+                    callback(top, ram[top])
+
+            after[ST].append(st)
+            after[PUSH].append(push)
+            after[CALL].append(push)
+
+        for callback in callbacks["call"]:
+            after[CALL].append(
+                lambda pc, opcode, oper1, oper2, callback=callback:
+                    callback(pc, cpu.pc))
+
+        for callback in callbacks["ret"]:
+            after[RET].append(
+                lambda pc, opcode, oper1, oper2, callback=callback:
+                    callback(pc, cpu.pc))
+
+        return ([tuple(hooks) for hooks in before],
+                [tuple(hooks) for hooks in after])
+
+    def run(self, max_cycles=None, deadline=None):
+        """
+        Run the CPU like CPU.run(), calling the registered hooks, and
+        return a RunResult. Unlike CPU.run(), unbudgeted runs count
+        cycles too.
+        """
+        cpu = self.cpu
+        # Built once per run, not per slice
+        self.before, self.after = self.tables()
+        try:
+            return cpu.run_engine(self.step, max_cycles, deadline,
+                                  poll=self.poll)
+        finally:
+            if cpu.halted:
+                for callback in self.callbacks["halt"]:
+                    callback(cpu.pc)
+
+    def step(self, count):
+        """
+        The instrumented interpreter loop: run up to `count`
+        instructions and return how many ran (see CPU.run_engine()).
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+        dispatch = cpu.dispatch
+        pc_step = cpu.pc_step
+        before = self.before
+        after = self.after
+
+        cycles = 0
+        try:
+            while cpu.running and cycles < count:
+                cycles += 1
+                pc = cpu.pc
+                execute_cmd = ram[pc]
+                oper1 = ram[pc + 1]
+                oper2 = ram[pc + 2]
+
+                for hook in before[execute_cmd]:
+                    hook(pc, execute_cmd, oper1, oper2)
+
+                dispatch[execute_cmd](oper1, oper2)
+                cpu.pc += pc_step[execute_cmd]
+
+                for hook in after[execute_cmd]:
+                    hook(pc, execute_cmd, oper1, oper2)
+        finally:
+            self.steps += cycles
+            cpu.cycles += cycles
+
+        return cycles
+
+    def poll(self):
+        """
+        cpu.poll_interrupts(), also reporting the stack writes and the
+        handler entry of an interrupt it delivers.
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+        reg = cpu.reg
+
+        # poll_interrupts() clears the bit it delivers, so work out
+        # which one it will be first
+        enabled = cpu.interrupts_enabled
+        masked = reg[5] & reg[6]
+        pc = cpu.pc
+        if not cpu.poll_interrupts():
+            return False
+
+        if enabled and not cpu.interrupts_enabled:
+            number = (masked & -masked).bit_length() - 1
+            # PC was pushed first, so sits highest
+            for offset in range(INTERRUPT_FRAME - 1, -1, -1):
+                address = (reg[7] + offset) & 0xFF
+                for callback in self.callbacks["write"]:
+                    callback(address, ram[address])
+            for callback in self.callbacks["interrupt"]:
+                callback(number, pc)
+
+        return True
+
+
+class OpcodeHistogram:
+    """
+    Counts executions per opcode.
+    """
+    def __init__(self):
+        self.counts = [0] * 256
+
+    def attach(self, hooks):
+        """
+        Register with `hooks` and return self.
+        """
+        hooks.add("execute", self.execute)
+        return self
+
+    def execute(self, pc, opcode, oper1, oper2):
+        self.counts[opcode] += 1
+
+    def report(self):
+        """
+        Return the histogram as text, busiest opcode first.
+        """
+        total = sum(self.counts) or 1
+        busiest = max(self.counts) or 1
+        lines = [f"Instructions executed: {sum(self.counts)}", ""]
+
+        for opcode in sorted(range(256), key=lambda op: -self.counts[op]):
+            count = self.counts[opcode]
+            if count == 0:
+                break
+            name = OPCODE_NAMES.get(opcode, f"{opcode:08b}")
+            bar = "#" * round(40 * count / busiest)
+            lines.append(f"  {name:<8} {count:>12} {100 * count / total:6.2f}% "
+                         f"{bar}")
+
+        return "\n".join(lines) + "\n"
+
+
+class MemoryHeatmap:
+    """
+    Counts data reads and writes per RAM address.
+    """
+    def __init__(self):
+        self.reads = [0] * 256
+        self.writes = [0] * 256
+
+    def attach(self, hooks):
+        """
+        Register with `hooks` and return self.
+        """
+        hooks.add("read", self.read)
+        hooks.add("write", self.write)
+        return self
+
+    def read(self, address, value):
+        self.reads[address] += 1
+
+    def write(self, address, value):
+        self.writes[address] += 1
+
+    def grid(self, counts):
+        """
+        Return `counts` drawn as 16 rows of 16 shaded cells.
+        """
+        busiest = max(counts) or 1
+        lines = ["    " + "".join(f"{column:X}" for column in range(16))]
+        for row in range(16):
+            cells = counts[row * 16:row * 16 + 16]
+            lines.append(f" {row:X}0 " + "".join(
+                SHADES[-(-count * (len(SHADES) - 1) // busiest)]
+                for count in cells))
+        return lines
+
+    def report(self):
+        """
+        Return the read and write heatmaps as text.
+        """
+        lines = [f"Reads: {sum(self.reads)}"]
+        lines += self.grid(self.reads)
+        lines.append("")
+        lines.append(f"Writes: {sum(self.writes)}")
+        lines += self.grid(self.writes)
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """
+    Writes run counters to a file in the Prometheus text format.
+    """
+    def __init__(self, file_name, interval=METRICS_INTERVAL):
+        """
+        Write to `file_name` every `interval` seconds once started, and
+        on stop().
+        """
+        self.file_name = file_name
+        self.interval = interval
+        self.hooks = None
+        self.calls = 0
+        self.returns = 0
+        self.reads = 0
+        self.writes = 0
+        self.interrupts = [0] * 8
+        self.halted = False
+        self.started = time.monotonic()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def attach(self, hooks):
+        """
+        Register with `hooks` and return self.
+        """
+        self.hooks = hooks
+        hooks.add("call", self.call)
+        hooks.add("ret", self.ret)
+        hooks.add("read", self.read)
+        hooks.add("write", self.write)
+        hooks.add("interrupt", self.interrupt)
+        hooks.add("halt", self.halt)
+        return self
+
+    def call(self, pc, target):
+        self.calls += 1
+
+    def ret(self, pc, address):
+        self.returns += 1
+
+    def read(self, address, value):
+        self.reads += 1
+
+    def write(self, address, value):
+        self.writes += 1
+
+    def interrupt(self, number, pc):
+        self.interrupts[number] += 1
+
+    def halt(self, pc):
+        self.halted = True
+
+    def start(self):
+        if self.interval is not None and self.thread is None:
+            self.thread = threading.Thread(target=self.tick, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.export()
+
+    def tick(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def metrics(self):
+        """
+        Return the metrics as Prometheus text exposition lines.
+        """
+        steps = self.hooks.steps if self.hooks is not None else 0
+        elapsed = time.monotonic() - self.started
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP ls8_{name} {help_text}")
+            lines.append(f"# TYPE ls8_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"ls8_{name}{labels} {value}")
+
+        metric("instructions_total", "counter", "Instructions executed.",
+               [("", steps)])
+        metric("instructions_per_second", "gauge",
+               "Mean instructions executed per second.",
+               [("", f"{steps / elapsed:.1f}" if elapsed else 0)])
+        metric("calls_total", "counter", "CALL instructions executed.",
+               [("", self.calls)])
+        metric("returns_total", "counter", "RET instructions executed.",
+               [("", self.returns)])
+        metric("memory_reads_total", "counter", "Data bytes read from RAM.",
+               [("", self.reads)])
+        metric("memory_writes_total", "counter", "Data bytes written to RAM.",
+               [("", self.writes)])
+        metric("interrupts_total", "counter", "Interrupts delivered.",
+               [(f'{{number="{number}"}}', count)
+                for number, count in enumerate(self.interrupts)])
+        metric("halted", "gauge", "1 once the program has halted.",
+               [("", int(self.halted))])
+
+        return lines
+
+    def export(self):
+        """
+        Write the metrics, replacing the file in one step so a reader
+        never sees half of it.
+        """
+        temporary = f"{self.file_name}.tmp"
+        with open(temporary, "w") as file:
+            file.write("\n".join(self.metrics()) + "\n")
+        os.replace(temporary, self.file_name)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run an LS-8 program with instrumentation hooks.")
+    parser.add_argument("program", help="program (.asm, .ls8 or .ls8b)")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="also export metrics to FILE")
+    args = parser.parse_args(argv[1:])
+
+    from devices import CaptureOutput
+
+    cpu = CPU()
+    cpu.output = CaptureOutput()
+    cpu.load(args.program)
+
+    hooks = Hooks(cpu).install()
+    histogram = OpcodeHistogram().attach(hooks)
+    heatmap = MemoryHeatmap().attach(hooks)
+    exporter = None
+    if args.metrics:
+        exporter = MetricsExporter(args.metrics).attach(hooks).start()
+
+    try:
+        result = cpu.run()
+    finally:
+        if exporter is not None:
+            exporter.stop()
+
+    print(f"{result.status} after {result.cycles} instructions")
+    print()
+    print(histogram.report())
+    print(heatmap.report())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
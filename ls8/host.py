@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+"""
+Asyncio host for running many LS-8 machines in one process.
+
+Every machine is a Session driven by its own task, which runs the CPU
+for a bounded slice of cycles and then yields to the event loop, so no
+machine needs a thread. Output goes to an async stream (a socket, a pipe
+or an asyncio.Queue) and input bytes are queued per session and raised
+as keyboard interrupts (I1) between slices. One host task raises the
+timer interrupt (I0) on every session.
+
+A machine spinning on `JMP` to itself (as keyboard.asm and
+interrupts.asm do while waiting) sleeps until its next key or timer
+tick instead of burning its slices.
+
+Usage: host.py <program> [--port PORT] [-n SESSIONS] [--slice CYCLES]
+
+With --port, every TCP connection gets a fresh machine running the
+program, with the socket as its keyboard and console. Otherwise
+SESSIONS copies run on this terminal, all fed from stdin.
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import sys
+
+from cpu import CPU, RUN_BUDGET
+
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = None
+
+# Instructions a machine runs before yielding to the event loop
+SLICE = 10000
+
+# Input bytes held per session before the oldest are dropped
+KEY_BUFFER = 4096
+
+
+class StreamOutput:
+    """
+    Output device writing to an asyncio StreamWriter.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        self.writer.write(bytes(data))
+
+    def flush(self):
+        pass
+
+    async def drain(self):
+        await self.writer.drain()
+
+
+class QueueOutput:
+    """
+    Output device putting every write on an asyncio.Queue as bytes.
+    """
+    def __init__(self, queue=None):
+        self.queue = queue if queue is not None else asyncio.Queue()
+
+    def write(self, data):
+        self.queue.put_nowait(bytes(data))
+
+    def flush(self):
+        pass
+
+
+class Session:
+    """
+    One machine run by a Host.
+    """
+    def __init__(self, cpu, output):
+        """
+        Wrap `cpu`, sending its output to `output`.
+        """
+        self.cpu = cpu
+        cpu.output = output
+        self.output = output
+        # Input bytes waiting to be raised as keyboard interrupts
+        self.keys = collections.deque(maxlen=KEY_BUFFER)
+        # Set on input, timer ticks and close(), to wake an idle machine
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        # The task running the machine, set by Host.start()
+        self.task = None
+        # The RunResult of the last slice
+        self.result = None
+
+    def feed(self, data):
+        """
+        Queue input bytes for the machine.
+        """
+        self.keys.extend(data)
+        self.wakeup.set()
+
+    def close(self):
+        """
+        Stop the machine at the end of its current slice.
+        """
+        self.closed = True
+        self.wakeup.set()
+
+    def deliver(self):
+        """
+        Raise the next queued key, once the previous one has been taken
+        (its IS bit cleared) and its handler has returned, so none are
+        overwritten at 0xF4. Matches interrupts.Keyboard.
+        """
+        cpu = self.cpu
+        if (self.keys and not cpu.reg[6] & 0b10
+                and cpu.interrupts_enabled):
+            cpu.raise_interrupt(1, key=self.keys.popleft())
+
+    def idle(self):
+        """
+        Return True if the machine is spinning on a jump to itself.
+        """
+        cpu = self.cpu
+        pc = cpu.pc
+        return (cpu.ram[pc] == cpu.JMP
+                and cpu.reg[cpu.ram[(pc + 1) & 0xFF] & 7] == pc)
+
+
+class Host:
+    """
+    Runs Sessions as asyncio tasks in bounded slices of cycles.
+    """
+    def __init__(self, slice_cycles=SLICE, timer_interval=1.0):
+        """
+        Create a host. With `timer_interval` None no timer interrupts
+        are raised.
+        """
+        self.slice_cycles = slice_cycles
+        self.timer_interval = timer_interval
+        self.sessions = set()
+        self.timer = None
+
+    def start(self, cpu, output):
+        """
+        Start running `cpu` and return its Session. Must be called from
+        inside the event loop.
+        """
+        session = Session(cpu, output)
+        self.sessions.add(session)
+        session.task = asyncio.create_task(self.run_session(session))
+
+        if self.timer is None and self.timer_interval is not None:
+            self.timer = asyncio.create_task(self.tick())
+
+        return session
+
+    async def run_session(self, session):
+        """
+        Run a session until its machine halts, faults or is closed.
+        Returns the last slice's RunResult.
+        """
+        cpu = session.cpu
+        drain = getattr(session.output, "drain", None)
+
+        try:
+            while not session.closed:
+                session.deliver()
+                session.result = cpu.run(max_cycles=self.slice_cycles)
+                if session.result.status != RUN_BUDGET:
+                    break
+
+                if drain is not None:
+                    await drain()
+
+                if session.idle():
+                    # Nothing will change until an event arrives
+                    session.wakeup.clear()
+                    if (not session.keys and not cpu.interrupt_pending
+                            and not session.closed):
+                        await session.wakeup.wait()
+                else:
+                    await asyncio.sleep(0)
+        finally:
+            session.output.flush()
+            self.sessions.discard(session)
+
+        return session.result
+
+    async def tick(self):
+        """
+        Raise I0 on every session once per timer interval.
+        """
+        while True:
+            await asyncio.sleep(self.timer_interval)
+            for session in self.sessions:
+                session.cpu.raise_interrupt(0)
+                session.wakeup.set()
+
+    async def pump(self, session, reader):
+        """
+        Feed bytes from an asyncio StreamReader to `session` until EOF.
+        """
+        while True:
+            data = await reader.read(256)
+            if not data:
+                return
+            session.feed(data)
+
+    def stop(self):
+        """
+        Close every session and stop the timer.
+        """
+        for session in list(self.sessions):
+            session.close()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+async def serve(template, port, host):
+    """
+    Serve a copy of the `template` machine on every TCP connection.
+    """
+    async def connected(reader, writer):
+        session = host.start(template.fork(), StreamOutput(writer))
+        pump = asyncio.create_task(host.pump(session, reader))
+
+        try:
+            # Whichever ends first: the program stopping or the client
+            # hanging up
+            await asyncio.wait((session.task, pump),
+                               return_when=asyncio.FIRST_COMPLETED)
+            result = session.result
+            if session.task.done() and result.status != "halted":
+                writer.write(f"\n{result.status}: {result.reason}\n"
+                             .encode())
+        finally:
+            session.close()
+            pump.cancel()
+            await asyncio.gather(session.task, return_exceptions=True)
+            writer.close()
+
+    server = await asyncio.start_server(connected, port=port)
+    async with server:
+        await server.serve_forever()
+
+
+async def run_local(template, count, host):
+    """
+    Run `count` copies of the `template` machine on this terminal,
+    feeding stdin to all of them.
+    """
+    loop = asyncio.get_running_loop()
+    sessions = [host.start(template.fork(), template.output)
+                for _ in range(count)]
+
+    fd = sys.stdin.fileno()
+
+    def readable():
+        data = os.read(fd, 256)
+        if not data:
+            loop.remove_reader(fd)
+        for session in sessions:
+            session.feed(data)
+
+    async def read_file():
+        # Regular files and /dev/null can't be polled, but never block
+        while True:
+            data = await loop.run_in_executor(None, os.read, fd, 256)
+            if not data:
+                return
+            for session in sessions:
+                session.feed(data)
+
+    reader = None
+    try:
+        loop.add_reader(fd, readable)
+    except PermissionError:
+        reader = asyncio.create_task(read_file())
+
+    try:
+        results = await asyncio.gather(*(session.task for session in sessions))
+        for result in results:
+            if result.status != "halted":
+                print(f"{result.status}: {result.reason}", file=sys.stderr)
+    finally:
+        if reader is None:
+            loop.remove_reader(fd)
+        else:
+            reader.cancel()
+        host.stop()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run many LS-8 machines on one event loop.")
+    parser.add_argument("program", help="program to run (.ls8 or .ls8b)")
+    parser.add_argument("--port", type=int,
+                        help="serve a machine per TCP connection on PORT")
+    parser.add_argument("-n", "--sessions", type=int, default=1,
+                        help="machines to run locally (default: 1)")
+    parser.add_argument("--slice", type=int, default=SLICE,
+                        help=f"instructions per slice (default: {SLICE})")
+    args = parser.parse_args(argv[1:])
+
+    template = CPU()
+    template.load(args.program)
+    host = Host(slice_cycles=args.slice)
+
+    if args.port is not None:
+        try:
+            asyncio.run(serve(template, args.port, host))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    saved = None
+    fd = sys.stdin.fileno()
+    if termios is not None and os.isatty(fd):
+        saved = termios.tcgetattr(fd)
+        tty.setcbreak(fd)
+
+    try:
+        asyncio.run(run_local(template, args.sessions, host))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if saved is not None:
+            termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
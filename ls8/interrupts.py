@@ -0,0 +1,107 @@
+"""
+Interrupt sources for the LS-8 emulator.
+
+Each source runs on a daemon thread and calls cpu.raise_interrupt() when
+its event happens, so the CPU's run loop never has to poll a clock or
+the keyboard itself.
+"""
+
+import os
+import queue
+import sys
+import threading
+
+try:
+    import termios
+    import tty
+except ImportError:
+    # Not available on Windows; the keyboard then reads whole lines
+    termios = None
+
+
+class Timer:
+    """
+    Raises I0 once per `interval` seconds.
+    """
+    def __init__(self, cpu, interval=1.0):
+        self.cpu = cpu
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.tick, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def tick(self):
+        while not self.stopped.wait(self.interval):
+            self.cpu.raise_interrupt(0)
+
+
+# Seconds between checks for the previous key having been taken, while
+# the next one waits
+KEY_POLL = 0.001
+
+
+class Keyboard:
+    """
+    Raises I1 for every byte read from `stream`, storing it at 0xF4.
+    Bytes are queued and each is only delivered once the previous one
+    has been taken (its IS bit cleared) and its handler has returned,
+    so none are overwritten.
+
+    If the stream is a terminal it is put in cbreak mode (no line
+    buffering or echo) until stop() is called.
+    """
+    def __init__(self, cpu, stream=None):
+        self.cpu = cpu
+        self.stream = stream if stream is not None else sys.stdin
+        self.saved = None
+        # Bytes read and not yet delivered; None from stop() ends
+        # delivery
+        self.keys = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.delivery = threading.Thread(target=self.deliver, daemon=True)
+
+    def start(self):
+        fd = self.stream.fileno()
+        if termios is not None and os.isatty(fd):
+            self.saved = termios.tcgetattr(fd)
+            tty.setcbreak(fd)
+        self.thread.start()
+        self.delivery.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.keys.put(None)
+        if self.saved is not None:
+            termios.tcsetattr(self.stream.fileno(), termios.TCSADRAIN,
+                              self.saved)
+            self.saved = None
+
+    def read(self):
+        fd = self.stream.fileno()
+        while True:
+            data = os.read(fd, 1)
+            if not data:
+                return
+            self.keys.put(data[0])
+
+    def deliver(self):
+        cpu = self.cpu
+        while True:
+            # Sleeps until a byte arrives
+            key = self.keys.get()
+            if key is None:
+                return
+
+            while cpu.reg[6] & 0b10 or not cpu.interrupts_enabled:
+                if self.stopped.wait(KEY_POLL):
+                    return
+
+            cpu.raise_interrupt(1, key=key)
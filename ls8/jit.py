@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+
+"""
+JIT tier for the LS-8 emulator.
+
+Hot basic blocks (found by a per-PC execution counter) are turned into
+Python source with the registers held in local variables, compiled with
+compile(), and installed in the CPU's translation cache in place of the
+decoded block. A block that jumps back to its own start loops inside the
+compiled function instead of returning to the dispatcher every time.
+
+Usage: jit.py [examples dir]
+
+Run as a script, every example program is executed on both the
+interpreter and the JIT and the output and final state compared.
+"""
+
+import contextlib
+import io
+import os
+import sys
+
+from cpu import (
+    ADD, AND, CALL, CMP, CPU, DEC, HLT, INC, JEQ, JGE, JGT, JLE, JLT, JMP,
+    JNE, LD, LDI, MUL, NOP, NOT, OR, POP, PRA, PRN, PUSH, RET, SHL, SHR,
+    SUB, XOR,
+)
+from devices import CaptureOutput
+
+# Executions of a block start before it is compiled
+THRESHOLD = 16
+
+# Maximum trips around a self-loop before handing control back to the
+# interpreter loop
+LOOP_LIMIT = 4096
+
+# LD's template while input ports are mapped
+LD_PORT = ["{a} = inputs[{b}]() if {b} in inputs else ram[{b}]"]
+
+# Straight-line instruction templates. {a} and {b} are register locals
+# (r0-r7), {i} is the raw second operand byte.
+BODY = {
+    LDI: ["{a} = {i}"],
+    ADD: ["{a} = ({a} + {b}) & 0xFF"],
+    SUB: ["{a} = ({a} - {b}) & 0xFF"],
+    MUL: ["{a} = ({a} * {b}) & 0xFF"],
+    AND: ["{a} = {a} & {b}"],
+    OR: ["{a} = {a} | {b}"],
+    XOR: ["{a} = {a} ^ {b}"],
+    NOT: ["{a} = ~{a} & 0xFF"],
+    INC: ["{a} = ({a} + 1) & 0xFF"],
+    DEC: ["{a} = ({a} - 1) & 0xFF"],
+    SHL: ["{a} = ({a} << {b}) & 0xFF"],
+    SHR: ["{a} = {a} >> {b}"],
+    CMP: ["fl = 4 if {a} < {b} else 2 if {a} > {b} else 1"],
+    PRN: ["cpu.output.write(b'%d\\n' % {a})"],
+    POP: ["{a} = ram[r7]", "r7 = (r7 + 1) & 0xFF"],
+    LD: ["{a} = ram[{b}]"],
+    PRA: ["cpu.output.write(b'%c' % {a})"],
+    NOP: [],
+}
+
+# Block-ending instruction templates. Each sets `pc` to the next PC;
+# {n} is the address of the following instruction. Templates that push
+# set `addr` and `value` and leave the store to the epilogue, which
+# checks for stack overflow first.
+TAIL = {
+    JMP: ["pc = {a}"],
+    JEQ: ["pc = {a} if fl & 1 else {n}"],
+    JNE: ["pc = {n} if fl & 1 else {a}"],
+    JGT: ["pc = {a} if fl & 2 else {n}"],
+    JLT: ["pc = {a} if fl & 4 else {n}"],
+    JLE: ["pc = {a} if fl & 5 else {n}"],
+    JGE: ["pc = {a} if fl & 3 else {n}"],
+    HLT: ["cpu.handle_hlt(0, 0)", "pc = {n}"],
+    RET: ["pc = ram[r7]", "r7 = (r7 + 1) & 0xFF"],
+    CALL: ["r7 = (r7 - 1) & 0xFF", "addr = r7",
+           "value = {n} & 0xFF", "pc = {a}"],
+    PUSH: ["r7 = (r7 - 1) & 0xFF", "addr = r7",
+           "value = {a}", "pc = {n}"],
+}
+
+# Tails that may jump back to the start of their own block
+LOOPING = (JMP, JEQ, JNE, JGT, JLT, JLE, JGE)
+
+# Tails that store to the stack
+STORING = (CALL, PUSH)
+
+
+class JIT:
+    """
+    Compiles hot LS-8 basic blocks into Python functions.
+    """
+    def __init__(self, cpu, threshold=THRESHOLD):
+        """
+        Attach a JIT to `cpu`.
+        """
+        self.cpu = cpu
+        self.threshold = threshold
+        # Per-PC execution counter
+        self.counts = [0] * 256
+        # Block start PCs that can't be compiled (unsupported opcode)
+        self.rejected = set()
+
+    def decode(self, start):
+        """
+        Return the instructions of the block at `start` as a list of
+        (pc, opcode, oper1, oper2), using the same block boundaries as
+        CPU.translate().
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+        instructions = []
+        pc = start
+
+        while True:
+            execute_cmd = ram[pc]
+            size = (execute_cmd >> 6) + 1
+            instructions.append((pc, execute_cmd, ram[pc + 1], ram[pc + 2]))
+
+            if (cpu.block_end[execute_cmd]
+                    or len(instructions) > cpu.BLOCK_LIMIT
+                    or pc + size + 2 >= len(ram)):
+                return instructions
+
+            pc += size
+
+    def generate(self, start):
+        """
+        Return Python source for the block at `start`, or None if the
+        block uses an instruction the JIT doesn't handle.
+        """
+        instructions = self.decode(start)
+        *body, (tail_pc, tail_cmd, tail_a, tail_b) = instructions
+
+        if tail_cmd not in TAIL:
+            return None
+
+        lines = []
+        used = {7} if tail_cmd in STORING or tail_cmd == RET else set()
+
+        for pc, execute_cmd, oper1, oper2 in body:
+            if execute_cmd not in BODY:
+                return None
+            if execute_cmd >> 6:
+                if oper1 > 7:
+                    return None
+                used.add(oper1)
+            if execute_cmd >> 6 == 2 and execute_cmd != LDI:
+                if oper2 > 7:
+                    return None
+                used.add(oper2)
+            if execute_cmd == POP:
+                used.add(7)
+
+            templates = BODY[execute_cmd]
+            if execute_cmd == LD and self.cpu.inputs:
+                templates = LD_PORT
+
+            for template in templates:
+                lines.append(template.format(
+                    a=f"r{oper1}", b=f"r{oper2}", i=oper2))
+
+        if tail_cmd >> 6:
+            if tail_a > 7:
+                return None
+            used.add(tail_a)
+
+        next_pc = tail_pc + (tail_cmd >> 6) + 1
+        for template in TAIL[tail_cmd]:
+            lines.append(template.format(a=f"r{tail_a}", n=next_pc))
+
+        # Registers are loaded into locals on entry and all of them
+        # written back on exit
+        regs = sorted(used)
+        source = ["def block():"]
+        source += [f"    r{r} = reg[{r}]" for r in regs]
+        source.append("    fl = cpu.fl")
+
+        # Each block records the instructions it ran in
+        # cpu.block_cycles, for budgeted runs
+        count = len(instructions)
+
+        if tail_cmd in LOOPING:
+            source.append("    for trip in range(LOOP_LIMIT):")
+            source += [f"        {line}" for line in lines]
+            source.append(f"        if pc != {start}:")
+            source.append("            break")
+            source.append(f"    cpu.block_cycles = {count} * (trip + 1)")
+        else:
+            source += [f"    {line}" for line in lines]
+            source.append(f"    cpu.block_cycles = {count}")
+
+        source += [f"    reg[{r}] = r{r}" for r in regs]
+        source.append("    cpu.fl = fl")
+
+        if tail_cmd in STORING:
+            # On overflow, leave the machine as the interpreter would:
+            # SP not yet moved and the PC on the pushing instruction
+            source.append("    if addr < cpu.stack_limit or addr == 0xFF:")
+            source.append("        reg[7] = (addr + 1) & 0xFF")
+            source.append(f"        cpu.pc = {tail_pc}")
+            source.append("        cpu.stack_overflow(addr)")
+            source.append("    ram[addr] = value")
+            source.append("    if code_map[addr]:")
+            source.append("        cpu.flush_blocks()")
+
+        source.append("    return pc")
+
+        return "\n".join(source) + "\n"
+
+    def compile(self, start):
+        """
+        Compile the block at `start` and install it in the CPU's
+        translation cache. Returns the installed block, or None.
+        """
+        source = self.generate(start)
+        if source is None:
+            self.rejected.add(start)
+            return None
+
+        cpu = self.cpu
+        namespace = {
+            "cpu": cpu,
+            "reg": cpu.reg,
+            "ram": cpu.ram,
+            "code_map": cpu.code_map,
+            "inputs": cpu.inputs,
+            "LOOP_LIMIT": LOOP_LIMIT,
+        }
+        code = compile(source, f"<ls8 block {start:02X}>", "exec")
+        exec(code, namespace)
+
+        # Make sure the RAM under the block is marked as code, then
+        # replace the decoded block with the compiled one
+        cpu.translate(start)
+        block = ((), namespace["block"])
+        cpu.blocks[start] = block
+
+        return block
+
+    def run(self, max_cycles=None, deadline=None):
+        """
+        Run the CPU, interpreting cold blocks from the translation
+        cache and compiling hot ones. Returns a RunResult like
+        CPU.run(). Budgets are checked once per block, and a compiled
+        self-loop counts as one block, so a run may go past
+        `max_cycles` by up to LOOP_LIMIT trips around it.
+        """
+        return self.cpu.run_engine(self.step, max_cycles, deadline,
+                                   free=self.run_loop)
+
+    def step(self, count):
+        """
+        The budgeted block loop: run blocks until at least `count`
+        instructions have, and return how many did (see
+        CPU.run_engine()).
+        """
+        cpu = self.cpu
+        blocks = cpu.blocks
+        translate = cpu.translate
+        counts = self.counts
+        threshold = self.threshold
+
+        cycles = 0
+        try:
+            while cpu.running and cycles < count:
+                pc = cpu.pc
+                try:
+                    body, tail = blocks[pc]
+                except KeyError:
+                    body, tail = translate(pc)
+
+                if body:
+                    counts[pc] += 1
+                    if counts[pc] >= threshold and pc not in self.rejected:
+                        body, tail = self.compile(pc) or (body, tail)
+
+                # Compiled blocks overwrite this with their own count
+                cpu.block_cycles = len(body) + 1
+                for op in body:
+                    op()
+                cpu.pc = tail()
+                cycles += cpu.block_cycles
+        finally:
+            cpu.cycles += cycles
+
+        return cycles
+
+    def run_loop(self):
+        """
+        The JIT's block loop.
+        """
+        cpu = self.cpu
+        blocks = cpu.blocks
+        translate = cpu.translate
+        counts = self.counts
+        threshold = self.threshold
+
+        while True:
+            while cpu.running:
+                pc = cpu.pc
+                try:
+                    body, tail = blocks[pc]
+                except KeyError:
+                    body, tail = translate(pc)
+
+                if body:
+                    # Still a decoded block: count it towards compilation
+                    counts[pc] += 1
+                    if counts[pc] >= threshold and pc not in self.rejected:
+                        body, tail = self.compile(pc) or (body, tail)
+
+                for op in body:
+                    op()
+                cpu.pc = tail()
+
+            if not cpu.poll_interrupts():
+                break
+
+
+def check(file_name):
+    """
+    Run a program on the interpreter and on the JIT (compiling every
+    block on first sight) and return a list of differences.
+    """
+    results = []
+
+    for engine in ("interp", "jit"):
+        cpu = CPU()
+        cpu.load(file_name)
+        cpu.output = CaptureOutput()
+        # Catches the trace printed on a fault
+        out = io.StringIO()
+
+        with contextlib.redirect_stdout(out):
+            if engine == "jit":
+                result = JIT(cpu, threshold=1).run()
+            else:
+                result = cpu.run()
+
+        results.append({
+            "output": bytes(cpu.output.data),
+            "trace": out.getvalue(),
+            "status": result.status,
+            "reason": result.reason,
+            "pc": cpu.pc,
+            "fl": cpu.fl,
+            "reg": list(cpu.reg),
+            "ram": list(cpu.ram),
+        })
+
+    interp, jit = results
+
+    return [k for k in interp if interp[k] != jit[k]]
+
+
+# Engine name -> function(cpu) returning a callable that runs the
+# loaded program, for ls8.py -e and the tools that compare engines
+ENGINES = {
+    "interp": lambda cpu: cpu.run,
+    "blocks": lambda cpu: cpu.run_blocks,
+    "jit": lambda cpu: JIT(cpu).run,
+}
+
+
+# Examples that never halt on their own
+NON_HALTING = {"interrupts.ls8", "keyboard.ls8"}
+
+
+def main(argv):
+    examples = argv[1] if len(argv) > 1 else "examples"
+    failures = 0
+
+    for name in sorted(os.listdir(examples)):
+        if not name.endswith(".ls8") or name in NON_HALTING:
+            continue
+
+        diff = check(os.path.join(examples, name))
+        if diff:
+            failures += 1
+            print(f"{name}: MISMATCH in {', '.join(diff)}")
+        else:
+            print(f"{name}: ok")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -2,17 +2,211 @@
 
 """Main."""
 
+import argparse
+import mmap
+import signal
 import sys
-from cpu import CPU
+import time
+from cpu import CPU, RUN_BUDGET, RUN_HALTED
+from devices import BufferedOutput, StreamInput
+from interrupts import Keyboard, Timer
+from jit import ENGINES
+from profiler import Profiler
+from tracer import Tracer
 
-if len(sys.argv) !=2:
-    print(f"{sys.argv[0]} <file name>")
-    sys.exit(1)
+parser = argparse.ArgumentParser(description="Run an LS-8 program.")
+parser.add_argument("file_name", nargs="?",
+                    help="program to run (.ls8, .ls8b or .asm)")
+parser.add_argument("-e", "--engine", choices=ENGINES, default="interp",
+                    help="execution engine (default: interp)")
+parser.add_argument("--profile", metavar="REPORT",
+                    help="profile the run (on the interpreter) and write "
+                         "a hot-spot report to REPORT at exit")
+parser.add_argument("--trace", metavar="FILE",
+                    help="record a binary execution trace (on the "
+                         "interpreter) and dump it to FILE at exit, on a "
+                         "crash, or on SIGUSR1")
+parser.add_argument("--save-snapshot", metavar="FILE",
+                    help="stop after --after cycles and save the machine "
+                         "state to FILE")
+parser.add_argument("--after", metavar="N", type=int, default=0,
+                    help="cycles to run before --save-snapshot "
+                         "(default: 0)")
+parser.add_argument("--resume", metavar="FILE",
+                    help="continue from a snapshot saved with "
+                         "--save-snapshot instead of loading a program")
+parser.add_argument("--no-interrupts", action="store_true",
+                    help="don't start the timer and keyboard interrupt "
+                         "sources")
+parser.add_argument("--output-port", metavar="ADDR", type=lambda x: int(x, 0),
+                    help="map an output port at RAM address ADDR: bytes "
+                         "stored there with ST are printed")
+parser.add_argument("--input-port", metavar="ADDR",
+                    type=lambda x: int(x, 0),
+                    help="map an input port at RAM address ADDR: LD from "
+                         "it reads the next byte of --input, and LD from "
+                         "ADDR+1 its status (1: byte ready, 2: end of "
+                         "input)")
+parser.add_argument("--input", metavar="FILE", default="-",
+                    help="what --input-port reads (default: - for stdin)")
+parser.add_argument("--unbuffered", action="store_true",
+                    help="write program output immediately instead of "
+                         "buffering it")
+parser.add_argument("--max-cycles", metavar="N", type=int,
+                    help="stop after N instructions (the block engines "
+                         "check once per block)")
+parser.add_argument("--timeout", metavar="SECONDS", type=float,
+                    help="stop after SECONDS of wall-clock time")
+parser.add_argument("--prebuild", action="store_true",
+                    help="analyse the program's control flow and decode "
+                         "its blocks before running (blocks and jit "
+                         "engines)")
+parser.add_argument("--banks", metavar="FILE",
+                    help="turn on bank switching with FILE as the bank "
+                         "store, mapped copy-on-write so the file is never "
+                         "changed")
+parser.add_argument("--memoize", action="store_true",
+                    help="answer calls to pure subroutines from a cache "
+                         "(not from jit-compiled code) and print its "
+                         "counters at exit")
+parser.add_argument("--histogram", metavar="FILE",
+                    help="count executions per opcode (on the "
+                         "interpreter) and write the histogram to FILE "
+                         "at exit")
+parser.add_argument("--heatmap", metavar="FILE",
+                    help="count reads and writes per RAM address (on the "
+                         "interpreter) and write the heatmap to FILE at "
+                         "exit")
+parser.add_argument("--metrics", metavar="FILE",
+                    help="export run counters to FILE in the Prometheus "
+                         "text format every few seconds and at exit (on "
+                         "the interpreter)")
+args = parser.parse_args()
+
+if args.file_name is None and args.resume is None:
+    parser.error("a program or --resume snapshot is required")
 
 cpu = CPU()
 
-cpu.load(sys.argv[1])
-cpu.run()
+try:
+    if args.resume:
+        cpu.load_snapshot(args.resume)
+    else:
+        cpu.load(args.file_name)
+except ValueError as e:
+    # Bad snapshot, image, .ls8 text or assembler source
+    print(f"{args.resume or args.file_name}: {e}", file=sys.stderr)
+    sys.exit(1)
+
+if args.banks:
+    try:
+        with open(args.banks, "rb") as file:
+            cpu.map_banks(mmap.mmap(file.fileno(), 0,
+                                    access=mmap.ACCESS_COPY))
+    except (OSError, ValueError) as e:
+        print(f"{args.banks}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if not args.unbuffered:
+    cpu.output = BufferedOutput().start()
+if args.output_port is not None:
+    cpu.map_output(args.output_port)
+
+input_file = None
+if args.input_port is not None:
+    try:
+        input_file = (sys.stdin.buffer if args.input == "-"
+                      else open(args.input, "rb"))
+    except OSError as e:
+        print(f"{args.input}: {e}", file=sys.stderr)
+        sys.exit(1)
+    cpu.map_input(args.input_port, StreamInput(input_file))
+
+memo = None
+if args.memoize:
+    from memo import Memoizer
+    memo = Memoizer(cpu).install()
+
+# Only loaded when asked for, so plain runs keep CPU.run()
+hooks = histogram = heatmap = exporter = None
+if args.histogram or args.heatmap or args.metrics:
+    from hooks import Hooks, MemoryHeatmap, MetricsExporter, OpcodeHistogram
+    hooks = Hooks(cpu).install()
+    if args.histogram:
+        histogram = OpcodeHistogram().attach(hooks)
+    if args.heatmap:
+        heatmap = MemoryHeatmap().attach(hooks)
+    if args.metrics:
+        exporter = MetricsExporter(args.metrics).attach(hooks).start()
+
+devices = []
+status = 0
+tracer = profiler = None
+if not args.no_interrupts:
+    devices.append(Timer(cpu).start())
+    # The input port gets stdin to itself
+    if sys.stdin is not None and input_file is not sys.stdin.buffer:
+        devices.append(Keyboard(cpu).start())
+
+try:
+    if args.save_snapshot:
+        cpu.run(max_cycles=args.after)
+        cpu.save_snapshot(args.save_snapshot)
+    else:
+        if args.trace:
+            tracer = Tracer(cpu)
+            if hasattr(signal, "SIGUSR1"):
+                signal.signal(signal.SIGUSR1,
+                              lambda signum, frame: tracer.dump(args.trace))
+            run = tracer.run
+        elif args.profile:
+            profiler = Profiler(cpu)
+            run = profiler.run
+        elif hooks is not None:
+            # The hooks' run loop is an interpreter
+            run = cpu.run
+        else:
+            if args.prebuild:
+                from cfg import analyze_cpu
+                cpu.prebuild(analyze_cpu(cpu).block_starts())
+            run = ENGINES[args.engine](cpu)
+
+        if args.max_cycles is not None or args.timeout is not None:
+            deadline = (time.monotonic() + args.timeout
+                        if args.timeout is not None else None)
+            result = run(max_cycles=args.max_cycles, deadline=deadline)
+        else:
+            result = run()
+
+        if result.status == RUN_BUDGET:
+            print(f"Stopped: {result.reason} budget used up after "
+                  f"{result.cycles} instructions", file=sys.stderr)
+        elif result.status != RUN_HALTED:
+            cpu.output.flush()
+            where = cpu.line_map.get(cpu.pc)
+            print(f"{result.status}: {result.reason}"
+                  + (f" (source line {where})" if where else ""),
+                  file=sys.stderr)
+            status = 1
+finally:
+    for device in devices:
+        device.stop()
+    cpu.output.flush()
+    if tracer is not None:
+        tracer.dump(args.trace)
+    if profiler is not None:
+        profiler.write_report(args.profile)
+    if memo is not None:
+        print("memoize: " + ", ".join(f"{name} {value}" for name, value
+                                      in memo.stats().items()),
+              file=sys.stderr)
+    if exporter is not None:
+        exporter.stop()
+    for consumer, file_name in ((histogram, args.histogram),
+                                (heatmap, args.heatmap)):
+        if consumer is not None:
+            with open(file_name, "w") as file:
+                file.write(consumer.report())
 
 if __name__ == "__main__":
-    pass
+    sys.exit(status)
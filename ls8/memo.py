@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+"""
+Memoized subroutine calls for the LS-8 emulator.
+
+A Memoizer finds the program's pure subroutines with the control-flow
+analysis in cfg.py: ones that, with everything they call, only compute
+on registers and their own stack frame. No PRN, PRA, ST, LD, INT, IRET
+or HLT, every jump and call target known, and the stack balanced. For
+each it works out the registers (and whether FL) whose values on entry
+can affect the result.
+
+install() swaps the CPU's CALL handler for one that looks up
+(target, those input values) in an LRU cache. On a hit it makes the
+call's whole effect at once: the return address and the frame bytes
+the subroutine pushed are stored, the registers it writes (and FL, if
+it compares) are set, and the PC moves on past the CALL, with the
+instructions in between never run. On a miss the call runs normally
+through a recording loop that collects the same effect for next time.
+
+The swap covers everything that goes through the dispatch table: run(),
+run_blocks() and the profiler and tracer loops. Compiled JIT blocks
+push their own return addresses, so calls from them aren't memoized. A
+memoized call counts as one instruction in budgeted runs. In budgeted
+runs, recordings stop where CPU.budget says, which leaves room for the
+rest of the run loop's current slice; near the end of a budget, calls
+simply run unrecorded.
+
+Usage: memo.py <program> [--size N] [--cycles N]
+
+Runs the program with and without memoization (for at most N
+instructions each), checks that both end in the same state, and prints
+the cache counters and instruction counts.
+"""
+
+import argparse
+import collections
+import sys
+import time
+
+from cfg import analyze_cpu
+from cpu import (
+    ALU, CALL, CMP, CPU, HLT, INT, IRET, JNE, JUMP_IF, LD, LDI, POP, PRA,
+    PRN, RET, ST,
+)
+
+# Instructions that reach outside registers and the stack frame
+IMPURE = frozenset((LD, ST, PRN, PRA, HLT, INT, IRET))
+
+# FL's slot in the liveness sets, after R0-R7
+FL = 8
+
+# Default cache size, in entries
+CACHE_SIZE = 1024
+
+# Most instructions recorded for one call before giving up on it
+RECORD_LIMIT = 100000
+
+# Instructions main() runs each way before stopping a program that
+# doesn't halt
+COMPARE_CYCLES = 5000000
+
+# A recorded call: the registers it leaves as (number, value) pairs, FL
+# (None if untouched), the stack bytes it leaves below its return
+# address, the offset of the lowest of them from SP at the CALL, and the
+# instructions the call stands for
+MemoEntry = collections.namedtuple("MemoEntry",
+                                   "registers fl frame low count")
+
+
+class Subroutine:
+    """
+    A pure subroutine and what its memo key and entries cover.
+    """
+    def __init__(self, entry, instructions, inputs, outputs, sets_fl, code):
+        self.entry = entry
+        # Addresses of every instruction it or its callees can run
+        self.instructions = instructions
+        # Registers read before being written, as a tuple; FL is read if
+        # `reads_fl`
+        self.inputs = tuple(r for r in sorted(inputs) if r != FL)
+        self.reads_fl = FL in inputs
+        # Registers it may write, apart from SP
+        self.outputs = tuple(sorted(outputs - {7}))
+        # Whether it may change FL
+        self.sets_fl = sets_fl
+        # (address, bytes) runs of its code, checked on every hit so a
+        # rewritten subroutine isn't answered from the cache
+        self.code = code
+
+
+def uses(execute_cmd, oper1, oper2):
+    """
+    Return the registers (FL as 8) an instruction reads.
+    """
+    if execute_cmd == LDI or execute_cmd == POP or execute_cmd == RET:
+        return set()
+    if execute_cmd in JUMP_IF or execute_cmd == JNE:
+        return {oper1, FL}
+    if execute_cmd >> 6 == 2:
+        return {oper1, oper2}
+    if execute_cmd >> 6 == 1:
+        return {oper1}
+    return set()
+
+
+def defines(execute_cmd, oper1):
+    """
+    Return the registers (FL as 8) an instruction always writes.
+    """
+    if execute_cmd == CMP:
+        return {FL}
+    if execute_cmd in ALU or execute_cmd == LDI or execute_cmd == POP:
+        return {oper1}
+    return set()
+
+
+def code_runs(analysis, instructions):
+    """
+    Return the bytes of `instructions` as (address, bytes) runs.
+    """
+    ram = analysis.ram
+    addresses = set()
+    for pc in instructions:
+        addresses.update(range(pc, pc + (ram[pc] >> 6) + 1))
+
+    runs = []
+    for address in sorted(addresses):
+        if runs and runs[-1][1] == address:
+            runs[-1][1] += 1
+        else:
+            runs.append([address, address + 1])
+    return [(start, ram[start:end]) for start, end in runs]
+
+
+def find_pure(analysis):
+    """
+    Return {entry: Subroutine} for the pure subroutines in a cfg
+    Analysis.
+    """
+    functions = analysis.functions
+
+    def closure(entry, seen):
+        # Instructions of a function and everything it calls
+        if entry in seen:
+            return set()
+        seen.add(entry)
+        pcs = set(functions[entry].instructions)
+        for target in functions[entry].calls:
+            pcs |= closure(target, seen)
+        return pcs
+
+    flagged = (set(analysis.unresolved) | analysis.invalid | analysis.off_end
+               | set(analysis.bad_returns) | analysis.underflows
+               | analysis.sp_writes)
+
+    candidates = {}
+    for entry, func in functions.items():
+        if func.kind != "subroutine":
+            continue
+        pcs = closure(entry, set())
+        if any(pc in flagged or pc not in analysis.instructions
+               or analysis.instructions[pc][0] in IMPURE for pc in pcs):
+            continue
+        candidates[entry] = pcs
+
+    # A callee must be pure for its caller to be
+    changed = True
+    while changed:
+        changed = False
+        for entry in list(candidates):
+            if not functions[entry].calls <= set(candidates):
+                del candidates[entry]
+                changed = True
+
+    # Registers live on entry, by backward dataflow over each function
+    # body, iterated to a fixpoint across calls. At RET everything the
+    # function may write is live, since a path that skips the write
+    # passes the caller's value through.
+    live_in = {entry: set() for entry in candidates}
+    exits = {}
+    for entry, pcs in candidates.items():
+        out = set(functions[entry].writes)
+        if any(analysis.instructions[pc][0] == CMP for pc in pcs):
+            out.add(FL)
+        exits[entry] = out
+
+    changed = True
+    while changed:
+        changed = False
+        for entry in candidates:
+            func = functions[entry]
+            live = {}
+            settled = False
+            while not settled:
+                settled = True
+                for pc in sorted(func.instructions, reverse=True):
+                    execute_cmd, oper1, oper2 = analysis.instructions[pc]
+                    if execute_cmd == RET:
+                        after = exits[entry]
+                    else:
+                        after = set()
+                        for target in analysis.edges.get(pc, ()):
+                            after |= live.get(target, set())
+                    if execute_cmd == CALL:
+                        # The callee's writes aren't certain, so nothing
+                        # is killed
+                        callee = analysis.call_targets[pc]
+                        before = after | live_in[callee] | {oper1}
+                    else:
+                        before = ((after - defines(execute_cmd, oper1))
+                                  | uses(execute_cmd, oper1, oper2))
+                    if before != live.get(pc):
+                        live[pc] = before
+                        settled = False
+
+            if live[entry] != live_in[entry]:
+                live_in[entry] = live[entry]
+                changed = True
+
+    return {
+        entry: Subroutine(entry, frozenset(pcs), live_in[entry],
+                          set(functions[entry].writes), FL in exits[entry],
+                          code_runs(analysis, pcs))
+        for entry, pcs in candidates.items()
+    }
+
+
+class Memoizer:
+    """
+    Answers calls to a CPU's pure subroutines from an LRU cache.
+    """
+    def __init__(self, cpu, size=CACHE_SIZE, analysis=None):
+        """
+        Find the pure subroutines of the program loaded in `cpu` (using
+        `analysis`, a cfg.Analysis of it, if given) and keep up to
+        `size` recorded calls.
+        """
+        self.cpu = cpu
+        self.size = size
+        if analysis is None:
+            analysis = analyze_cpu(cpu)
+        # Entry address -> Subroutine
+        self.pure = find_pure(analysis)
+        # (entry, input values..., FL) -> MemoEntry, least recently used
+        # first
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Instructions that hits didn't have to run
+        self.skipped = 0
+
+        # The lowest stack address written since the innermost call
+        # being recorded started
+        self.lowest = 0x100
+        # Instructions run by recordings, plus those hits stood for
+        self.steps = 0
+        self.handle_call = cpu.handle_call
+
+    def install(self):
+        """
+        Swap the CPU's CALL handler for the memoizing one. It stays in
+        place when the CPU rebuilds its dispatch table (mapping ports or
+        banks, reset()), but a fork() gets the plain handler.
+        """
+        cpu = self.cpu
+        self.handle_call = cpu.dispatch[CALL]
+        cpu.overrides[CALL] = self.call
+        cpu.bind_dispatch()
+        # Cached blocks hold the old CALL handler
+        cpu.flush_blocks()
+        return self
+
+    def uninstall(self):
+        """
+        Put the CPU's own CALL handler back.
+        """
+        cpu = self.cpu
+        cpu.overrides.pop(CALL, None)
+        cpu.bind_dispatch()
+        cpu.flush_blocks()
+
+    def call(self, oper1, oper2):
+        """
+        CALL regA, answered from the cache when the target is pure.
+        """
+        cpu = self.cpu
+        reg = cpu.reg
+        # A bad register operand faults inside the real handler, after
+        # it has moved SP
+        sub = self.pure.get(reg[oper1]) if oper1 < 8 else None
+        if sub is None:
+            return self.handle_call(oper1, oper2)
+
+        key = (sub.entry, *[reg[r] for r in sub.inputs],
+               cpu.fl if sub.reads_fl else 0)
+        entry = self.cache.get(key)
+        base = reg[7]
+        ram = cpu.ram
+
+        # The lowest stack address a hit would write, if there is one
+        lowest = base + entry.low if entry is not None else -1
+        if (lowest >= 0 and lowest >= cpu.stack_limit
+                and all(ram[start:start + len(code)] == code
+                        for start, code in sub.code)):
+            self.cache.move_to_end(key)
+            self.hits += 1
+            self.skipped += entry.count
+            self.steps += entry.count
+
+            # The stack grows one byte at a time, so everything between
+            # the lowest address and the return address was written
+            ram[lowest:base - 1] = entry.frame
+            ram[base - 1] = (cpu.pc + 2) & 0xFF
+            if any(cpu.code_map[lowest:base]):
+                cpu.flush_blocks()
+            if lowest < self.lowest:
+                self.lowest = lowest
+            for r, value in entry.registers:
+                reg[r] = value
+            if entry.fl is not None:
+                cpu.fl = entry.fl
+            cpu.pc = (cpu.pc + 2) & 0xFF
+            return
+
+        self.misses += 1
+        self.record(sub, key, oper1, oper2)
+
+    def record(self, sub, key, oper1, oper2):
+        """
+        Run a call to `sub` to its RET, collecting its effect into the
+        cache under `key`. Calls it makes go through call() too, so they
+        are answered or recorded in turn. Gives up, leaving the CPU
+        wherever it got to for the run loop to carry on from, if the
+        call is interrupted, runs too long or strays outside the
+        subroutine's code, or if the run's budget runs out.
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+        reg = cpu.reg
+        dispatch = cpu.dispatch
+        pc_step = cpu.pc_step
+        allowed = sub.instructions
+
+        base = reg[7]
+        return_pc = (cpu.pc + 2) & 0xFF
+        self.handle_call(oper1, oper2)
+
+        outer = self.lowest
+        self.lowest = base - 1
+        start = self.steps
+        count = 0
+        finished = False
+
+        # The run's budget. Recorded instructions go into cpu.cycles as
+        # they run, so calls recorded inside this one count against it
+        # too
+        end, deadline = cpu.budget or (sys.maxsize, None)
+
+        try:
+            while cpu.pc != return_pc or reg[7] != base:
+                pc = cpu.pc
+                if pc not in allowed:
+                    # The analysis missed this path; stop trusting it
+                    self.pure.pop(sub.entry, None)
+                    return
+                if (not cpu.running or count == RECORD_LIMIT
+                        or cpu.cycles >= end):
+                    return
+                # The clock is read as often as the run loops read it
+                if (deadline is not None and count % cpu.CHECK_INTERVAL == 0
+                        and count and time.monotonic() >= deadline):
+                    return
+
+                execute_cmd = ram[pc]
+                count += 1
+                cpu.cycles += 1
+                dispatch[execute_cmd](ram[pc + 1], ram[pc + 2])
+                cpu.pc += pc_step[execute_cmd]
+
+                if reg[7] < self.lowest:
+                    self.lowest = reg[7]
+            finished = True
+        finally:
+            # Counted whether or not the recording finished
+            self.steps += count
+            lowest = self.lowest
+            self.lowest = min(outer, lowest)
+
+        if finished:
+            self.cache[key] = MemoEntry(
+                tuple((r, reg[r]) for r in sub.outputs),
+                cpu.fl if sub.sets_fl else None,
+                bytes(ram[lowest:base - 1]),
+                lowest - base,
+                self.steps - start)
+            if len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def stats(self):
+        """
+        Return the cache counters as a dict.
+        """
+        return {
+            "subroutines": len(self.pure),
+            "entries": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+        }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Compare a run with and without memoized calls.")
+    parser.add_argument("program", help="program (.asm, .ls8 or .ls8b)")
+    parser.add_argument("--size", type=int, default=CACHE_SIZE,
+                        help=f"cache entries (default: {CACHE_SIZE})")
+    parser.add_argument("--cycles", type=int, default=COMPARE_CYCLES,
+                        help=f"instructions to run each way "
+                             f"(default: {COMPARE_CYCLES})")
+    args = parser.parse_args(argv[1:])
+
+    from devices import CaptureOutput
+
+    results = []
+    for memoize in (False, True):
+        cpu = CPU()
+        cpu.output = CaptureOutput()
+        cpu.load(args.program)
+        memo = Memoizer(cpu, args.size).install() if memoize else None
+
+        # Count what actually executes, memoized calls as one
+        result = cpu.run(max_cycles=args.cycles)
+        results.append((cpu.snapshot()[:-8], cpu.output.getvalue(), result))
+
+    (plain, plain_output, plain_result), (fast, fast_output,
+                                          fast_result) = results
+
+    print("pure subroutines: "
+          + (", ".join(f"{entry:02X}" for entry in sorted(memo.pure))
+             or "none"))
+    for name, value in memo.stats().items():
+        print(f"{name}: {value}")
+    print(f"instructions: {plain_result.cycles} -> {fast_result.cycles}")
+
+    if (plain, plain_output, plain_result.status) != \
+            (fast, fast_output, fast_result.status):
+        print("memoized run ended in a different state", file=sys.stderr)
+        return 1
+    print("same final state and output")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,192 @@
+"""
+Execution profiler for the LS-8 emulator.
+
+Profiler.run() runs the CPU through CPU.run_engine(), budgets and
+RunResult included, with an interpreter step that also counts
+executions per PC, per opcode and per CALL target, and (optionally)
+wall-clock time per PC. report() maps the hot addresses back to the
+labels in cpu.symbols, so the output reads in terms of subroutines.
+"""
+
+import time
+
+from cpu import CALL, OPCODE_NAMES
+
+
+class Profiler:
+    """
+    Profiles one CPU's run.
+    """
+    def __init__(self, cpu, timing=True):
+        """
+        Attach a profiler to `cpu`. With `timing` off only counts are
+        kept, which roughly halves the profiling overhead.
+        """
+        self.cpu = cpu
+        self.timing = timing
+        # Executions and nanoseconds per PC
+        self.pc_counts = [0] * 256
+        self.pc_times = [0] * 256
+        # CALL target -> number of calls
+        self.calls = {}
+
+
+    def run(self, max_cycles=None, deadline=None):
+        """
+        Run the CPU like CPU.run(), collecting the profile, and return a
+        RunResult. Unlike CPU.run(), unbudgeted runs count cycles too.
+        """
+        step = self.step_timed if self.timing else self.step
+        return self.cpu.run_engine(step, max_cycles, deadline)
+
+    def step(self, count):
+        """
+        The counting loop: run up to `count` instructions and return how
+        many ran (see CPU.run_engine()).
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+        dispatch = cpu.dispatch
+        pc_step = cpu.pc_step
+        pc_counts = self.pc_counts
+        calls = self.calls
+        call = CALL
+
+        cycles = 0
+        try:
+            while cpu.running and cycles < count:
+                cycles += 1
+                pc = cpu.pc
+                execute_cmd = ram[pc]
+
+                dispatch[execute_cmd](ram[pc + 1], ram[pc + 2])
+                cpu.pc += pc_step[execute_cmd]
+
+                pc_counts[pc] += 1
+                if execute_cmd == call:
+                    calls[cpu.pc] = calls.get(cpu.pc, 0) + 1
+        finally:
+            cpu.cycles += cycles
+
+        return cycles
+
+    def step_timed(self, count):
+        """
+        step(), also timing every instruction.
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+        dispatch = cpu.dispatch
+        pc_step = cpu.pc_step
+        pc_counts = self.pc_counts
+        pc_times = self.pc_times
+        calls = self.calls
+        call = CALL
+        clock = time.perf_counter_ns
+
+        cycles = 0
+        try:
+            while cpu.running and cycles < count:
+                cycles += 1
+                pc = cpu.pc
+                execute_cmd = ram[pc]
+
+                start = clock()
+                dispatch[execute_cmd](ram[pc + 1], ram[pc + 2])
+                cpu.pc += pc_step[execute_cmd]
+                pc_times[pc] += clock() - start
+
+                pc_counts[pc] += 1
+                if execute_cmd == call:
+                    calls[cpu.pc] = calls.get(cpu.pc, 0) + 1
+        finally:
+            cpu.cycles += cycles
+
+        return cycles
+
+    def label(self, address):
+        """
+        Return `address` as "LABEL+offset" using the nearest label at or
+        below it, or as a hex address if there is none.
+        """
+        best = None
+        for name, value in self.cpu.symbols.items():
+            if value <= address and (best is None or value > best[1]):
+                best = (name, value)
+
+        if best is None:
+            return f"{address:02X}"
+        if best[1] == address:
+            return best[0]
+        return f"{best[0]}+{address - best[1]}"
+
+    def region(self, address):
+        """
+        Return the label whose region contains `address`, or "(top)".
+        """
+        name = self.label(address).split("+")[0]
+        return name if name in self.cpu.symbols else "(top)"
+
+    def report(self, top=20):
+        """
+        Return the profile as text.
+        """
+        ram = self.cpu.ram
+        total = sum(self.pc_counts) or 1
+        total_time = sum(self.pc_times) or 1
+        lines = [f"Instructions executed: {sum(self.pc_counts)}"]
+
+        # Aggregate by opcode and by labelled region
+        op_counts = {}
+        op_times = {}
+        regions = {}
+        for pc, count in enumerate(self.pc_counts):
+            if count == 0:
+                continue
+            name = OPCODE_NAMES.get(ram[pc], f"{ram[pc]:08b}")
+            op_counts[name] = op_counts.get(name, 0) + count
+            op_times[name] = op_times.get(name, 0) + self.pc_times[pc]
+            region = self.region(pc)
+            regions[region] = regions.get(region, 0) + count
+
+        lines.append("")
+        lines.append("By label:")
+        for name, count in sorted(regions.items(), key=lambda x: -x[1]):
+            lines.append(f"  {name:<20} {count:>12} {100 * count / total:6.2f}%")
+
+        lines.append("")
+        lines.append("CALL targets:")
+        for target, count in sorted(self.calls.items(), key=lambda x: -x[1]):
+            lines.append(f"  {self.label(target):<20} {count:>12} calls")
+
+        lines.append("")
+        lines.append("By opcode:")
+        for name, count in sorted(op_counts.items(), key=lambda x: -x[1]):
+            line = f"  {name:<8} {count:>12} {100 * count / total:6.2f}%"
+            if self.timing:
+                line += f" {op_times[name] / 1e6:10.3f}ms"
+            lines.append(line)
+
+        lines.append("")
+        lines.append(f"Hottest {top} addresses:")
+        hot = sorted(range(256), key=lambda pc: -self.pc_counts[pc])[:top]
+        for pc in hot:
+            count = self.pc_counts[pc]
+            if count == 0:
+                break
+            name = OPCODE_NAMES.get(ram[pc], f"{ram[pc]:08b}")
+            line = (f"  {pc:02X} {self.label(pc):<20} {name:<6} {count:>12} "
+                    f"{100 * count / total:6.2f}%")
+            if self.timing:
+                line += (f" {self.pc_times[pc] / 1e6:10.3f}ms "
+                         f"{100 * self.pc_times[pc] / total_time:6.2f}%")
+            lines.append(line)
+
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, file_name, top=20):
+        """
+        Write the profile report to `file_name`.
+        """
+        with open(file_name, "w") as file:
+            file.write(self.report(top))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+Binary execution trace recorder for the LS-8 emulator.
+
+Tracer.run() runs the CPU through CPU.run_engine(), budgets and
+RunResult included, with an interpreter step that appends one
+fixed-size record per instruction to a preallocated ring buffer:
+
+    step (u64), pc, opcode, operand A, operand B, FL after,
+    R0-R7 after, RAM write flag, address, old byte, new byte
+
+dump() writes the buffer, oldest record first, after a header and a
+snapshot of the machine at dump time. Because every record carries the
+full register file and the old value of any byte it stored, the state
+after any recorded step can be rebuilt by undoing stores backwards from
+the final snapshot, without re-running the program. (The stack pushes
+made on interrupt entry are not recorded, so replay across an interrupt
+leaves those stack bytes at their later values.)
+
+Usage: tracer.py <trace file> [step]
+
+Prints the recorded steps, or the rebuilt machine state after `step`.
+"""
+
+import struct
+import sys
+
+from cpu import CPU, STATE_PC, STATE_RUNNING, STATE_SIZE
+
+TRACE_MAGIC = b"LS8T"
+# Version 1 had 32-bit step counts, which overflowed after 2**32 steps
+TRACE_VERSION = 2
+TRACE_HEADER = struct.Struct("<4sBBIQ")
+RECORD = struct.Struct("<QBBBBB8sBBBB")
+
+# Default ring buffer capacity, in records
+CAPACITY = 65536
+
+
+class Tracer:
+    """
+    Records one CPU's execution into a ring buffer.
+    """
+    def __init__(self, cpu, capacity=CAPACITY):
+        """
+        Attach a tracer to `cpu` keeping the last `capacity` records.
+        """
+        self.cpu = cpu
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        # Total records written (the ring holds the last `capacity`)
+        self.count = 0
+
+        # Opcode -> kind of RAM store it makes: 1 pushes to the stack,
+        # 2 stores to the address in register A
+        self.stores = [0] * 256
+        self.stores[cpu.PUSH] = 1
+        self.stores[cpu.CALL] = 1
+        self.stores[cpu.ST] = 2
+
+    def run(self, max_cycles=None, deadline=None):
+        """
+        Run the CPU like CPU.run(), recording every instruction, and
+        return a RunResult. Unlike CPU.run(), unbudgeted runs count
+        cycles too.
+        """
+        return self.cpu.run_engine(self.step, max_cycles, deadline)
+
+    def step(self, count):
+        """
+        The tracing loop: run up to `count` instructions and return how
+        many ran (see CPU.run_engine()).
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+        reg = cpu.reg
+        dispatch = cpu.dispatch
+        pc_step = cpu.pc_step
+        stores = self.stores
+        buffer = self.buffer
+        pack_into = RECORD.pack_into
+        size = RECORD.size
+        end = len(buffer)
+
+        step = self.count
+        offset = (step % self.capacity) * size
+
+        cycles = 0
+        try:
+            while cpu.running and cycles < count:
+                # A faulting instruction counts as executed, but isn't
+                # recorded
+                cycles += 1
+                pc = cpu.pc
+                execute_cmd = ram[pc]
+                oper1 = ram[pc + 1]
+                oper2 = ram[pc + 2]
+
+                store = stores[execute_cmd]
+                if store:
+                    address = ((reg[7] - 1) & 0xFF if store == 1
+                               else reg[oper1 & 7])
+                    old = ram[address]
+
+                dispatch[execute_cmd](oper1, oper2)
+                cpu.pc += pc_step[execute_cmd]
+
+                if store:
+                    pack_into(buffer, offset, step, pc, execute_cmd, oper1,
+                              oper2, cpu.fl, reg, 1, address, old,
+                              ram[address])
+                else:
+                    pack_into(buffer, offset, step, pc, execute_cmd, oper1,
+                              oper2, cpu.fl, reg, 0, 0, 0, 0)
+
+                step += 1
+                offset += size
+                if offset == end:
+                    offset = 0
+        finally:
+            self.count = step
+            cpu.cycles += cycles
+
+        return cycles
+
+    def records(self):
+        """
+        Return the buffered records, oldest first, as raw bytes.
+        """
+        if self.count <= self.capacity:
+            return bytes(self.buffer[:self.count * RECORD.size])
+
+        split = (self.count % self.capacity) * RECORD.size
+        return bytes(self.buffer[split:] + self.buffer[:split])
+
+    def dump(self, file_name):
+        """
+        Write the trace, with a snapshot of the current machine state,
+        to `file_name`.
+        """
+        records = self.records()
+
+        with open(file_name, "wb") as file:
+            file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION,
+                                         RECORD.size,
+                                         len(records) // RECORD.size,
+                                         self.count))
+            file.write(self.cpu.snapshot())
+            file.write(records)
+
+
+class Trace:
+    """
+    A trace file loaded for offline replay.
+    """
+    def __init__(self, file_name):
+        """
+        Read the trace in `file_name`.
+        """
+        with open(file_name, "rb") as file:
+            data = file.read()
+
+        magic, version, size, count, total = TRACE_HEADER.unpack_from(data)
+        if (magic != TRACE_MAGIC or version != TRACE_VERSION
+                or size != RECORD.size):
+            raise ValueError(f"{file_name}: not a version {TRACE_VERSION} "
+                             f"LS-8 trace")
+
+        start = TRACE_HEADER.size
+        # Machine state when the trace was dumped
+        self.final = data[start:start + STATE_SIZE]
+        # Record tuples, oldest first
+        self.records = list(RECORD.iter_unpack(data[start + STATE_SIZE:]))
+        # Steps executed in total, including ones that fell off the ring
+        self.total = total
+
+    def steps(self):
+        """
+        Return the range of step numbers present in the trace.
+        """
+        if not self.records:
+            return range(0)
+        return range(self.records[0][0], self.records[-1][0] + 1)
+
+    def state_at(self, step):
+        """
+        Return a CPU holding the machine state right after `step`.
+        """
+        steps = self.steps()
+        if step not in steps:
+            raise IndexError(f"step {step} is not in the trace "
+                             f"({steps.start}-{steps.stop - 1})")
+
+        cpu = CPU()
+        cpu.restore(self.final)
+
+        index = step - steps.start
+        record = self.records[index]
+
+        # Undo RAM stores made after `step`, newest first
+        for later in reversed(self.records[index + 1:]):
+            if later[7]:
+                cpu.ram[later[8]] = later[9]
+
+        cpu.reg[:] = record[6]
+        cpu.fl = record[5]
+        cpu.running = True
+
+        # The PC is where the next recorded instruction started, or
+        # the final PC for the last one
+        if index + 1 < len(self.records):
+            cpu.pc = self.records[index + 1][1]
+        else:
+            cpu.pc = self.final[STATE_PC]
+            cpu.running = bool(self.final[STATE_RUNNING])
+
+        return cpu
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(f"{argv[0]} <trace file> [step]", file=sys.stderr)
+        return 1
+
+    trace = Trace(argv[1])
+
+    if len(argv) > 2:
+        cpu = trace.state_at(int(argv[2]))
+        cpu.trace()
+        return 0
+
+    print(f"{trace.total} steps executed, {len(trace.records)} recorded")
+    for (step, pc, execute_cmd, oper1, oper2, fl, reg, stored, address, old,
+         new) in trace.records:
+        line = (f"{step:>10} {pc:02X} | {execute_cmd:02X} {oper1:02X} "
+                f"{oper2:02X} | {fl:02X} |" + "".join(f" {r:02X}" for r in reg))
+        if stored:
+            line += f" | [{address:02X}] {old:02X} -> {new:02X}"
+        print(line)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+"""
+Vectorised LS-8: N machines held in NumPy arrays and stepped together.
+
+Every step the machines still running are grouped by the opcode at
+their PC and each group is executed as one masked array operation.
+Registers and RAM are uint8 arrays, so arithmetic wraps at 8 bits as
+the spec requires.
+
+Interrupts are not modelled. PRN/PRA output is collected per machine
+in `output` instead of being printed. Machines fault wherever CPU would:
+on an unknown opcode, a register operand above R7, a divide by zero, a
+stack overflow or an instruction in the last two bytes of RAM.
+
+Usage: vector_cpu.py [machines] [steps] [program.ls8]
+
+Run as a script, compares throughput against separate CPU.run loops.
+"""
+
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+
+from cpu import (
+    ADD, AND, CALL, CMP, CPU, DEC, DIV, FL_E, FL_G, FL_L, HLT, INC, JMP,
+    JNE, JUMP_IF, LD, LDI, MOD, MUL, NOP, NOT, OR, POP, PRA, PRN, PUSH,
+    RET, SHL, SHR, ST, SUB, XOR,
+)
+from devices import CaptureOutput
+
+SP = 7
+
+# Opcodes whose operand A or B must name a register; a bigger operand
+# faults before the instruction has any effect. PUSH, CALL and the
+# jumps check operand A themselves, at the point CPU would fault
+REGISTER_A = {
+    LDI, LD, ST, PRN, PRA, ADD, SUB, MUL, DIV, MOD, AND, OR, XOR, SHL, SHR,
+    INC, DEC, NOT, CMP, POP,
+}
+REGISTER_B = {LD, ST, ADD, SUB, MUL, DIV, MOD, AND, OR, XOR, SHL, SHR, CMP}
+
+
+class VectorCPU:
+    """
+    N LS-8 machines stepped in lockstep.
+    """
+    def __init__(self, n):
+        """
+        Construct `n` machines in the power-on state.
+        """
+        self.n = n
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.reg = np.zeros((n, 8), dtype=np.uint8)
+        self.reg[:, SP] = 0xF4
+        self.pc = np.zeros(n, dtype=np.uint8)
+        self.fl = np.zeros(n, dtype=np.uint8)
+        self.running = np.ones(n, dtype=bool)
+        # Machines stopped by a fault (see faults())
+        self.fault = np.zeros(n, dtype=bool)
+        # End of the loaded program: pushing below it is a stack overflow
+        self.stack_limit = 0
+        # Per-machine PRN/PRA output
+        self.output = [[] for _ in range(n)]
+        # Machine-steps executed
+        self.steps = 0
+
+        # PC advance per opcode, from the `AABCDDDD` layout
+        self.pc_step = np.array(
+            [0 if op & 0b00010000 else (op >> 6) + 1 for op in range(256)],
+            dtype=np.uint8)
+
+        self.dispatch = {
+            LDI: self.op_ldi, LD: self.op_ld, ST: self.op_st,
+            PRN: self.op_prn, PRA: self.op_pra, HLT: self.op_hlt,
+            NOP: self.op_nop,
+            ADD: self.op_alu, SUB: self.op_alu, MUL: self.op_alu,
+            AND: self.op_alu, OR: self.op_alu, XOR: self.op_alu,
+            DIV: self.op_div, MOD: self.op_div,
+            SHL: self.op_shift, SHR: self.op_shift,
+            INC: self.op_incdec, DEC: self.op_incdec, NOT: self.op_not,
+            CMP: self.op_cmp,
+            PUSH: self.op_push, POP: self.op_pop,
+            CALL: self.op_call, RET: self.op_ret,
+            JMP: self.op_jmp, JNE: self.op_jne,
+        }
+        for op in JUMP_IF:
+            self.dispatch[op] = self.op_jcond
+
+    def load(self, file_name):
+        """
+        Load the same program into every machine.
+        """
+        cpu = CPU()
+        cpu.load(file_name)
+        self.ram[:] = np.frombuffer(cpu.ram, dtype=np.uint8)
+        self.stack_limit = cpu.stack_limit
+
+    def step(self):
+        """
+        Execute one instruction on every running machine.
+        """
+        rows = np.flatnonzero(self.running)
+        if len(rows) == 0:
+            return False
+
+        # CPU fetches both operand bytes of every instruction, so an
+        # instruction in the last two bytes of RAM faults
+        pcs = self.pc[rows]
+        edge = pcs > 0xFD
+        if edge.any():
+            self.stop(rows[edge], pcs[edge])
+            rows, pcs = rows[~edge], pcs[~edge]
+            if len(rows) == 0:
+                return False
+
+        # Fetch through a flat view of RAM: one gather per byte
+        ram = self.ram.reshape(-1)
+        base = rows * 256
+        ops = ram[base + pcs]
+        oper1 = ram[base + (pcs + np.uint8(1))]
+        oper2 = ram[base + (pcs + np.uint8(2))]
+
+        # Advance PCs first; jump handlers overwrite them
+        self.pc[rows] = pcs + self.pc_step[ops]
+
+        present = np.flatnonzero(np.bincount(ops, minlength=256))
+
+        if len(present) == 1:
+            # Every machine is on the same opcode: no masking needed
+            self.execute(int(present[0]), rows, oper1, oper2, pcs)
+        else:
+            for op in present.tolist():
+                mask = ops == op
+                self.execute(op, rows[mask], oper1[mask], oper2[mask],
+                             pcs[mask])
+
+        self.steps += len(rows)
+        return True
+
+    def execute(self, op, rows, a, b, pcs):
+        """
+        Execute opcode `op` on `rows`, after faulting those whose
+        register operands don't name a register.
+        """
+        bad = None
+        if op in REGISTER_A:
+            bad = a > 7
+        if op in REGISTER_B:
+            bad = b > 7 if bad is None else bad | (b > 7)
+        if bad is not None and bad.any():
+            self.stop(rows[bad], pcs[bad])
+            ok = ~bad
+            rows, a, b, pcs = rows[ok], a[ok], b[ok], pcs[ok]
+
+        self.dispatch.get(op, self.op_unknown)(op, rows, a, b, pcs)
+
+    def stop(self, rows, pcs):
+        """
+        Fault `rows`, leaving their PCs on the faulting instructions.
+        """
+        self.running[rows] = False
+        self.fault[rows] = True
+        self.pc[rows] = pcs
+
+    def stack_room(self, rows, a, pcs):
+        """
+        Fault the machines among `rows` whose next push would overflow
+        the stack, as CPU.stack_overflow() does, and return the rest as
+        (rows, a, pcs).
+        """
+        address = self.reg[rows, SP] - np.uint8(1)
+        over = (address < self.stack_limit) | (address == 0xFF)
+        if over.any():
+            self.stop(rows[over], pcs[over])
+            ok = ~over
+            rows, a, pcs = rows[ok], a[ok], pcs[ok]
+        return rows, a, pcs
+
+    def run(self, max_steps=None):
+        """
+        Step until every machine has halted or faulted, or for at most
+        `max_steps` steps.
+        """
+        count = 0
+        while (max_steps is None or count < max_steps) and self.step():
+            count += 1
+
+    # Operation handlers: (opcode, machine rows, operand A, operand B,
+    # instruction PC). Operands checked by execute() name registers
+
+    def op_ldi(self, op, rows, a, b, pcs):
+        self.reg[rows, a] = b
+
+    def op_ld(self, op, rows, a, b, pcs):
+        self.reg[rows, a] = self.ram[rows, self.reg[rows, b]]
+
+    def op_st(self, op, rows, a, b, pcs):
+        self.ram[rows, self.reg[rows, a]] = self.reg[rows, b]
+
+    def op_prn(self, op, rows, a, b, pcs):
+        for row, value in zip(rows.tolist(), self.reg[rows, a].tolist()):
+            self.output[row].append(str(value) + "\n")
+
+    def op_pra(self, op, rows, a, b, pcs):
+        for row, value in zip(rows.tolist(), self.reg[rows, a].tolist()):
+            self.output[row].append(chr(value))
+
+    def op_hlt(self, op, rows, a, b, pcs):
+        self.running[rows] = False
+
+    def op_nop(self, op, rows, a, b, pcs):
+        pass
+
+    def op_alu(self, op, rows, a, b, pcs):
+        x = self.reg[rows, a]
+        y = self.reg[rows, b]
+        if op == ADD:
+            result = x + y
+        elif op == SUB:
+            result = x - y
+        elif op == MUL:
+            result = x * y
+        elif op == AND:
+            result = x & y
+        elif op == OR:
+            result = x | y
+        else:
+            result = x ^ y
+        self.reg[rows, a] = result
+
+    def op_div(self, op, rows, a, b, pcs):
+        x = self.reg[rows, a]
+        y = self.reg[rows, b]
+
+        # Dividing by zero stops that machine
+        zero = y == 0
+        if zero.any():
+            self.stop(rows[zero], pcs[zero])
+            rows, a, x, y = rows[~zero], a[~zero], x[~zero], y[~zero]
+
+        self.reg[rows, a] = x // y if op == DIV else x % y
+
+    def op_shift(self, op, rows, a, b, pcs):
+        x = self.reg[rows, a]
+        y = self.reg[rows, b]
+        # Shifting an 8-bit value by 8 or more leaves nothing
+        big = y > 7
+        y = np.where(big, 0, y)
+        result = (x << y) if op == SHL else (x >> y)
+        self.reg[rows, a] = np.where(big, 0, result)
+
+    def op_incdec(self, op, rows, a, b, pcs):
+        self.reg[rows, a] += np.uint8(1) if op == INC else np.uint8(255)
+
+    def op_not(self, op, rows, a, b, pcs):
+        self.reg[rows, a] = ~self.reg[rows, a]
+
+    def op_cmp(self, op, rows, a, b, pcs):
+        x = self.reg[rows, a]
+        y = self.reg[rows, b]
+        self.fl[rows] = np.where(x < y, FL_L, np.where(x > y, FL_G, FL_E))
+
+    def op_push(self, op, rows, a, b, pcs):
+        rows, a, pcs = self.stack_room(rows, a, pcs)
+        self.reg[rows, SP] -= np.uint8(1)
+
+        # CPU moves SP before it reads the register
+        bad = a > 7
+        if bad.any():
+            self.stop(rows[bad], pcs[bad])
+            rows, a = rows[~bad], a[~bad]
+
+        self.ram[rows, self.reg[rows, SP]] = self.reg[rows, a]
+
+    def op_pop(self, op, rows, a, b, pcs):
+        self.reg[rows, a] = self.ram[rows, self.reg[rows, SP]]
+        self.reg[rows, SP] += np.uint8(1)
+
+    def op_call(self, op, rows, a, b, pcs):
+        rows, a, pcs = self.stack_room(rows, a, pcs)
+        self.reg[rows, SP] -= np.uint8(1)
+        self.ram[rows, self.reg[rows, SP]] = pcs + np.uint8(2)
+
+        # ...and pushes the return address before it reads the target
+        bad = a > 7
+        if bad.any():
+            self.stop(rows[bad], pcs[bad])
+            rows, a = rows[~bad], a[~bad]
+
+        self.pc[rows] = self.reg[rows, a]
+
+    def op_ret(self, op, rows, a, b, pcs):
+        self.pc[rows] = self.ram[rows, self.reg[rows, SP]]
+        self.reg[rows, SP] += np.uint8(1)
+
+    def op_jmp(self, op, rows, a, b, pcs):
+        self.jump(rows, a, pcs, np.ones(len(rows), dtype=bool))
+
+    def op_jne(self, op, rows, a, b, pcs):
+        self.jump(rows, a, pcs, (self.fl[rows] & FL_E) == 0)
+
+    def op_jcond(self, op, rows, a, b, pcs):
+        self.jump(rows, a, pcs, (self.fl[rows] & JUMP_IF[op]) != 0)
+
+    def jump(self, rows, a, pcs, taken):
+        """
+        Jump `rows` where `taken` to the address in register `a`; the
+        rest go on to the next instruction. Only a taken jump reads
+        the register, so only a taken jump faults on a bad one.
+        """
+        bad = taken & (a > 7)
+        if bad.any():
+            self.stop(rows[bad], pcs[bad])
+            ok = ~bad
+            rows, a, pcs, taken = rows[ok], a[ok], pcs[ok], taken[ok]
+
+        # Rows not jumping may still hold a bad operand, unread
+        self.pc[rows] = np.where(taken, self.reg[rows, a & 7],
+                                 pcs + np.uint8(2))
+
+    def op_unknown(self, op, rows, a, b, pcs):
+        self.stop(rows, pcs)
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 10000
+    steps = int(argv[2]) if len(argv) > 2 else 2000
+    file_name = argv[3] if len(argv) > 3 else "examples/loop.ls8"
+
+    vcpu = VectorCPU(n)
+    vcpu.load(file_name)
+    start = time.perf_counter()
+    vcpu.run(max_steps=steps)
+    elapsed = time.perf_counter() - start
+    print(f"VectorCPU: {vcpu.steps} machine-steps in {elapsed:.3f}s "
+          f"({vcpu.steps / elapsed:,.0f} steps/s)")
+
+    # The same work as separate CPU.run loops, timed on a sample
+    sample = min(n, 100)
+    start = time.perf_counter()
+    executed = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(sample):
+            cpu = CPU()
+            cpu.load(file_name)
+            cpu.output = CaptureOutput()
+            cpu.run(max_cycles=steps)
+            executed += cpu.cycles
+    elapsed = time.perf_counter() - start
+    print(f"CPU.run:   {executed} machine-steps in {elapsed:.3f}s "
+          f"({executed / elapsed:,.0f} steps/s)")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))